@@ -9,11 +9,16 @@ class OrderItemInline(admin.TabularInline):
     # Optionally, you can control the number of extra empty forms shown:
     # extra = 0
 
+    # OrderItem.__str__ reads the product and the order, load them with the items instead of one query per line
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related("product", "order__user")
+
 
 # Custom admin for Order model
 # Displays related OrderItems inline on the Order detail page
 class OrderAdmin(admin.ModelAdmin):
     inlines = [OrderItemInline]
+    list_select_related = ("user",)  # Order.__str__ shows the username
 
 
 # Register the customized Order admin with the site
@@ -6,4 +6,13 @@ class ApiConfig(AppConfig):
     name = "api"
 
     def ready(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+
         from . import signals  # noqa: F401
+        from .instrumentation import install_query_dispatch
+
+        # Per-request query recording (api/instrumentation.py), also on the connections opened already
+        connection_created.connect(install_query_dispatch)
+        for connection in connections.all(initialized_only=True):
+            install_query_dispatch(connection=connection)
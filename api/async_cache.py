@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from redis import asyncio as aioredis
+
+from api.cache import generation_key
+from api.metrics import record_page_cache
+from api.replicas import primary_reads
+
+"""
+Async page caching for the async views
+
+Talks to the Redis of the default cache through redis.asyncio, so waiting on Redis doesn't hold a
+thread the way django-redis (sync) would. Keys are built by the default cache's make_key and the
+generation counters are the ones bumped by the sync invalidation (api/cache.py, django-redis stores
+integers as plain numbers), so a product or order write evicts the async pages as well.
+"""
+
+_clients = weakref.WeakKeyDictionary()  # An asyncio connection belongs to the event loop that opened it
+
+
+def get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        config = settings.ASYNC_CACHE
+        client = _clients[loop] = aioredis.Redis.from_url(config["LOCATION"], **config.get("OPTIONS", {}))
+    return client
+
+
+async def aget_generation(namespace):
+    client, key = get_client(), cache.make_key(generation_key(namespace))
+    generation = await client.get(key)
+    if generation is None:
+        # Same start as get_generation: from the clock, only if nobody set it in the meantime
+        await client.set(key, int(time.time() * 1000), nx=True)
+        generation = await client.get(key)
+    return int(generation)
+
+
+async def acache_page_by_generation(request, timeout, namespace, render):
+    """
+    The body rendered by `await render()`, cached per URL under the namespace's current generation
+    (the async counterpart of cache_page_by_generation, `namespace` can be a tuple of namespaces as well).
+    Errors are raised by render, so never cached.
+    """
+    namespaces = (namespace,) if isinstance(namespace, str) else namespace
+    prefix = ".".join([f"{name}.{await aget_generation(name)}" for name in namespaces])
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    key = cache.make_key(f"async_page.{prefix}.{path}")
+    client = get_client()
+
+    body = await client.get(key)
+    record_page_cache(request, hit=body is not None)
+    if body is None:
+        with primary_reads():  # Not from a replica that may be behind (api/replicas.py)
+            body = await render()
+        await client.set(key, body, ex=timeout)
+    return body
@@ -0,0 +1,191 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Count, Max
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import (
+    APIException,
+    AuthenticationFailed,
+    MethodNotAllowed,
+    NotAuthenticated,
+    NotFound,
+    PermissionDenied,
+)
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from api.async_cache import acache_page_by_generation
+from api.cache import order_list_page_namespaces
+from api.models import Order, Product, User
+from api.renderers import FastJSONRenderer
+from api.replicas import aread_alias
+from api.serializers import ProductSerializer
+from api.streaming import astream_json_object, stream_json_object
+from api.views import OrderViewSet, ProductDetailAPIView, ProductInfoAPIView, ProductListCreateAPIView
+
+"""
+Async read paths
+
+Native async versions of the product list/detail/info and order list/retrieve endpoints, served under
+/async/. The database is read through the async ORM (acount, aget, aiterator, async for) and the page
+cache through redis.asyncio, so under an ASGI server (products/asgi.py, e.g. uvicorn products.asgi:application)
+a request waiting on I/O doesn't hold a thread. They still answer under WSGI, one thread per request.
+
+Each one borrows the configuration of its DRF view (filters, ordering, pagination, serializers,
+permissions, throttles, query budget) so both return the same JSON. DRF views are sync only, so the
+request checks are redone here: session or JWT authentication, permissions and the throttles (which
+use the sync cache, run in a worker thread).
+"""
+
+renderer = FastJSONRenderer()
+jwt_authentication = JWTAuthentication()
+
+
+def json_response(data, status=200):
+    return HttpResponse(renderer.render(data), content_type="application/json", status=status)
+
+
+def error_response(exc):
+    data = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+    status = exc.status_code
+    # SessionAuthentication comes first and has no WWW-Authenticate header: DRF answers 403 instead of 401
+    if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+        status = 403
+    response = json_response(data, status)
+    if getattr(exc, "wait", None):
+        response["Retry-After"] = "%d" % exc.wait
+    return response
+
+
+async def authenticate(request):
+    """The user of the session, else of the JWT bearer token, in the same order as the DRF settings"""
+    user = await request.auser()
+    if user.is_authenticated:
+        return user
+
+    header = jwt_authentication.get_header(request)
+    raw_token = jwt_authentication.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return user
+
+    token = jwt_authentication.get_validated_token(raw_token)
+    try:
+        user_id = token[jwt_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken("Token contained no recognizable user identification")
+    try:
+        user = await User.objects.aget(**{jwt_settings.USER_ID_FIELD: user_id})
+    except User.DoesNotExist:
+        raise AuthenticationFailed("User not found", code="user_not_found")
+    if not user.is_active:
+        raise AuthenticationFailed("User is inactive", code="user_inactive")
+    return user
+
+
+def async_api_view(view_class, action=None):
+    """
+    Turn `async def handler(view, request, **kwargs)` into an async GET view checked like `view_class`:
+    the handler gets an instance of the DRF view (for its filters, paginator and serializers) and the
+    DRF request, and DRF exceptions come out as the usual JSON errors.
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, **kwargs):
+            drf_request = Request(request)
+            view = view_class()
+            view.setup(drf_request, **kwargs)
+            view.format_kwarg, view.action, view.headers = None, action, {}
+            try:
+                if request.method not in ("GET", "HEAD"):
+                    raise MethodNotAllowed(request.method)
+                drf_request.user = await authenticate(request)
+                await aread_alias(request)  # The replica is chosen here, db_for_read then has nothing to look up
+                try:
+                    view.check_permissions(drf_request)
+                except PermissionDenied:
+                    if not drf_request.user.is_authenticated:
+                        raise NotAuthenticated()
+                    raise
+                await sync_to_async(view.check_throttles, thread_sensitive=False)(drf_request)
+                return await handler(view, drf_request, **kwargs)
+            except APIException as exc:
+                return error_response(exc)
+
+        # Same attributes as a DRF view function, for the query budgets (api/querybudget.py). Left out of the
+        # OpenAPI schema (schema=None), where their sync views already describe them
+        wrapper.cls, wrapper.actions = view_class, {"get": action} if action else {}
+        wrapper.initkwargs = {"schema": None}
+        return wrapper
+
+    return decorator
+
+
+async def paginated_data(view, queryset):
+    paginator = view.paginator
+    if paginator is None:
+        return view.get_serializer([obj async for obj in queryset], many=True).data
+    page = await paginator.apaginate_queryset(queryset, view.request, view=view)
+    return paginator.get_paginated_response(view.get_serializer(page, many=True).data).data
+
+
+@async_api_view(ProductListCreateAPIView)
+async def product_list(view, request):
+    async def render():
+        # The view's own queryset, without the get_queryset of the sync view (and its sleep)
+        queryset = view.filter_queryset(ProductListCreateAPIView.queryset.all())
+        return renderer.render(await paginated_data(view, queryset))
+
+    body = await acache_page_by_generation(request, 60 * 15, "product_list", render)
+    return HttpResponse(body, content_type="application/json")
+
+
+@async_api_view(ProductDetailAPIView)
+async def product_detail(view, request, product_id):
+    try:
+        product = await ProductDetailAPIView.queryset.aget(pk=product_id)
+    except Product.DoesNotExist:
+        raise NotFound("No Product matches the given query.")
+    return json_response(view.get_serializer(product).data)
+
+
+@async_api_view(ProductInfoAPIView)
+async def product_info(view, request):
+    products = Product.objects.defer("search_vector").order_by("pk")
+    info = await products.aaggregate(count=Count("pk"), max_price=Max("price"))
+    max_price = info["max_price"]
+    # A WSGI server can only send a sync iterator (Django would read an async one whole into memory
+    # first), so the rows are streamed through the async ORM under ASGI only
+    stream = astream_json_object if isinstance(request._request, ASGIRequest) else stream_json_object
+    return StreamingHttpResponse(
+        stream(
+            "products",
+            products,
+            ProductSerializer,
+            extra={"count": info["count"], "max_price": float(max_price) if max_price is not None else None},
+            chunk_size=ProductInfoAPIView.chunk_size,
+        ),
+        content_type="application/json",
+    )
+
+
+@async_api_view(OrderViewSet, action="list")
+async def order_list(view, request):
+    async def render():
+        queryset = view.filter_queryset(view.get_queryset())
+        return renderer.render(await paginated_data(view, queryset))
+
+    body = await acache_page_by_generation(request, 60 * 15, order_list_page_namespaces(request.user), render)
+    return HttpResponse(body, content_type="application/json")
+
+
+@async_api_view(OrderViewSet, action="retrieve")
+async def order_detail(view, request, pk):
+    try:
+        order = await view.get_queryset().aget(pk=pk)
+    except Order.DoesNotExist:
+        raise NotFound("No Order matches the given query.")
+    return json_response(view.get_serializer(order).data)
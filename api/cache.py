@@ -0,0 +1,133 @@
+import time
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import transaction
+from django.views.decorators.cache import cache_page
+
+from api.metrics import record_page_cache
+from api.replicas import primary_reads
+
+"""
+Generation based page caching
+
+Every cached page key is prefixed with the current generation of its namespace (e.g. product_list.17).
+Invalidating a namespace is a single INCR of its generation counter: the old pages are never
+looked up again and simply expire, so there is no keyspace SCAN like with delete_pattern.
+"""
+
+
+def generation_key(namespace):
+    return f"generation:{namespace}"
+
+
+def get_generation(namespace):
+    generation = cache.get(generation_key(namespace))
+    if generation is None:
+        # Start from the clock so a counter that was evicted never reuses an old generation
+        cache.add(generation_key(namespace), int(time.time() * 1000), timeout=None)
+        generation = cache.get(generation_key(namespace))
+    return generation
+
+
+def bump_generation(namespace):
+    try:
+        return cache.incr(generation_key(namespace))
+    except ValueError:  # Counter missing (never read yet or evicted)
+        generation = int(time.time() * 1000)
+        cache.set(generation_key(namespace), generation, timeout=None)
+        return generation
+
+
+def coalesce_on_commit(name, flush, using=None):
+    """
+    The state (a dict) gathering what the writes of the current transaction want done once it commits,
+    handed to `flush(state)` by a single on_commit callback. None outside a transaction.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return None
+
+    pending = getattr(connection, "pending_on_commit", None)
+    if pending is None:
+        pending = connection.pending_on_commit = {}
+    state = pending.get(name)
+    # After a rollback Django drops the callback, so register a fresh one
+    if state is None or not any(func is state["callback"] for _, func, _ in connection.run_on_commit):
+        state = {}
+
+        def callback():
+            if pending.get(name) is state:
+                del pending[name]
+            flush(state)
+
+        state["callback"] = callback
+        pending[name] = state
+        transaction.on_commit(callback, using=using)
+    return state
+
+
+def flush_generation_bumps(state):
+    for namespace in state["namespaces"]:
+        bump_generation(namespace)
+
+
+def bump_generation_on_commit(*namespaces, using=None):
+    """
+    Bump the generations once the current transaction commits (right away outside a transaction).
+    All the bumps requested inside one transaction are coalesced into a single INCR per namespace.
+    """
+    state = coalesce_on_commit("generation_bumps", flush_generation_bumps, using=using)
+    if state is None:
+        for namespace in namespaces:
+            bump_generation(namespace)
+        return
+    state.setdefault("namespaces", set()).update(namespaces)
+
+
+def order_list_namespace(user=None, user_id=None):
+    """Staff see every order and share one namespace, other users get one namespace each"""
+    if user is not None and user.is_staff:
+        return "order_list.staff"
+    return f"order_list.user.{user.pk if user is not None else user_id}"
+
+
+def order_list_page_namespaces(user):
+    """The namespaces of the user's order list pages: the items show their products (name, price) as well"""
+    return order_list_namespace(user), "product_list"
+
+
+def generations_prefix(namespace):
+    """`namespace` (or each of a tuple of namespaces) with its current generation, as a key prefix"""
+    namespaces = (namespace,) if isinstance(namespace, str) else namespace
+    return ".".join(f"{name}.{get_generation(name)}" for name in namespaces)
+
+
+def cache_page_by_generation(timeout, namespace):
+    """
+    cache_page whose key_prefix carries the namespace's current generation.
+    `namespace` can also be a tuple of namespaces, for a page that any of them moves on, or a callable
+    taking the (authenticated) request that returns either, e.g. to cache per user.
+    """
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            current = namespace(request) if callable(namespace) else namespace
+            key_prefix = generations_prefix(current)
+            rendered = []
+
+            # On a hit the cache middleware answers from the cache and the view never runs
+            def view(*view_args, **view_kwargs):
+                rendered.append(True)
+                with primary_reads():  # Not from a replica that may be behind (api/replicas.py)
+                    return view_func(*view_args, **view_kwargs)
+
+            response = cache_page(timeout, key_prefix=key_prefix)(view)(request, *args, **kwargs)
+            if request.method in ("GET", "HEAD"):
+                record_page_cache(request, hit=not rendered)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,178 @@
+import hashlib
+from functools import wraps
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import SAFE_METHODS
+
+from api.cache import get_generation, order_list_page_namespaces
+from api.models import Order, Product
+from api.object_cache import get_product
+
+"""
+Conditional requests (ETag / Last-Modified)
+
+A view method decorated with @conditional(version) first asks `version` for the state of what it would
+return: a few updated_at values, counts and maxima read from the version indexes (migration 0003), or
+for the lists the generations of their page cache (api/cache.py), never the objects themselves. From
+them come a strong ETag and a Last-Modified date (none for the lists), so that:
+
+- a GET with a matching If-None-Match (or an If-Modified-Since not older) is answered 304 Not Modified
+  without loading, serializing or even looking up the cached page;
+- a PUT/PATCH/DELETE with an If-Match (or If-Unmodified-Since) that is out of date gets a 412, so two
+  clients can't overwrite each other's changes. The check and the write run in one transaction, the
+  version lookup locking the row, so no other write can slip in between.
+
+A version may change without the response changing (e.g. a stock change moves the ETag of the orders
+holding that product), never the other way around.
+"""
+
+
+class PreconditionFailed(APIException):
+    status_code = 412
+    default_detail = "The resource has been modified since it was fetched."
+    default_code = "precondition_failed"
+
+
+def make_etag(request, marks):
+    # The URL (filters, page, ?format=) and the negotiated renderer are part of the representation
+    accepted = getattr(request, "accepted_renderer", None)
+    key = repr((request.get_full_path(), getattr(accepted, "format", None), marks))
+    return '"%s"' % hashlib.md5(key.encode()).hexdigest()
+
+
+def conditional(version):
+    """
+    `version(view, request, *args, **kwargs)` returns (marks, last_modified) describing the current
+    state of the resource, or None to skip the conditional handling (e.g. the object doesn't exist,
+    so the view answers 404 itself).
+    """
+
+    def decorator(method):
+        def handle(self, request, *args, **kwargs):
+            state = version(self, request, *args, **kwargs)
+            if state is None:
+                return method(self, request, *args, **kwargs)
+
+            marks, last_modified = state
+            etag = make_etag(request, marks)
+            timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is not None:
+                if response.status_code == PreconditionFailed.status_code:
+                    raise PreconditionFailed()
+                return response  # 304
+
+            response = method(self, request, *args, **kwargs)
+            if request.method in ("PUT", "PATCH") and 200 <= response.status_code < 300:
+                # The client can chain its next If-Match on the new version
+                state = version(self, request, *args, **kwargs)
+                etag = make_etag(request, state[0]) if state is not None else None
+                last_modified = state[1] if state is not None else None
+            if request.method in ("GET", "HEAD", "PUT", "PATCH") and 200 <= response.status_code < 300:
+                if etag is not None:
+                    response.headers.setdefault("ETag", etag)
+                if last_modified is not None:
+                    response.headers.setdefault("Last-Modified", http_date(last_modified.timestamp()))
+            return response
+
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            if request.method in SAFE_METHODS:
+                return handle(self, request, *args, **kwargs)
+            with transaction.atomic():
+                return handle(self, request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def for_method(request, queryset):
+    """Lock the looked up row for writes (inside the transaction opened by @conditional)"""
+    return queryset if request.method in SAFE_METHODS else queryset.select_for_update(of=("self",))
+
+
+def product_version(view, request, *args, **kwargs):
+    pk = view.kwargs[view.lookup_url_kwarg or view.lookup_field]
+    if request.method in SAFE_METHODS:
+        # Reads take the version of the payload they are about to serve: no query when it is cached.
+        # The entry is kept on the view for retrieve (see ProductDetailAPIView)
+        try:
+            view.cached_product = get_product(pk)
+        except (TypeError, ValueError):  # Malformed pk: the view answers 404
+            return None
+        if view.cached_product is None:
+            return None
+        updated_at = view.cached_product["updated_at"]
+        return (updated_at,), updated_at
+
+    # Writes check the row itself (locked, so the If-Match can't go stale before the write)
+    try:
+        updated_at = (
+            for_method(request, Product.objects.filter(pk=pk)).values_list("updated_at", flat=True).first()
+        )
+    except (TypeError, ValueError, ValidationError):  # Malformed pk: the view answers 404
+        return None
+    if updated_at is None:
+        return None
+    return (updated_at,), updated_at
+
+
+def product_list_version(view, request, *args, **kwargs):
+    # The generation of the cached pages, moved on by every product write: one cache read whatever the
+    # size of the catalog. Filters and pages are functions of the whole catalog (the URL is in the ETag)
+    return ("product_list", get_generation("product_list")), None
+
+
+def scoped_orders(request):
+    orders = Order.objects.all()
+    if not request.user.is_staff:
+        orders = orders.filter(user=request.user)
+    return orders
+
+
+def order_list_version(view, request, *args, **kwargs):
+    # The generations of the user's cached pages (the staff's for staff), moved on by their order and item
+    # writes, and of the catalog, moved on by the product writes (the items show their name and price)
+    namespaces = order_list_page_namespaces(request.user)
+    return tuple((namespace, get_generation(namespace)) for namespace in namespaces), None
+
+
+def order_version(view, request, pk=None, *args, **kwargs):
+    # The order, its owner's orders (their pks are listed in `user`) and the products of its items, in one query
+    owner_orders = (
+        Order.objects.filter(user=OuterRef("user")).order_by().values("user").annotate(count=Count("pk"))
+    )
+    products = (
+        Product.objects.filter(orderitem__order=OuterRef("pk"))
+        .order_by()
+        .values("orderitem__order")
+        .annotate(count=Count("pk"), updated_at=Max("updated_at"))
+    )
+    try:
+        row = (
+            for_method(request, scoped_orders(request).filter(pk=pk))
+            .annotate(
+                owner_count=Subquery(owner_orders.values("count")),
+                owner_updated_at=Subquery(owner_orders.annotate(updated_at=Max("updated_at")).values("updated_at")),
+                product_count=Subquery(products.values("count")),
+                products_updated_at=Subquery(products.values("updated_at")),
+            )
+            .values_list("updated_at", "owner_count", "owner_updated_at", "product_count", "products_updated_at")
+            .first()
+        )
+    except (TypeError, ValueError, ValidationError):  # Malformed pk: the view answers 404
+        return None
+    if row is None:
+        return None
+    return row, latest(row[0], row[2], row[4])
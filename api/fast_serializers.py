@@ -0,0 +1,201 @@
+"""
+Read-only fast path of the list endpoints
+
+ProductSerializer and OrderSerializer build a model instance per row and run every value through the
+DRF field machinery (to_representation, nested serializers, source lookups). On the list endpoints that
+costs more than the SQL. A ValuesSerializer reads the same columns with .values_list() instead, and turns
+each row into the same dict as the DRF serializer's .data with converters compiled once per class: the
+JSON rendered from it is the same, byte for byte.
+
+Rows are named tuples with the model's pk and the sources' names as attributes, so the paginators
+(page numbers slice the rows, keyset cursors read the ordering fields off them) work on them unchanged.
+Writes, single objects and the browsable forms keep going through the DRF serializers.
+"""
+
+from collections import namedtuple
+
+from django.utils import timezone
+from rest_framework.response import Response
+
+from api.exports import format_datetime
+from api.models import Order, OrderItem, Product
+
+
+# Same output as DRF's fields for these model fields
+def decimal_string(value):
+    # DecimalField(coerce_to_string): the column's scale is the field's decimal_places, nothing to quantize
+    return format(value, "f")
+
+
+def datetime_string(value):
+    # DateTimeField: ISO 8601 in the current time zone, UTC written as Z
+    return format_datetime(timezone.localtime(value))
+
+
+class ValuesSerializer:
+    """
+    `fields` lists (output name, source, converter) in output order: the source is an attribute of the
+    row (a lookup of .values_list()), the converter is skipped for None (DRF's fields return None as
+    is) and None as a converter keeps the database value. A None source leaves the field to be filled
+    in by a subclass.
+    """
+
+    fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.names = [name for name, _, _ in cls.fields]
+        cls.sources = tuple(dict.fromkeys(["pk", *(source for _, source, _ in cls.fields if source is not None)]))
+        cls.row_class = namedtuple(f"{cls.__name__}Row", cls.sources)
+        cls.plain = [(name, source) for name, source, convert in cls.fields if source is not None and convert is None]
+        cls.converted = [(name, source, convert) for name, source, convert in cls.fields if convert is not None]
+
+    def values(self, queryset):
+        return queryset.values_list(*self.sources, named=True)
+
+    def to_representation(self, row):
+        data = dict.fromkeys(self.names)  # Output order
+        for name, source in self.plain:
+            data[name] = getattr(row, source)
+        for name, source, convert in self.converted:
+            value = getattr(row, source)
+            data[name] = None if value is None else convert(value)
+        return data
+
+    def serialize(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+
+class ProductValuesSerializer(ValuesSerializer):
+    """ProductSerializer"""
+
+    fields = (
+        ("id", "id", None),
+        ("product_id", "product_id", str),
+        ("description", "description", None),
+        ("name", "name", None),
+        ("price", "price", decimal_string),
+        ("stock", "stock", None),
+    )
+
+
+class OrderItemValuesSerializer(ValuesSerializer):
+    """OrderItemSerializer, over rows with the product's name and price"""
+
+    fields = (
+        ("order_item_id", "order_item_id", str),
+        ("product_name", "product_name", None),
+        ("product_price", "product_price", decimal_string),
+        ("quantity", "quantity", None),
+        ("item_subtotal", None, None),
+    )
+
+    def to_representation(self, row):
+        data = super().to_representation(row)
+        data["item_subtotal"] = row.product_price * row.quantity  # The model property, a Decimal
+        return data
+
+
+class UserValuesSerializer(ValuesSerializer):
+    """UserSerializer nested in OrderSerializer, over the user__ columns of the order rows"""
+
+    fields = (
+        ("id", "user_id", None),
+        ("username", "user__username", None),
+        ("email", "user__email", None),
+        ("is_staff", "user__is_staff", None),
+        ("is_active", "user__is_active", None),
+        ("is_superuser", "user__is_superuser", None),
+        ("is_authenticated", None, None),
+        ("get_full_name", None, None),
+        ("orders", None, None),
+    )
+
+    def to_representation(self, row, orders=()):
+        data = super().to_representation(row)
+        data["is_authenticated"] = True  # Always True on a User
+        data["get_full_name"] = ("%s %s" % (row.user__first_name, row.user__last_name)).strip()
+        data["orders"] = list(orders)
+        return data
+
+
+class OrderValuesSerializer(ValuesSerializer):
+    """
+    OrderSerializer over the rows of OrderViewSet's annotated queryset. The users' orders, the items and
+    their products are read by the same three queries as the view's prefetches, so they come in the same
+    order.
+    """
+
+    fields = (
+        ("order_id", "order_id", str),
+        ("created_at", "created_at", datetime_string),
+        ("user", None, None),
+        ("status", "status", None),
+        ("items", None, None),
+        ("total_price", "total_price", None),
+        ("item_count", "item_count", None),
+    )
+    user_sources = ("user__username", "user__email", "user__is_staff", "user__is_active", "user__is_superuser",
+                    "user__first_name", "user__last_name", "user_id")
+
+    def __init__(self):
+        self.user_serializer = UserValuesSerializer()
+        self.item_serializer = OrderItemValuesSerializer()
+
+    def values(self, queryset):
+        # The prefetches are replaced by the queries of serialize()
+        return queryset.prefetch_related(None).values_list(*self.sources, *self.user_sources, named=True)
+
+    def serialize(self, rows):
+        rows = list(rows)
+        if not rows:
+            return []
+
+        user_orders = {}
+        users = {row.user_id for row in rows}
+        # In pk order, like the prefetches of OrderViewSet.queryset, so the lists come out the same
+        for user_id, order_id in Order.objects.filter(user__in=users).order_by("pk").values_list("user_id", "pk"):
+            user_orders.setdefault(user_id, []).append(order_id)
+
+        items = list(
+            OrderItem.objects.filter(order__in=[row.pk for row in rows])
+            .order_by("pk")
+            .values_list("pk", "order_id", "order_item_id", "product_id", "quantity")
+        )
+        products = {
+            pk: (name, price)
+            for pk, name, price in Product.objects.filter(pk__in={item[3] for item in items}).values_list(
+                "pk", "name", "price"
+            )
+        }
+        item_row = self.item_serializer.row_class
+        order_items = {}
+        for pk, order_id, order_item_id, product_id, quantity in items:
+            name, price = products[product_id]
+            order_items.setdefault(order_id, []).append(
+                self.item_serializer.to_representation(item_row(pk, order_item_id, name, price, quantity))
+            )
+
+        data = []
+        for row in rows:
+            order = self.to_representation(row)
+            order["user"] = self.user_serializer.to_representation(row, user_orders.get(row.user_id, ()))
+            order["items"] = order_items.get(row.pk, [])
+            order["total_price"] = order["total_price"] or 0  # OrderSerializer.total
+            data.append(order)
+        return data
+
+
+# list() of a generic view through its `values_serializer_class` instead of its serializer_class
+class ValuesListMixin:
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if self.values_serializer_class is None:
+            return super().list(request, *args, **kwargs)
+        serializer = self.values_serializer_class()
+        rows = serializer.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.serialize(page))
+        return Response(serializer.serialize(rows))
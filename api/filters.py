@@ -1,4 +1,12 @@
+import re
+from datetime import datetime, time, timedelta
+
 import django_filters
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connections
+from django.db.models import F, Q
+from django.utils import timezone
+from django_filters.constants import EMPTY_VALUES
 
 from api.models import Order, Product
 from rest_framework import filters
@@ -20,10 +28,74 @@ class InStockFilterBackend(filters.BaseFilterBackend):
         # return queryset.exclude(stock__gt=0) # Filter where stock is 0
 
 
+class ProductSearchFilter(filters.SearchFilter):
+    """
+    Full-text search on the indexed Product.search_vector column (GIN), ranked by relevance,
+    with a trigram match on the name (GIN gin_trgm_ops) as a fallback for typos.
+    Every word is matched as a prefix, so short partial words like "cam" still find "Camera".
+    Uses the same ?search= param as SearchFilter and falls back to it on non-PostgreSQL databases.
+    """
+
+    search_config = "english"
+
+    def filter_queryset(self, request, queryset, view):
+        if connections[queryset.db].vendor != "postgresql":
+            return super().filter_queryset(request, queryset, view)
+
+        term = " ".join(self.get_search_terms(request))
+        words = re.findall(r"\w+", term)
+        if not words:
+            return queryset
+
+        # websearch syntax is too strict for partial words, build a raw prefix query from the words instead
+        query = SearchQuery(
+            " & ".join(f"{word}:*" for word in words),
+            search_type="raw",
+            config=self.search_config,
+        )
+        return (
+            queryset.annotate(
+                rank=SearchRank(F("search_vector"), query),
+                similarity=TrigramWordSimilarity(term, "name"),
+            )
+            # `<%` (pg_trgm.word_similarity_threshold) is answered from the trigram index, unlike a similarity comparison
+            .filter(Q(search_vector=query) | Q(name__trigram_word_similar=term))
+            .order_by("-rank", "-similarity", "pk")
+        )
+
+
+# Comma separated "min,max", the same as the range lookup generated for ProductFilter.price
+class NumberRangeFilter(django_filters.BaseRangeFilter, django_filters.NumberFilter):
+    pass
+
+
+class DayFilter(django_filters.DateFilter):
+    """
+    The datetimes of a YYYY-MM-DD day in the current time zone, the same rows as a __date lookup.
+    __date casts every row's column to a date, which no index on the column can answer: the day's
+    half-open range [midnight, next midnight) can.
+    """
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        if self.distinct:
+            qs = qs.distinct()
+        start = timezone.make_aware(datetime.combine(value, time.min))
+        end = timezone.make_aware(datetime.combine(value + timedelta(days=1), time.min))
+        return self.get_method(qs)(**{f"{self.field_name}__gte": start, f"{self.field_name}__lt": end})
+
+
 class OrderFilter(django_filters.FilterSet):
-    created_at = django_filters.DateFilter(
-        field_name="created_at__date"
-    )  # Extract the YYYY-MM-DD part of the created_at passed to the filter and use it to filter the orders
+    created_at = DayFilter()  # ?created_at=YYYY-MM-DD, the orders created that day
+
+    # total_price is the annotation added by OrderViewSet, so these become HAVING clauses in SQL
+    total_price = django_filters.NumberFilter()
+    total_price__lt = django_filters.NumberFilter(field_name="total_price", lookup_expr="lt")
+    total_price__gt = django_filters.NumberFilter(field_name="total_price", lookup_expr="gt")
+    total_price__lte = django_filters.NumberFilter(field_name="total_price", lookup_expr="lte")
+    total_price__gte = django_filters.NumberFilter(field_name="total_price", lookup_expr="gte")
+    total_price__range = NumberRangeFilter(field_name="total_price", lookup_expr="range")  # ?total_price__range=100,500
 
     class Meta:
         model = Order
@@ -0,0 +1,44 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+"""
+Per-request query recording that works for sync and async views
+
+Django keeps one database connection per thread, and async views run their queries on a different
+thread than the middleware (sync_to_async). So instead of a per-request connection.execute_wrapper,
+one execute wrapper is installed on every connection (connection_created, see ApiConfig.ready) and hands
+each query to the recorders of the current request, found in a context variable: the context is copied
+into sync_to_async threads, and concurrent async requests each see their own.
+"""
+
+_recorders = ContextVar("query_recorders", default=())
+
+
+def dispatch_query(execute, sql, params, many, context):
+    recorders = _recorders.get()
+    if not recorders:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        for recorder in recorders:
+            recorder(sql, duration)
+
+
+def install_query_dispatch(sender=None, connection=None, **kwargs):
+    """connection_created receiver (the wrappers list belongs to the connection object, which is reused on reconnect)"""
+    if dispatch_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(dispatch_query)
+
+
+@contextmanager
+def record_queries(recorder):
+    """Call recorder(sql, duration) for every query run in this context, in this thread or sync_to_async ones"""
+    token = _recorders.set(_recorders.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _recorders.reset(token)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api.models import PRODUCT_SEARCH_VECTOR, Product
+
+
+class Command(BaseCommand):
+    help = "Fills Product.search_vector for existing rows in primary key batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute every row, not only the ones without a search vector",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_pk = Product.objects.aggregate(last_pk=Max("pk"))["last_pk"] or 0
+        updated = 0
+
+        # Walk the table in pk ranges so each UPDATE is a short transaction on an index range scan
+        for start in range(0, last_pk + 1, batch_size):
+            products = Product.objects.filter(pk__gte=start, pk__lt=start + batch_size)
+            if not options["all"]:
+                products = products.filter(search_vector__isnull=True)
+            # queryset.update() sends no post_save signal, so the product caches are not touched per batch
+            updated += products.update(search_vector=PRODUCT_SEARCH_VECTOR)
+            self.stdout.write(f"Up to pk {min(start + batch_size, last_pk + 1) - 1}: {updated} products updated")
+
+        self.stdout.write(self.style.SUCCESS(f"Search vectors backfilled for {updated} products"))
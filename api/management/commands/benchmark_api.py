@@ -0,0 +1,260 @@
+import json
+import platform
+import statistics
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
+
+import django
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework.views import APIView
+from silk.config import SilkyConfig
+
+from api.models import DailySales, Order, Product, User
+
+"""
+Endpoint benchmarks
+
+Every route of api/urls.py is requested in-process through the full middleware stack, against a
+throwaway test database seeded with populate_db. Writes run inside a transaction that is rolled back,
+so the dataset (and the numbers) stay the same from one request to the next. Throttling is turned off
+and silk doesn't record anything unless --with-silk is passed.
+"""
+
+PAGE_CACHE_HEADER = "views.decorators.cache.cache_header."
+PAGE_CACHE_PAGE = "views.decorators.cache.cache_page."
+
+
+def percentile(samples, percent):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+def app_query_count(queries):
+    return sum(1 for query in queries if "silk_" not in query["sql"])
+
+
+class Command(BaseCommand):
+    help = "Benchmarks every API endpoint in-process: latency percentiles, throughput, SQL queries and cache hits"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--products", type=int, default=5000)
+        parser.add_argument("--orders", type=int, default=10000)
+        parser.add_argument("--seed", default="benchmark")
+        parser.add_argument("--requests", type=int, default=100, help="Measured requests per endpoint")
+        parser.add_argument("--warmup", type=int, default=5, help="Unmeasured requests per endpoint")
+        parser.add_argument("--endpoint", action="append", help="Only run these endpoints (repeatable)")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2, help="Fail when a p95 is this much slower than the baseline"
+        )
+        parser.add_argument(
+            "--min-delta-ms", type=float, default=2.0, help="Ignore p95 regressions smaller than this (noise)"
+        )
+        parser.add_argument("--keepdb", action="store_true", help="Keep (and reuse) the seeded benchmark database")
+        parser.add_argument("--with-silk", action="store_true", help="Leave silk recording the requests")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"], encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file)
+
+        runner = DiscoverRunner(verbosity=0, interactive=False, keepdb=options["keepdb"])
+        old_config = runner.setup_databases()
+        cache = caches["default"]
+        key_prefix = cache.key_prefix
+        cache.key_prefix = f"{key_prefix}benchmark"  # Keep the benchmark's cached pages apart from the real ones
+        try:
+            if not Product.objects.exists():
+                call_command(
+                    "populate_db",
+                    users=options["users"],
+                    products=options["products"],
+                    orders=options["orders"],
+                    seed=options["seed"],
+                    stdout=self.stdout,
+                )
+            silk = {} if options["with_silk"] else {"SILKY_INTERCEPT_FUNC": lambda request: False}
+            with mock.patch.dict(SilkyConfig().attrs, silk):
+                results = self.run_endpoints(options)
+        finally:
+            cache.key_prefix = key_prefix
+            runner.teardown_databases(old_config)
+
+        report = {
+            "meta": {
+                "users": options["users"],
+                "products": options["products"],
+                "orders": options["orders"],
+                "seed": options["seed"],
+                "requests": options["requests"],
+                "python": platform.python_version(),
+                "django": django.get_version(),
+            },
+            "endpoints": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as output:
+                json.dump(report, output, indent=2)
+
+        if baseline is not None:
+            regressions = self.compare(baseline["endpoints"], results, options["threshold"], options["min_delta_ms"])
+            if regressions:
+                raise CommandError("Regressions against the baseline:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regression against the baseline"))
+
+    def endpoints(self):
+        """(name, user, method, path, payload) of the requests to benchmark"""
+        admin = User.objects.filter(is_staff=True).order_by("pk").first()
+        # The customer with the most orders, so their order list isn't trivially small
+        customer = (
+            User.objects.filter(is_staff=False).annotate(order_count=Count("orders")).order_by("-order_count").first()
+            or admin
+        )
+        product = Product.objects.order_by("pk").first()
+        order = Order.objects.filter(user=customer).order_by("pk").first()
+        # Enough stock for every order written by the create, bulk and update requests
+        Product.objects.filter(pk=product.pk).update(stock=1_000_000)
+        items = [{"product": product.pk, "quantity": 1}]
+        batch = ",".join(str(pk) for pk in Product.objects.order_by("pk").values_list("pk", flat=True)[:20])
+        # The last days with sales: populate_db dates its orders up to a fixed day, not up to today
+        end = DailySales.objects.order_by("-day").values_list("day", flat=True).first() or timezone.localdate()
+        week, month = f"start={end - timedelta(days=6)}&end={end}", f"start={end - timedelta(days=29)}&end={end}"
+        return [
+            ("products.list", None, "get", "/products/", None),
+            ("products.page", None, "get", "/products/?pagenum=3&size=4", None),
+            ("products.cursor", None, "get", "/products/?pagination=cursor&ordering=-price", None),
+            ("products.search", None, "get", "/products/?search=camera", None),
+            ("products.ordering", None, "get", "/products/?ordering=-stock", None),
+            ("products.filter", None, "get", "/products/?price__range=10,50", None),
+            ("products.create", admin, "post", "/products/", {
+                "name": "Benchmark product", "description": "Created by benchmark_api", "price": "9.99", "stock": 10,
+            }),
+            ("products.info", None, "get", "/products/info/", None),
+            ("products.export", None, "get", "/products/export/?price__range=10,20", None),
+            ("products.detail", None, "get", f"/products/{product.pk}/", None),
+            ("products.batch", None, "get", f"/products/batch/?ids={batch}", None),
+            ("products.update", admin, "patch", f"/products/{product.pk}/", {"stock": 999_999}),
+            ("sales.top", admin, "get", f"/products/top-sellers/?{week}", None),
+            ("sales.top.revenue", admin, "get", f"/products/top-sellers/?{month}&by=revenue", None),
+            ("sales.series", admin, "get", f"/products/sales/?{month}", None),
+            ("orders.list.staff", admin, "get", "/orders/", None),
+            ("orders.list.user", customer, "get", "/orders/", None),
+            ("orders.cursor", admin, "get", "/orders/?pagination=cursor&ordering=-created_at", None),
+            ("orders.detail", customer, "get", f"/orders/{order.pk}/", None),
+            ("orders.create", customer, "post", "/orders/", {"items": items}),
+            ("orders.bulk", customer, "post", "/orders/bulk/", [{"items": items}] * 20),
+            ("orders.update", customer, "put", f"/orders/{order.pk}/", {"items": items}),
+            ("orders.export", customer, "get", "/orders/export/", None),
+            ("users.list", admin, "get", "/users/", None),
+            ("users.compact", admin, "get", "/users/?compact=true", None),
+            ("async.products", None, "get", "/async/products/", None),
+            ("async.info", None, "get", "/async/products/info/", None),
+            ("async.detail", None, "get", f"/async/products/{product.pk}/", None),
+            ("async.orders", customer, "get", "/async/orders/", None),
+            ("async.order", customer, "get", f"/async/orders/{order.pk}/", None),
+        ]
+
+    def run_endpoints(self, options):
+        cache_class = type(caches["default"])
+        original_get = cache_class.get
+        lookups = Counter()
+
+        # Count the page cache lookups: a header key lookup per cached view, a page key hit when it is served
+        def counting_get(cache, key, *args, **kwargs):
+            value = original_get(cache, key, *args, **kwargs)
+            if key.startswith(PAGE_CACHE_HEADER):
+                lookups["lookups"] += 1
+            elif key.startswith(PAGE_CACHE_PAGE) and value is not None:
+                lookups["hits"] += 1
+            return value
+
+        results = {}
+        # The throttles would turn most of the requests into 429s
+        with mock.patch.object(cache_class, "get", counting_get), mock.patch.object(
+            APIView, "get_throttles", lambda view: []
+        ):
+            for name, user, method, path, payload in self.endpoints():
+                if options["endpoint"] and name not in options["endpoint"]:
+                    continue
+                client = APIClient()
+                if user is not None and path.startswith("/async/"):
+                    client.force_login(user)  # The async views authenticate outside DRF: session or JWT only
+                elif user is not None:
+                    client.force_authenticate(user)
+                for _ in range(options["warmup"]):
+                    self.request(client, method, path, payload)
+
+                lookups.clear()
+                timings, queries, statuses = [], [], Counter()
+                started = time.perf_counter()
+                for _ in range(options["requests"]):
+                    with CaptureQueriesContext(connection) as captured:
+                        request_started = time.perf_counter()
+                        status_code = self.request(client, method, path, payload)
+                        timings.append((time.perf_counter() - request_started) * 1000)
+                    queries.append(app_query_count(captured.captured_queries))
+                    statuses[status_code] += 1
+                elapsed = time.perf_counter() - started
+
+                results[name] = {
+                    "method": method.upper(),
+                    "path": path,
+                    "requests": len(timings),
+                    "statuses": {str(code): count for code, count in sorted(statuses.items())},
+                    "p50_ms": round(percentile(timings, 50), 3),
+                    "p95_ms": round(percentile(timings, 95), 3),
+                    "p99_ms": round(percentile(timings, 99), 3),
+                    "mean_ms": round(statistics.fmean(timings), 3),
+                    "throughput_rps": round(len(timings) / elapsed, 1),
+                    "queries_mean": round(statistics.fmean(queries), 2),
+                    "queries_max": max(queries),
+                    "cache_hit_rate": round(lookups["hits"] / lookups["lookups"], 3) if lookups["lookups"] else None,
+                }
+                self.write_result(name, results[name])
+        return results
+
+    def request(self, client, method, path, payload):
+        # Writes are rolled back so every request sees the same data
+        with transaction.atomic():
+            response = getattr(client, method)(path, payload, format="json")
+            if response.streaming:
+                b"".join(response.streaming_content)
+            if method != "get":
+                transaction.set_rollback(True)
+        return response.status_code
+
+    def write_result(self, name, result):
+        hit_rate = "-" if result["cache_hit_rate"] is None else f"{result['cache_hit_rate']:.0%}"
+        self.stdout.write(
+            f"{name:<20} p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+            f"{result['throughput_rps']:8.1f} req/s  {result['queries_mean']:6.2f} queries  cache hits {hit_rate:>4}  "
+            f"{result['statuses']}"
+        )
+
+    def compare(self, baseline, results, threshold, min_delta_ms):
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]
+            slower = result["p95_ms"] - before["p95_ms"]
+            if result["p95_ms"] > before["p95_ms"] * (1 + threshold) and slower > min_delta_ms:
+                regressions.append(f"{name}: p95 {before['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+            # Query counts are deterministic, any increase is a regression (usually a new N+1)
+            if result["queries_max"] > before["queries_max"]:
+                regressions.append(f"{name}: queries {before['queries_max']} -> {result['queries_max']}")
+        return regressions
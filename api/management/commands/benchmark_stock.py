@@ -0,0 +1,89 @@
+import itertools
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from api.models import Product
+from api.stock import InsufficientStock, apply_stock_changes
+
+
+class Command(BaseCommand):
+    help = "Benchmarks stock reservation with many workers ordering the same hot product"
+
+    strategies = ("conditional", "select_for_update", "read_modify_write")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=32)
+        parser.add_argument("--attempts", type=int, default=5000, help="Order attempts per strategy")
+        parser.add_argument("--stock", type=int, default=4000, help="Initial stock of the hot product")
+        parser.add_argument("--strategy", choices=self.strategies, action="append")
+
+    def handle(self, *args, **options):
+        for strategy in options["strategy"] or self.strategies:
+            self.run(strategy, options["workers"], options["attempts"], options["stock"])
+
+    # Conditional UPDATE used by the order serializers (api/stock.py)
+    def reserve_conditional(self, product_id):
+        with transaction.atomic():
+            apply_stock_changes({}, {product_id: 1})
+
+    # Row lock, then read-modify-write: correct but every worker queues on the lock for a round trip longer
+    def reserve_select_for_update(self, product_id):
+        with transaction.atomic():
+            product = Product.objects.select_for_update().only("stock").get(pk=product_id)
+            if product.stock < 1:
+                raise InsufficientStock([product_id])
+            Product.objects.filter(pk=product_id).update(stock=product.stock - 1)
+
+    # The old side-job approach: read, check and write without a lock (loses updates under contention)
+    def reserve_read_modify_write(self, product_id):
+        stock = Product.objects.values_list("stock", flat=True).get(pk=product_id)
+        if stock < 1:
+            raise InsufficientStock([product_id])
+        Product.objects.filter(pk=product_id).update(stock=stock - 1)
+
+    def run(self, strategy, workers, attempts, stock):
+        product = Product.objects.create(
+            name="Benchmark hot product", description="", price=Decimal("1.00"), stock=stock
+        )
+        reserve = getattr(self, f"reserve_{strategy}")
+        tickets = itertools.count()  # next() on a count is atomic under the GIL
+        results = {"reserved": 0, "rejected": 0}
+        lock = threading.Lock()
+
+        def worker():
+            reserved = rejected = 0
+            try:
+                while next(tickets) < attempts:
+                    try:
+                        reserve(product.pk)
+                        reserved += 1
+                    except InsufficientStock:
+                        rejected += 1
+            finally:
+                connections.close_all()  # Each thread has its own connection
+            with lock:
+                results["reserved"] += reserved
+                results["rejected"] += rejected
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        final_stock = Product.objects.values_list("stock", flat=True).get(pk=product.pk)
+        # Stock that was handed out twice: orders accepted beyond what the stock counter went down by
+        oversold = results["reserved"] - (stock - final_stock)
+        Product.objects.filter(pk=product.pk).delete()
+
+        self.stdout.write(
+            f"{strategy:>18}: {attempts / elapsed:8.0f} attempts/s, "
+            f"{results['reserved']} reserved, {results['rejected']} rejected, "
+            f"final stock {final_stock}, oversold {oversold}"
+        )
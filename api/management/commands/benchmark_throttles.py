@@ -0,0 +1,68 @@
+import itertools
+import statistics
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from rest_framework.request import Request
+from rest_framework.throttling import AnonRateThrottle
+
+from api.throttles import SlidingWindowAnonRateThrottle, TokenBucketAnonRateThrottle
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the throttles with many workers hitting the same client's limit at once"
+
+    throttles = {
+        "drf": AnonRateThrottle,  # DRF's timestamp list: cache get, then cache set
+        "sliding_window": SlidingWindowAnonRateThrottle,
+        "token_bucket": TokenBucketAnonRateThrottle,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=32)
+        parser.add_argument("--attempts", type=int, default=5000, help="Checks per throttle")
+        parser.add_argument("--limit", type=int, default=1000, help="Requests allowed per hour")
+        parser.add_argument("--throttle", choices=self.throttles, action="append")
+
+    def handle(self, *args, **options):
+        for name in options["throttle"] or self.throttles:
+            self.run(name, options["workers"], options["attempts"], options["limit"])
+
+    def run(self, name, workers, attempts, limit):
+        throttle_class = type("BenchmarkThrottle", (self.throttles[name],), {"rate": f"{limit}/hour"})
+        # A client address of its own, so every run starts from an empty limit
+        request = Request(RequestFactory().get("/products/", HTTP_X_FORWARDED_FOR=str(uuid.uuid4())))
+        tickets = itertools.count()  # next() on a count is atomic under the GIL
+        allowed = []
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            worker_allowed = 0
+            worker_latencies = []
+            while next(tickets) < attempts:
+                started = time.perf_counter()
+                if throttle_class().allow_request(request, None):
+                    worker_allowed += 1
+                worker_latencies.append(time.perf_counter() - started)
+            with lock:
+                allowed.append(worker_allowed)
+                latencies.extend(worker_latencies)
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        self.stdout.write(
+            f"{name:>14}: {attempts / elapsed:8.0f} checks/s, "
+            f"p50 {percentiles[49] * 1000:.2f}ms, p95 {percentiles[94] * 1000:.2f}ms, "
+            f"{sum(allowed)} allowed for a limit of {limit}, overrun {max(0, sum(allowed) - limit)}"
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.replicas import ReplicaHealth, replica_settings
+
+
+class Command(BaseCommand):
+    help = "Checks that every read replica is reachable and within the lag the router accepts"
+
+    def handle(self, *args, **options):
+        options = replica_settings()
+        if not options["ALIASES"]:
+            self.stdout.write("No replica configured (DATABASE_URL_REPLICA_<name>), every read goes to the primary")
+            return
+
+        health = ReplicaHealth()
+        failing = []
+        for alias in options["ALIASES"]:
+            lag = health.measure(alias)
+            if lag is None:
+                failing.append(alias)
+                self.stdout.write(self.style.ERROR(f"{alias}: unreachable"))
+            elif lag > options["MAX_LAG_SECONDS"]:
+                failing.append(alias)
+                self.stdout.write(self.style.WARNING(f"{alias}: {lag:.1f}s behind (max {options['MAX_LAG_SECONDS']}s)"))
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{alias}: {lag:.1f}s behind"))
+
+        if failing:
+            raise CommandError(f"{len(failing)} of {len(options['ALIASES'])} replicas can't serve reads: {', '.join(failing)}")
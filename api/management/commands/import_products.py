@@ -0,0 +1,178 @@
+import collections
+import csv
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from rest_framework import serializers
+
+from api.cache import bump_generation
+from api.models import Product
+from api.object_cache import evict_products_on_commit
+from api.sales import reprice_sales
+from api.serializers import ProductSerializer
+
+IMPORT_FIELDS = ("product_id", "name", "description", "price", "stock")
+
+
+def validate_batch(records):
+    """
+    Validate (line, record) pairs with the field rules of ProductSerializer plus its validate_price,
+    without building a serializer per row. Returns the clean products and the (line, error) pairs.
+    NDJSON records are the raw lines, parsed here so that a malformed line is one more invalid row.
+    Module level so it can run in worker processes.
+    """
+    serializer = ProductSerializer()
+    fields = serializer.fields
+    products, errors = [], []
+    for line, record in records:
+        try:
+            if isinstance(record, str):
+                record = json.loads(record)  # JSONDecodeError is a ValueError
+            product_id = record.get("product_id")
+            products.append(
+                {
+                    "product_id": uuid.UUID(str(product_id)) if product_id else uuid.uuid4(),
+                    "name": fields["name"].run_validation(record.get("name")),
+                    "description": fields["description"].run_validation(record.get("description")),
+                    "price": serializer.validate_price(fields["price"].run_validation(record.get("price"))),
+                    "stock": fields["stock"].run_validation(record.get("stock")),
+                }
+            )
+        except serializers.ValidationError as exc:
+            errors.append((line, exc.detail))
+        except (ValueError, TypeError, AttributeError) as exc:
+            errors.append((line, str(exc)))
+    return products, errors
+
+
+class Command(BaseCommand):
+    help = (
+        "Upserts products (matched on product_id) from a CSV or NDJSON feed in large batches, "
+        "re-pricing the sales rollups of the updated products"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV/NDJSON file, or - for stdin")
+        parser.add_argument("--format", choices=("csv", "ndjson"), help="Defaults to the file extension")
+        parser.add_argument("--batch-size", type=int, default=10000)
+        parser.add_argument(
+            "--method",
+            choices=("bulk", "copy"),
+            default="bulk",
+            help="bulk: INSERT ... ON CONFLICT through bulk_create, copy: COPY into a staging table then upsert",
+        )
+        parser.add_argument("--workers", type=int, default=1, help="Processes validating batches in parallel")
+        parser.add_argument("--max-errors", type=int, default=100, help="Abort after this many invalid rows")
+
+    def handle(self, *args, **options):
+        source_format = options["format"] or ("csv" if options["path"].endswith(".csv") else "ndjson")
+        source = sys.stdin if options["path"] == "-" else open(options["path"], newline="", encoding="utf-8")
+        upsert = self.upsert_copy if options["method"] == "copy" else self.upsert_bulk
+        batches = self.batches(self.read(source, source_format), options["batch_size"])
+
+        pool = None
+        if options["workers"] > 1:
+            connections.close_all()  # Don't share the open connection with the forked workers
+            pool = multiprocessing.Pool(options["workers"])
+            validated = self.validate_in(pool, batches, window=options["workers"] * 2)
+        else:
+            validated = map(validate_batch, batches)
+
+        started = time.perf_counter()
+        imported = errors = 0
+        try:
+            for products, batch_errors in validated:
+                for line, detail in batch_errors:
+                    self.stderr.write(f"Line {line}: {detail}")
+                errors += len(batch_errors)
+                if errors >= options["max_errors"]:
+                    raise CommandError(f"Aborting after {errors} invalid rows")
+
+                # The last row wins when a feed repeats a product (a row can't be upserted twice in one statement)
+                batch = {product["product_id"]: product for product in products}
+                if batch:
+                    with transaction.atomic():
+                        upsert(list(batch.values()))
+                        evict_products_on_commit(list(batch))  # Bulk writes skip the post_save write-through
+                        reprice_sales(list(batch))  # ... and the post_save re-pricing of the rollups
+                    imported += len(batch)
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f"{imported} products imported ({imported / max(elapsed, 1e-9):.0f} rows/s)")
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if source is not sys.stdin:
+                source.close()
+            # One cache invalidation for the whole import (bulk writes send no post_save signal)
+            if imported:
+                bump_generation("product_list")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {imported} products in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.0f} rows/s), "
+                f"{errors} invalid rows skipped"
+            )
+        )
+
+    # (line, record) pairs numbered by the line of the feed the record ends on
+    def read(self, source, source_format):
+        if source_format == "csv":
+            reader = csv.DictReader(source)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line, text in enumerate(source, 1):
+            if text.strip():
+                yield line, text
+
+    # (line, record) pairs in lists of batch_size, read lazily from the feed
+    def batches(self, records, batch_size):
+        while batch := list(itertools.islice(records, batch_size)):
+            yield batch
+
+    # Like pool.imap (results in feed order) but with at most `window` batches in flight,
+    # pool.imap would read the whole feed into memory ahead of the workers
+    def validate_in(self, pool, batches, window):
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(validate_batch, (batch,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def upsert_bulk(self, products):
+        Product.objects.bulk_create(
+            [Product(**product) for product in products],
+            update_conflicts=True,
+            unique_fields=["product_id"],
+            update_fields=["name", "description", "price", "stock"],
+        )
+
+    def upsert_copy(self, products):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS import_products_staging ("
+                "product_id uuid, name varchar(200), description text, price numeric(10, 2), stock integer"
+                ") ON COMMIT DELETE ROWS"
+            )
+            # COPY streams the whole batch in one round trip, without building an INSERT statement
+            with cursor.cursor.copy(
+                f"COPY import_products_staging ({', '.join(IMPORT_FIELDS)}) FROM STDIN"
+            ) as copy:
+                for product in products:
+                    copy.write_row([product[field] for field in IMPORT_FIELDS])
+            # updated_at of the updated rows is moved by the trigger of migration 0003
+            cursor.execute(
+                f"INSERT INTO api_product ({', '.join(IMPORT_FIELDS)}, updated_at) "
+                f"SELECT {', '.join(IMPORT_FIELDS)}, clock_timestamp() FROM import_products_staging "
+                "ON CONFLICT (product_id) DO UPDATE SET name = EXCLUDED.name, description = EXCLUDED.description, "
+                "price = EXCLUDED.price, stock = EXCLUDED.stock"
+            )
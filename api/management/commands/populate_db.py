@@ -1,16 +1,169 @@
+import bisect
+import itertools
+import multiprocessing
 import random
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime, time as day_time, timedelta
 from decimal import Decimal
 
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
-from django.utils import lorem_ipsum
+from django.db import connection, connections, transaction
+from django.utils import lorem_ipsum, timezone
 
+from api.cache import bump_generation, order_list_namespace
 from api.models import Order, OrderItem, Product, User
+from api.object_cache import refresh_products_on_commit
+from api.sales import rebuild_sales
+from api.stock import held_quantities
+
+WORDS = lorem_ipsum.WORDS
+PRODUCT_NOUNS = (
+    "Camera", "Watch", "Scanner", "Coffee Machine", "Headphones", "Lamp", "Backpack", "Keyboard",
+    "Record", "Speaker", "Kettle", "Monitor", "Chair", "Blender", "Jacket", "Bicycle",
+)
+
+# Order status mix of a shop that mostly confirms its orders
+STATUS_WEIGHTS = (
+    (Order.StatusChoices.CONFIRMED, 0.8),
+    (Order.StatusChoices.PENDING, 0.12),
+    (Order.StatusChoices.CANCELLED, 0.08),
+)
+
+# The default end of the created_at span: a fixed day, so the same seed gives the same data whenever it runs
+EPOCH = date(2025, 1, 1)
+
+# Filled in by the parent before the worker processes are forked, so they are shared instead of pickled per task
+SHARED = {}
+
+
+# Every chunk has its own random stream derived from the seed, so the data does not depend on
+# how the chunks are spread over worker processes
+def chunk_random(seed, kind, chunk):
+    return random.Random(f"{seed}:{kind}:{chunk}")
+
+
+def sentence(rng, low, high):
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high))).capitalize() + "."
+
+
+# Seeded stand-in for lorem_ipsum.paragraph(), which draws from the global random
+def paragraph(rng):
+    return " ".join(sentence(rng, 8, 20) for _ in range(rng.randint(2, 5)))
+
+
+# auto_now_add overwrites created_at in bulk_create, so the generated values are written afterwards
+SET_CREATED_AT = """
+UPDATE {order} o SET created_at = c.created_at
+FROM unnest(%s::uuid[], %s::timestamptz[]) AS c(order_id, created_at)
+WHERE o.order_id = c.order_id
+"""
+
+# The held quantities come off the generated stock, which is raised to what the orders hold where they hold more
+HOLD_STOCK = """
+UPDATE {product} p SET stock = GREATEST(p.stock - h.quantity, 0)
+FROM unnest(%s::bigint[], %s::integer[]) AS h(id, quantity)
+WHERE p.id = h.id
+"""
+
+
+def generate_products(seed, chunk, count):
+    rng = chunk_random(seed, "products", chunk)
+    products = []
+    for _ in range(count):
+        products.append(
+            Product(
+                product_id=uuid.UUID(int=rng.getrandbits(128), version=4),
+                name=f"{rng.choice(WORDS).title()} {rng.choice(PRODUCT_NOUNS)}",
+                description=sentence(rng, 8, 30),
+                # Log-normal prices: lots of cheap products, a long tail of expensive ones
+                price=Decimal(str(round(min(max(rng.lognormvariate(3.5, 1.0), 0.99), 99999), 2))),
+                stock=rng.randint(0, 200),
+            )
+        )
+    Product.objects.bulk_create(products, ignore_conflicts=True)  # Re-running with the same seed adds nothing
+    return count
+
+
+def generate_orders(task):
+    seed, chunk, count = task
+    rng = chunk_random(seed, "orders", chunk)
+    user_ids = SHARED["user_ids"]
+    product_ids = SHARED["product_ids"]
+    product_weights = SHARED["product_weights"]  # Cumulative, skewed towards the first (popular) products
+    now = SHARED["now"]
+    span = SHARED["span"].total_seconds()
+    items_per_order = SHARED["items_per_order"]
+    statuses, status_weights = zip(*STATUS_WEIGHTS)
+
+    orders, items = [], []
+    for _ in range(count):
+        order = Order(
+            order_id=uuid.UUID(int=rng.getrandbits(128), version=4),
+            # Users are skewed too: a few regulars place most of the orders
+            user_id=user_ids[min(int(rng.paretovariate(1.2)) - 1, len(user_ids) - 1)]
+            if rng.random() < 0.5
+            else rng.choice(user_ids),
+            created_at=now - timedelta(seconds=rng.random() * span),
+            status=rng.choices(statuses, status_weights)[0],
+        )
+        orders.append(order)
+        # Between 1 and 2 * items_per_order - 1 distinct products, items_per_order on average
+        lines = rng.randint(1, max(1, 2 * items_per_order - 1))
+        chosen = dict.fromkeys(
+            product_ids[bisect.bisect(product_weights, rng.random() * product_weights[-1])]
+            for _ in range(lines)
+        )
+        for product_id in chosen:
+            items.append(
+                OrderItem(
+                    order_item_id=uuid.UUID(int=rng.getrandbits(128), version=4),
+                    order=order,
+                    product_id=product_id,
+                    quantity=rng.choices((1, 2, 3, 4, 5), (60, 20, 10, 6, 4))[0],
+                )
+            )
+
+    # Re-running with the same seed adds nothing, and holds no stock twice
+    existing = set(
+        Order.objects.filter(order_id__in=[order.order_id for order in orders]).values_list("order_id", flat=True)
+    )
+    orders = [order for order in orders if order.order_id not in existing]
+    items = [item for item in items if item.order_id not in existing]
+    held = Counter()
+    for item in items:
+        held.update(held_quantities(item.order.status, [(item.product_id, item.quantity)]))
+    created_at = [[order.order_id for order in orders], [order.created_at for order in orders]]
+    with transaction.atomic():
+        Order.objects.bulk_create(orders, ignore_conflicts=True)
+        OrderItem.objects.bulk_create(items, ignore_conflicts=True)
+        with connection.cursor() as cursor:
+            cursor.execute(SET_CREATED_AT.format(order=Order._meta.db_table), created_at)
+    return len(orders), len(items), held
 
 
 class Command(BaseCommand):
-    help = "Creates application data"
+    help = "Creates application data (deterministic synthetic data at any scale with the sizing options)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=0, help="Users to create besides admin")
+        parser.add_argument("--products", type=int, default=6, help="Products to create (the first 6 are the classic ones)")
+        parser.add_argument("--orders", type=int, default=3)
+        parser.add_argument("--items-per-order", type=int, default=2, help="Average number of lines per order")
+        parser.add_argument("--years", type=float, default=3, help="created_at is spread over this many years")
+        parser.add_argument(
+            "--end", type=date.fromisoformat, default=EPOCH, help="YYYY-MM-DD, the day the created_at span ends on"
+        )
+        parser.add_argument("--seed", default="0", help="Same seed, same data")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--workers", type=int, default=1, help="Processes generating the orders")
+
+    def handle(self, *args, **options):
+        seed = options["seed"]
+        batch_size = options["batch_size"]
 
-    def handle(self, *args, **kwargs):
         # get or create superuser
         user = User.objects.filter(username="admin").first()
         if not user:
@@ -20,56 +173,124 @@ class Command(BaseCommand):
                 email="admin@example.com",  # <-- required
                 password="test",
             )
+        existing_user_ids = list(User.objects.values_list("pk", flat=True))
+
+        self.create_users(seed, options["users"], batch_size)
+        self.create_products(seed, options["products"], batch_size)
+
+        user_ids = list(User.objects.order_by("pk").values_list("pk", flat=True))
+        product_ids = list(Product.objects.order_by("pk").values_list("pk", flat=True))
+        if options["orders"] and product_ids:
+            self.create_orders(seed, options, user_ids, product_ids)
+            # Bulk inserts don't go through the incremental sales rollups
+            started = time.perf_counter()
+            self.report("Product sales days", rebuild_sales()[0], started)
+
+        # Bulk inserts send no signals: invalidate the cached lists once (new users have nothing cached yet)
+        bump_generation("product_list")
+        bump_generation("order_list.staff")
+        for user_id in existing_user_ids:
+            bump_generation(order_list_namespace(user_id=user_id))
+
+    def report(self, label, count, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"{label}: {count} in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s)")
+
+    def create_users(self, seed, count, batch_size):
+        started = time.perf_counter()
+        password = make_password("test")  # Hash once, hashing per user would dominate the run
+        prefix = f"user-{seed}-"
+        for start in range(0, count, batch_size):
+            User.objects.bulk_create(
+                [
+                    User(username=f"{prefix}{n}", email=f"{prefix}{n}@example.com", password=password)
+                    for n in range(start, min(start + batch_size, count))
+                ],
+                ignore_conflicts=True,  # Re-running with the same seed keeps the existing users
+            )
+        self.report("Users", count, started)
 
+    def create_products(self, seed, count, batch_size):
+        started = time.perf_counter()
+        rng = chunk_random(seed, "classic", 0)
         # create products - name, desc, price, stock, image
         products = [
             Product(
                 name="A Scanner Darkly",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("12.99"),
                 stock=4,
             ),
             Product(
                 name="Coffee Machine",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("70.99"),
                 stock=6,
             ),
             Product(
                 name="Velvet Underground & Nico",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("15.99"),
                 stock=11,
             ),
             Product(
                 name="Enter the Wu-Tang (36 Chambers)",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("17.99"),
                 stock=2,
             ),
             Product(
                 name="Digital Camera",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("350.99"),
                 stock=4,
             ),
             Product(
                 name="Watch",
-                description=lorem_ipsum.paragraph(),
+                description=paragraph(rng),
                 price=Decimal("500.05"),
                 stock=0,
             ),
+        ][:count]
+        for product in products:
+            product.product_id = uuid.uuid5(uuid.NAMESPACE_URL, f"populate_db:{product.name}")
+        Product.objects.bulk_create(products, ignore_conflicts=True)  # Re-running adds them once
+
+        remaining = count - len(products)
+        for chunk, start in enumerate(range(0, remaining, batch_size)):
+            generate_products(seed, chunk, min(batch_size, remaining - start))
+        self.report("Products", count, started)
+
+    def create_orders(self, seed, options, user_ids, product_ids):
+        # Zipf-like popularity: the product of rank r is picked with weight 1 / r
+        SHARED.update(
+            user_ids=user_ids,
+            product_ids=product_ids,
+            product_weights=list(itertools.accumulate(1 / rank for rank in range(1, len(product_ids) + 1))),
+            now=timezone.make_aware(datetime.combine(options["end"] + timedelta(days=1), day_time.min)),
+            span=timedelta(days=365 * options["years"]),
+            items_per_order=options["items_per_order"],
+        )
+        count, batch_size = options["orders"], options["batch_size"]
+        tasks = [
+            (seed, chunk, min(batch_size, count - start))
+            for chunk, start in enumerate(range(0, count, batch_size))
         ]
 
-        # create products & re-fetch from DB
-        Product.objects.bulk_create(products)
-        products = Product.objects.all()
-
-        # create some dummy orders tied to the superuser
-        for _ in range(3):
-            # create an Order with 2 order items
-            order = Order.objects.create(user=user)
-            for product in random.sample(list(products), 2):
-                OrderItem.objects.create(
-                    order=order, product=product, quantity=random.randint(1, 3)
-                )
+        started = time.perf_counter()
+        if options["workers"] > 1:
+            connections.close_all()  # Each forked worker opens its own connection
+            with multiprocessing.Pool(options["workers"], initializer=connections.close_all) as pool:
+                results = list(pool.imap_unordered(generate_orders, tasks))
+        else:
+            results = [generate_orders(task) for task in tasks]
+
+        self.report("Orders", sum(orders for orders, _, _ in results), started)
+        self.report("Order items", sum(items for _, items, _ in results), started)
+
+        # The pending and confirmed orders hold their items' stock (api/stock.py), taken off once for the whole run
+        held = sum((held for _, _, held in results), Counter())
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(HOLD_STOCK.format(product=Product._meta.db_table), [list(held), list(held.values())])
+            refresh_products_on_commit(list(held))
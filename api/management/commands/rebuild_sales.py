@@ -0,0 +1,17 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from api.sales import rebuild_sales
+
+
+class Command(BaseCommand):
+    help = "Recomputes the sales rollups from the confirmed orders, for every day or a range of days"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=date.fromisoformat, help="First day to rebuild (YYYY-MM-DD)")
+        parser.add_argument("--until", type=date.fromisoformat, help="Last day to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        product_rows, day_rows = rebuild_sales(options["since"], options["until"])
+        self.stdout.write(self.style.SUCCESS(f"Sales rollups rebuilt: {day_rows} days, {product_rows} product days"))
@@ -0,0 +1,194 @@
+import bisect
+import hmac
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from api.instrumentation import record_queries
+
+"""
+In-process metrics in the Prometheus text format
+
+A few counters and histograms kept in memory and updated by MetricsMiddleware: request latency,
+database time and query count per view, page cache hits/misses and throttled requests. Recording is a
+dict lookup and an increment under a lock, cheap enough to stay on for every request (unlike silk,
+which writes every request to the database). The values are per process: with several workers,
+each one exposes its own, which Prometheus sums up when scraping them all.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{%s}" % pairs
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self):
+        values = self.snapshot()
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [count per bucket (the last one is +Inf), sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        names = self.labels + ("le",)
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {cumulative}"
+
+
+REQUEST_LATENCY = Histogram(
+    "api_request_duration_seconds", "Time spent handling a request", ("view", "method", "status")
+)
+DB_TIME = Histogram("api_request_db_duration_seconds", "Time spent in the database per request", ("view", "method"))
+QUERY_COUNT = Histogram(
+    "api_request_queries", "SQL queries per request", ("view", "method"), buckets=QUERY_BUCKETS
+)
+CACHE_REQUESTS = Counter("api_page_cache_requests_total", "Cached view lookups by result", ("view", "result"))
+CACHE_TIER_REQUESTS = Counter(
+    "api_cache_requests_total", "Cache lookups per tier (l1: in-process, l2: Redis) by result", ("tier", "result")
+)
+THROTTLED = Counter("api_throttled_requests_total", "Requests rejected by a throttle (429)", ("view", "method"))
+
+REGISTRY = [REQUEST_LATENCY, DB_TIME, QUERY_COUNT, CACHE_REQUESTS, CACHE_TIER_REQUESTS, THROTTLED]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def can_scrape(request):
+    """Prometheus with the METRICS_TOKEN bearer token, or a staff user"""
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    if token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return True
+    user = getattr(request, "user", None)
+    return bool(user and user.is_staff)
+
+
+def metrics_view(request):
+    # The views, their latencies and their query counts are not for anonymous visitors
+    if not can_scrape(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    # Unmatched paths share one label, so 404 scans can't create a series per URL
+    return match.view_name if match is not None else "unmatched"
+
+
+# Called by cache_page_by_generation (api/cache.py) for every GET/HEAD of a cached view
+def record_page_cache(request, hit):
+    CACHE_REQUESTS.inc(view_label(request), "hit" if hit else "miss")
+
+
+# Called by TieredRedisCache (api/tiered_cache.py) for every lookup
+def record_cache_lookup(tier, hits, misses):
+    if hits:
+        CACHE_TIER_REQUESTS.inc(tier, "hit", amount=hits)
+    if misses:
+        CACHE_TIER_REQUESTS.inc(tier, "miss", amount=misses)
+
+
+class DatabaseTimer:
+    """Query recorder adding up the number and the duration of the queries"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, sql, duration):
+        self.queries += 1
+        self.seconds += duration
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with record_queries(DatabaseTimer()) as timer:
+            response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with record_queries(DatabaseTimer()) as timer:
+            response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    def observe(self, request, response, elapsed, timer):
+        view, method = view_label(request), request.method
+        REQUEST_LATENCY.observe(elapsed, view, method, response.status_code)
+        DB_TIME.observe(timer.seconds, view, method)
+        QUERY_COUNT.observe(timer.queries, view, method)
+        if response.status_code == 429:  # Only the throttles answer 429
+            THROTTLED.inc(view, method)
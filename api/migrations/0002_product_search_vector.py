@@ -0,0 +1,60 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations, models
+
+# Keep products.search_vector in sync on every INSERT/UPDATE, including bulk_create and queryset.update()
+CREATE_TRIGGER = """
+CREATE FUNCTION api_product_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english'::regconfig, COALESCE(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english'::regconfig, COALESCE(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, description ON api_product
+    FOR EACH ROW EXECUTE FUNCTION api_product_search_vector_update();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS api_product_search_vector_trigger ON api_product;
+DROP FUNCTION IF EXISTS api_product_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built CONCURRENTLY so a large catalog stays writable during the migration
+    atomic = False
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='orders', to=settings.AUTH_USER_MODEL),
+        ),
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, reverse_sql=DROP_TRIGGER),
+        AddIndexConcurrently(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='product_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
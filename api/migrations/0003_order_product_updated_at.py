@@ -0,0 +1,61 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+# Move updated_at forward on every UPDATE that doesn't set it itself (queryset.update(), e.g. the stock
+# reservations, or raw SQL), so the ETags can't miss a change. Saves through the ORM keep their auto_now value.
+CREATE_TRIGGER = """
+CREATE FUNCTION api_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    IF NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+        NEW.updated_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_product_updated_at_trigger
+    BEFORE UPDATE ON api_product
+    FOR EACH ROW EXECUTE FUNCTION api_touch_updated_at();
+
+CREATE TRIGGER api_order_updated_at_trigger
+    BEFORE UPDATE ON api_order
+    FOR EACH ROW EXECUTE FUNCTION api_touch_updated_at();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS api_order_updated_at_trigger ON api_order;
+DROP TRIGGER IF EXISTS api_product_updated_at_trigger ON api_product;
+DROP FUNCTION IF EXISTS api_touch_updated_at();
+"""
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built CONCURRENTLY so the tables stay writable during the migration
+    atomic = False
+
+    dependencies = [
+        ('api', '0002_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, reverse_sql=DROP_TRIGGER),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['user', 'updated_at'], name='order_user_version_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(fields=['id'], include=('updated_at',), name='product_version_idx'),
+        ),
+    ]
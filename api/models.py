@@ -1,12 +1,20 @@
 import uuid
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 
 
 class User(AbstractUser):
     pass
 
 
+# Same expression as the product search trigger (migration 0002), used by the backfill_search_vector command
+PRODUCT_SEARCH_VECTOR = SearchVector("name", weight="A", config="english") + SearchVector(
+    "description", weight="B", config="english"
+)
+
+
 class Product(models.Model):
     product_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     name = models.CharField(max_length=200)
@@ -14,6 +22,22 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Weighted name (A) + description (B) tsvector, kept up to date by a database trigger (see migration 0002)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Version marker of the ETags (api/conditional.py), also moved by queryset.update() through a trigger (migration 0003)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["search_vector"], name="product_search_vector_idx"),
+            GinIndex(fields=["name"], name="product_name_trgm_idx", opclasses=["gin_trgm_ops"]),
+            # Covers the version lookups: a product's updated_at, or count + max over the catalog, without the table
+            models.Index(fields=["id"], include=["updated_at"], name="product_version_idx"),
+            # Price ranges (ProductFilter), and ?ordering=price with the pk tie-breaker of the keyset cursors
+            models.Index(fields=["price", "id"], name="product_price_idx"),
+            # The in-stock catalog in pk order (InStockFilterBackend), without the sold-out rows
+            models.Index(fields=["id"], condition=models.Q(stock__gt=0), name="product_in_stock_idx"),
+        ]
 
     @property
     def in_stock(self):
@@ -30,8 +54,11 @@ class Order(models.Model):
         CANCELLED = 'Cancelled'
 
     order_id = models.UUIDField(primary_key=True, default=uuid.uuid4)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders")
+    # No index of its own: the composite indexes below all start with user
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders", db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Version marker of the ETags (api/conditional.py): item changes go through the order's save, queryset.update() through a trigger
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(
         max_length=10,
         choices=StatusChoices.choices,
@@ -40,6 +67,18 @@ class Order(models.Model):
 
     products = models.ManyToManyField(Product, through="OrderItem", related_name='orders')
 
+    class Meta:
+        indexes = [
+            # Count + max(updated_at) of a user's orders (or of all of them) from the index alone
+            models.Index(fields=["user", "updated_at"], name="order_user_version_idx"),
+            # A user's orders in pk order (OrderViewSet.get_queryset), or by date (?created_at= day, ?ordering=created_at)
+            models.Index(fields=["user", "order_id"], name="order_user_pk_idx"),
+            models.Index(fields=["user", "created_at"], name="order_user_created_idx"),
+            # Staff: every order by date (with the pk tie-breaker of the keyset cursors), or of one status by date
+            models.Index(fields=["created_at", "order_id"], name="order_created_idx"),
+            models.Index(fields=["status", "created_at"], name="order_status_created_idx"),
+        ]
+
     def __str__(self):
         return f"Order {self.order_id } by {self.user.username}"
 
@@ -60,3 +99,26 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f"{self.quantity} x {self.product.name} in Order {self.order.order_id}"
+
+
+# Sales rollups: the confirmed orders' items summed per product and day and per day (day of the order's
+# created_at), kept up to date by the order writes and rebuilt by the rebuild_sales command (api/sales.py)
+class ProductDailySales(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="daily_sales")
+    day = models.DateField()
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders = models.IntegerField(default=0)  # Confirmed orders with the product that day
+
+    class Meta:
+        constraints = [
+            # Also the index of the day range scans of the top sellers
+            models.UniqueConstraint(fields=["day", "product"], name="product_daily_sales_day_product_uniq"),
+        ]
+
+
+class DailySales(models.Model):
+    day = models.DateField(primary_key=True)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    orders = models.IntegerField(default=0)  # Confirmed orders that day, with or without items
@@ -0,0 +1,139 @@
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.expressions import Combinable
+
+from api.cache import coalesce_on_commit
+from api.models import Product
+from api.replicas import primary_reads
+
+"""
+Per-product object cache
+
+Every product is cached as its ProductSerializer payload (plus its updated_at, the ETag version) under
+two keys, product.<pk> and product.uuid.<product_id>, so both identifiers resolve in one lookup. Reads
+go through get_many (a single MGET however many products) and load only the misses from the database,
+in one query. Writes refresh the entries in place once their transaction commits (write-through, in
+one batch per transaction) instead of evicting them, so a product that was just edited doesn't send
+the next reads to Postgres.
+
+Two transactions committing at the same moment can write their payloads in the reverse order: the
+timeout bounds how long such an entry can stay behind.
+"""
+
+timeout = 60 * 15
+
+
+def product_keys(pk, product_id):
+    return [f"product.{pk}", f"product.uuid.{product_id}"]
+
+
+def product_entry(product):
+    from api.serializers import ProductSerializer  # api.serializers -> api.stock -> here
+
+    return {"data": dict(ProductSerializer(product).data), "updated_at": product.updated_at}
+
+
+def cache_products(products):
+    """Write the entries of these products, returned as (product, entry) pairs"""
+    entries = [(product, product_entry(product)) for product in products]
+    cache.set_many(
+        {key: entry for product, entry in entries for key in product_keys(product.pk, product.product_id)},
+        timeout,
+    )
+    return entries
+
+
+def load_products(*filters):
+    with primary_reads():  # Not from a replica that may be behind (api/replicas.py)
+        return cache_products(Product.objects.defer("search_vector").filter(*filters))
+
+
+def get_products(pks=(), product_ids=()):
+    """
+    Cached entries ({"data": payload, "updated_at": ...}) of the products with these pks and product_ids
+    (UUIDs or their strings), as two dicts keyed by pk and by product_id. Missing products are left out.
+    """
+    pks = {int(pk) for pk in pks}
+    product_ids = {uuid.UUID(str(product_id)) for product_id in product_ids}
+    keys = {f"product.{pk}": pk for pk in pks}
+    keys.update({f"product.uuid.{product_id}": product_id for product_id in product_ids})
+    found = cache.get_many(list(keys))
+
+    by_pk, by_product_id = {}, {}
+    for key, value in keys.items():
+        if key in found:
+            (by_product_id if isinstance(value, uuid.UUID) else by_pk)[value] = found[key]
+
+    # Read-through: all the misses in one query, cached for the next readers
+    missing_pks, missing_product_ids = pks - set(by_pk), product_ids - set(by_product_id)
+    if missing_pks or missing_product_ids:
+        for product, entry in load_products(Q(pk__in=missing_pks) | Q(product_id__in=missing_product_ids)):
+            if product.pk in missing_pks:
+                by_pk[product.pk] = entry
+            if product.product_id in missing_product_ids:
+                by_product_id[product.product_id] = entry
+    return by_pk, by_product_id
+
+
+def get_product(pk):
+    """Cached entry of one product, None if it doesn't exist"""
+    return get_products(pks=[pk])[0].get(pk)
+
+
+def flush_product_writes(state):
+    entries, reload = state.get("entries", {}), state.get("reload", set())
+    evicted = [key for keys, entry in entries.values() if entry is None for key in keys]
+    written = {
+        key: entry for pk, (keys, entry) in entries.items() if entry is not None and pk not in reload for key in keys
+    }
+    if evicted:
+        cache.delete_many(evicted)
+    if written:
+        cache.set_many(written, timeout)
+    if reload:  # The committed rows, whatever the instances said
+        load_products(Q(pk__in=reload))
+
+
+def product_writes_on_commit(entries=(), reload=()):
+    """
+    Once the transaction commits, write (or delete, for a None entry) the entries, given as
+    {pk: (keys, entry)}, and reload the products in `reload`. Coalesced per transaction: one
+    set_many/delete_many and one query however many products were written.
+    """
+    state = coalesce_on_commit("product_writes", flush_product_writes)
+    if state is None:
+        flush_product_writes({"entries": dict(entries), "reload": set(reload)})
+        return
+    state.setdefault("entries", {}).update(entries)
+    state.setdefault("reload", set()).update(reload)
+
+
+def refresh_product_on_commit(product, update_fields=None):
+    """Write-through from a saved instance (post_save), or eviction when it may not hold the saved row"""
+    keys = product_keys(product.pk, product.product_id)
+    partial = update_fields is not None or any(
+        isinstance(getattr(product, field.attname, None), Combinable) for field in Product._meta.concrete_fields
+    )
+    # save(update_fields=...) or F() values: the instance isn't the row, so evict
+    product_writes_on_commit(entries={product.pk: (keys, None if partial else product_entry(product))})
+
+
+def refresh_products_on_commit(pks):
+    """Write-through after queryset.update() (no post_save): reload the rows once committed"""
+    product_writes_on_commit(reload=pks)
+
+
+def evict_product_on_commit(product):
+    product_writes_on_commit(entries={product.pk: (product_keys(product.pk, product.product_id), None)})
+
+
+def evict_products_on_commit(product_ids):
+    """Eviction after bulk writes by product_id (imports): the rows are already written, so their pks are known"""
+    product_writes_on_commit(
+        entries={
+            pk: (product_keys(pk, product_id), None)
+            for pk, product_id in Product.objects.filter(product_id__in=product_ids).values_list("pk", "product_id")
+        }
+    )
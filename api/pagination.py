@@ -0,0 +1,240 @@
+import base64
+import binascii
+import json
+
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.generics import GenericAPIView
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class ProductPageNumberPagination(PageNumberPagination):
+    page_size = 2
+    page_query_param = "pagenum"
+    page_size_query_param = "size"
+    max_page_size = 4
+
+    # paginate_queryset for async views: the same page, with the count and the rows fetched by the async ORM
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        paginator = self.django_paginator_class(queryset, self.get_page_size(request))
+        paginator.count = await queryset.acount()  # Paginator.count is a cached_property: reused by page()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [obj async for obj in self.page.object_list]
+        return self.page.object_list
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination: every page is fetched with `WHERE (field, pk) > (last_field, last_pk)`
+    instead of an OFFSET, and no COUNT(*) is run, so page 10,000 costs the same as page 1.
+
+    The ordering comes from the `ordering` query param (restricted to the view's `ordering_fields`)
+    and always ends with `pk` as a tie-breaker so the order is stable. Cursors are opaque tokens.
+    """
+
+    cursor_query_param = "cursor"
+    mode_query_param = "pagination"  # ?pagination=cursor switches a view to keyset mode
+    mode_query_value = "cursor"
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "size"
+    max_page_size = 100
+    ordering_param = api_settings.ORDERING_PARAM
+    default_ordering = ("pk",)
+    invalid_cursor_message = "Invalid cursor"
+
+    @classmethod
+    def is_requested(cls, request):
+        return (
+            cls.cursor_query_param in request.query_params
+            or request.query_params.get(cls.mode_query_param) == cls.mode_query_value
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.page_queryset(queryset, request, view)
+        return self.set_page(list(queryset))
+
+    # paginate_queryset for async views (no COUNT, so the page is a single async query)
+    async def apaginate_queryset(self, queryset, request, view=None):
+        queryset = self.page_queryset(queryset, request, view)
+        return self.set_page([obj async for obj in queryset])
+
+    def page_queryset(self, queryset, request, view):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, view)
+
+        cursor = self.decode_cursor(request)
+        self.reverse = reverse = cursor is not None and cursor["reverse"]  # Walking backwards to the previous page
+        self.has_cursor = cursor is not None
+
+        # (field, descending) pairs, with the direction flipped when walking backwards
+        keys = [(term.lstrip("-"), term.startswith("-") != reverse) for term in self.ordering]
+        queryset = queryset.order_by(*[("-" if desc else "") + field for field, desc in keys])
+
+        if cursor is not None:
+            values = [
+                self.to_python(queryset, field, value)
+                for (field, _), value in zip(keys, cursor["position"])
+            ]
+            queryset = queryset.filter(self.seek_filter(keys, values))
+
+        # Fetch one extra row to know whether there is another page in this direction
+        return queryset[: self.page_size + 1]
+
+    def set_page(self, results):
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        if self.reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.has_cursor
+
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size,
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_ordering(self, request, view):
+        allowed = set(getattr(view, "ordering_fields", None) or [])
+        params = request.query_params.get(self.ordering_param, "")
+        terms = [term.strip() for term in params.split(",") if term.strip()]
+        terms = [term for term in terms if term.lstrip("-") in allowed and term.lstrip("-") != "pk"]
+        if not terms:
+            return self.default_ordering
+
+        # Always finish with the primary key so rows with equal values keep a stable order
+        return tuple(terms) + (("-pk",) if terms[-1].startswith("-") else ("pk",))
+
+    @staticmethod
+    def seek_filter(keys, values):
+        # Lexicographic "comes after" test: (a > x) OR (a = x AND b > y) OR ...
+        condition = Q()
+        for index, (field, desc) in enumerate(keys):
+            term = Q(**{f"{field}__{'lt' if desc else 'gt'}": values[index]})
+            for (prev_field, _), prev_value in zip(keys[:index], values[:index]):
+                term &= Q(**{prev_field: prev_value})
+            condition |= term
+        return condition
+
+    @staticmethod
+    def to_python(queryset, field, value):
+        if field == "pk":
+            return queryset.model._meta.pk.to_python(value)
+        if field in queryset.query.annotations:
+            return queryset.query.annotations[field].output_field.to_python(value)
+        return queryset.model._meta.get_field(field).to_python(value)
+
+    def position(self, obj):
+        values = []
+        for term in self.ordering:
+            value = getattr(obj, term.lstrip("-"))
+            # Keep ints/strings as they are, anything else (Decimal, datetime, UUID) travels as text
+            values.append(value if value is None or isinstance(value, (int, str)) else str(value))
+        return values
+
+    def encode_cursor(self, obj, reverse):
+        payload = {"o": list(self.ordering), "p": self.position(obj), "r": int(reverse)}
+        token = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param, token.decode())
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            ordering, position, reverse = tuple(payload["o"]), payload["p"], bool(payload["r"])
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+        # A cursor only makes sense for the ordering it was issued for
+        if ordering != self.ordering or len(position) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return {"position": position, "reverse": reverse}
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                "name": self.cursor_query_param,
+                "required": False,
+                "in": "query",
+                "description": "The pagination cursor value.",
+                "schema": {"type": "string"},
+            },
+            {
+                "name": self.page_size_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Number of results to return per page.",
+                "schema": {"type": "integer"},
+            },
+        ]
+
+
+# Lets a view keep its regular `pagination_class` and switch to keyset pagination
+# when the client asks for it with `?pagination=cursor` (or follows a `?cursor=` link).
+# (A comment, not a docstring: drf-spectacular would show it as the description of the views' operations)
+class KeysetPaginationMixin:
+    keyset_pagination_class = KeysetPagination
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.keyset_pagination_class.is_requested(self.request):
+                self._paginator = self.keyset_pagination_class()
+            else:
+                return GenericAPIView.paginator.fget(self)
+        return self._paginator
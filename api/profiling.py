@@ -0,0 +1,35 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from silk.middleware import SilkyMiddleware
+
+"""
+silk's middleware is sync only: in an async (ASGI) stack Django would run it, and everything below it,
+in a thread, which takes the concurrency of the async views away. This wrapper keeps silk's behaviour
+(and its SILKY_INTERCEPT_FUNC sampling) but only calls its sync hooks through sync_to_async, around an
+awaited view. silk keeps its collector per thread: async requests profiled at the same moment can get
+their queries mixed up, which is fine for sampled profiling.
+"""
+
+
+class SilkMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.silk = SilkyMiddleware(get_response)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.silk(request)
+
+    async def __acall__(self, request):
+        await sync_to_async(self.silk.process_request)(request)
+        request.silk_filters = {}
+        response = await self.get_response(request)
+        if getattr(request, "silk_is_intercepted", False):
+            response = await sync_to_async(self.silk.process_response)(request, response)
+        return response
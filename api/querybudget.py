@@ -0,0 +1,139 @@
+import logging
+import random
+import re
+import traceback
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from api.instrumentation import record_queries
+
+"""
+Query budgets and N+1 detection
+
+Views declare how many SQL queries one request may run with a `query_budget` attribute, either a number
+or a dict per action/method (e.g. {"list": 4, "retrieve": 5}). QueryBudgetMiddleware counts the queries of
+a request as they run (api/instrumentation.py, no DEBUG needed) and also flags the same SELECT shape
+running again and again, the signature of an N+1. settings.QUERY_BUDGET picks what happens then:
+raise QueryBudgetExceeded (test runs) or log a warning with the offending stack (production, for a
+sampled fraction of the requests, so the others pay nothing).
+"""
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MODE": "log",  # raise, log or off
+    "SAMPLE_RATE": 1.0,
+    "REPEATED_QUERY_THRESHOLD": 3,  # The same SELECT shape this many times in one request is reported
+}
+
+IGNORED_STATEMENTS = ("EXPLAIN", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+# IN (%s, %s, ...) lists of any length have the same shape
+IN_LIST = re.compile(r"\((?:%s,\s*)+%s\)")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "QUERY_BUDGET", {})}
+
+
+def query_shape(sql):
+    return IN_LIST.sub("(%s, ...)", sql)
+
+
+class QueryInspector:
+    """Query recorder counting the queries and the repeated SELECT shapes, with the stack of each repeat"""
+
+    def __init__(self, repeat_threshold):
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.shapes = Counter()
+        self.repeated = {}  # shape -> stack where it reached the threshold
+
+    def __call__(self, sql, duration):
+        # silk's own bookkeeping (its tables, the EXPLAIN of every query) isn't the view's doing,
+        # and savepoints are transaction control, not queries
+        if "silk_" in sql or sql.startswith(IGNORED_STATEMENTS):
+            return
+        self.count += 1
+        if sql.lstrip()[:6].upper() == "SELECT":
+            shape = query_shape(sql)
+            self.shapes[shape] += 1
+            # The stack is only captured once per repeated shape, never for the queries that are fine
+            if self.shapes[shape] == self.repeat_threshold:
+                self.repeated[shape] = "".join(traceback.format_stack()[:-2])
+
+    def violations(self, budget):
+        problems = []
+        if budget is not None and self.count > budget:
+            problems.append((f"{self.count} queries, budget is {budget}", None))
+        for shape, stack in self.repeated.items():
+            problems.append((f"Repeated {self.shapes[shape]} times (N+1?): {shape}", stack))
+        return problems
+
+
+def view_query_budget(view_func, method):
+    """The `query_budget` of a view for the action handling `method`, or None"""
+    budget = getattr(getattr(view_func, "cls", view_func), "query_budget", None)  # DRF view class or plain view
+    if isinstance(budget, dict):
+        action = (getattr(view_func, "actions", None) or {}).get(method, method)
+        return budget.get(action, budget.get("default"))
+    return budget
+
+
+class QueryBudgetMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        inspector = self.sampled_inspector()
+        if inspector is None:
+            return self.get_response(request)
+        with record_queries(inspector):
+            # Queries run while a StreamingHttpResponse is consumed happen after this and aren't counted
+            response = self.get_response(request)
+        self.check(request, inspector)
+        return response
+
+    async def __acall__(self, request):
+        inspector = self.sampled_inspector()
+        if inspector is None:
+            return await self.get_response(request)
+        with record_queries(inspector):
+            response = await self.get_response(request)
+        self.check(request, inspector)
+        return response
+
+    def sampled_inspector(self):
+        config = get_config()
+        if config["MODE"] == "off" or random.random() >= config["SAMPLE_RATE"]:
+            return None
+        return QueryInspector(config["REPEATED_QUERY_THRESHOLD"])
+
+    def check(self, request, inspector):
+        match = getattr(request, "resolver_match", None)
+        budget = view_query_budget(match.func, request.method.lower()) if match is not None else None
+        problems = inspector.violations(budget)
+        if problems:
+            self.report(request, problems, get_config()["MODE"])
+
+    def report(self, request, problems, mode):
+        summary = f"{request.method} {request.path}: " + "; ".join(message for message, _ in problems)
+        if mode == "raise":
+            stacks = "\n".join(stack for _, stack in problems if stack)
+            raise QueryBudgetExceeded(f"{summary}\n{stacks}" if stacks else summary)
+        for message, stack in problems:
+            logger.warning("%s %s: %s%s", request.method, request.path, message, f"\n{stack}" if stack else "")
@@ -0,0 +1,230 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+"""
+Read replicas
+
+Every DATABASE_URL_REPLICA_<name> variable adds a replica_<name> database (products/settings.py).
+ReplicaRouter sends the product and order reads of GET/HEAD/OPTIONS requests to one of them, and
+everything else to the primary: writes, reads of other requests, of management commands and shells,
+of users and sessions, and any read inside a transaction.
+
+- Read-your-writes: after a successful write request, the user's reads stick to the primary for
+  REPLICAS["STICKY_SECONDS"] (a cache key, so it holds across processes), long enough for the replicas
+  to replay the write.
+- Health and lag: a background thread per process checks the replicas every REPLICAS["CHECK_INTERVAL"]
+  seconds (one query on each). One that can't be reached or replays more than REPLICAS["MAX_LAG_SECONDS"]
+  behind the primary is skipped until the next check, and the reads fall back to the primary. Routing
+  only reads the result of the last check, so it never waits on a replica (nor blocks an async view).
+- Reads that fill a cache (the page caches, the product object cache) go to the primary, inside
+  primary_reads(): an entry read from a replica that is behind would serve the stale rows for its
+  whole timeout, long after the replica has caught up.
+"""
+
+logger = logging.getLogger(__name__)
+
+# The request being handled in this context (copied into the sync_to_async threads of async views)
+_request = ContextVar("replica_request", default=None)
+_primary_reads = ContextVar("replica_primary_reads", default=False)
+
+ROUTED_MODELS = {"api.product", "api.order", "api.orderitem"}
+
+# Seconds the replica is behind: 0 when it has replayed everything it received (an idle primary
+# otherwise makes pg_last_xact_replay_timestamp() look older and older)
+LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+def replica_settings():
+    return {"ALIASES": [], "STICKY_SECONDS": 10, "MAX_LAG_SECONDS": 5, "CHECK_INTERVAL": 5, **settings.REPLICAS}
+
+
+def sticky_key(user_id):
+    return f"replica.sticky.{user_id}"
+
+
+def stick_to_primary(user_id):
+    """Route the user's reads to the primary for the sticky window"""
+    cache.set(sticky_key(user_id), True, timeout=replica_settings()["STICKY_SECONDS"])
+
+
+@contextmanager
+def primary_reads():
+    """Send the reads of the block to the primary whatever the request, for what gets cached"""
+    token = _primary_reads.set(True)
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+class ReplicaHealth:
+    """Lag of each replica, measured by a background thread every CHECK_INTERVAL seconds (None: unreachable)"""
+
+    def __init__(self):
+        self.lags = {}  # alias -> lag in seconds or None, replaced as a whole by each check
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def measure(self, alias):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_QUERY)
+                return float(cursor.fetchone()[0])
+        except DatabaseError:
+            logger.warning("Replica %s is unreachable, reading from the primary", alias, exc_info=True)
+            connections[alias].close()  # Reconnect on the next check
+            return None
+
+    def check(self):
+        options = replica_settings()
+        lags = {alias: self.measure(alias) for alias in options["ALIASES"]}
+        for alias, lag in lags.items():
+            if lag is not None and lag > options["MAX_LAG_SECONDS"]:
+                logger.warning("Replica %s is %.1fs behind, reading from the primary", alias, lag)
+        self.lags = lags
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:  # Keep checking, the replicas stay skipped meanwhile
+                logger.exception("Replica health check failed")
+                self.lags = {}
+            time.sleep(replica_settings()["CHECK_INTERVAL"])
+
+    def start(self):
+        # Once per process: a worker forked from a parent that checked gets no thread with the fork
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="replica-health", daemon=True)
+                self.thread.start()
+
+    def usable(self):
+        """The replicas fit for reads at the last check (none until the first one is done), without any I/O"""
+        self.start()
+        options = replica_settings()
+        lags = self.lags
+        return [
+            alias
+            for alias in options["ALIASES"]
+            if lags.get(alias) is not None and lags[alias] <= options["MAX_LAG_SECONDS"]
+        ]
+
+
+health = ReplicaHealth()
+
+
+def request_user_id(request):
+    user = getattr(request, "user", None)  # Set by DRF on the Django request once authenticated
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+def choose_alias(request, sticky):
+    if request.method in SAFE_METHODS and not sticky:
+        usable = health.usable()
+        if usable:
+            return random.choice(usable)
+    return DEFAULT_DB_ALIAS
+
+
+def read_alias(request):
+    """The database the product/order reads of this request go to, chosen once per request"""
+    alias = getattr(request, "replica_alias", None)
+    if alias is None:
+        user_id = request_user_id(request)
+        sticky = user_id is not None and cache.get(sticky_key(user_id))
+        alias = request.replica_alias = choose_alias(request, sticky)
+    return alias
+
+
+async def aread_alias(request):
+    """read_alias for async views, once authenticated: the sticky lookup goes through the async cache API"""
+    if getattr(request, "replica_alias", None) is None and replica_settings()["ALIASES"]:
+        user_id = request_user_id(request)
+        sticky = user_id is not None and await cache.aget(sticky_key(user_id))
+        request.replica_alias = choose_alias(request, sticky)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        request = _request.get()
+        if request is None or model._meta.label_lower not in ROUTED_MODELS or not replica_settings()["ALIASES"]:
+            return None
+        if _primary_reads.get():
+            return None
+        # Reads inside a transaction see its writes and take its locks: primary only
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return read_alias(request)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replica_settings()["ALIASES"]}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary through replication
+        if db in replica_settings()["ALIASES"]:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Make the request visible to ReplicaRouter, and pin the user to the primary after a write"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request.reset(token)
+        self.after_response(request, response)
+        return response
+
+    async def __acall__(self, request):
+        token = _request.set(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request.reset(token)
+        self.after_response(request, response)
+        return response
+
+    def after_response(self, request, response):
+        if request.method in SAFE_METHODS or response.status_code >= 400 or not replica_settings()["ALIASES"]:
+            return
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            stick_to_primary(user.pk)
@@ -0,0 +1,215 @@
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from api.models import DailySales, Order, OrderItem, Product, ProductDailySales
+
+"""
+Sales rollups
+
+"Best sellers this week" or "revenue per day" would otherwise scan every OrderItem joined to its
+Product. ProductDailySales (units, revenue and confirmed orders per product and day) and DailySales
+(the same per day) are kept up to date as orders are written instead, so the analytics read a few
+rows per day whatever the order volume.
+
+A confirmed order counts on the day of its created_at (in the current time zone), its lines at the
+products' current prices, like the orders' total_price. Like the stock reservations (api/stock.py),
+every order write applies the net difference between what the order counted before and after: a
+status transition (confirmed or cancelled), new items, a delete. A price change re-prices the
+product's rollups (a product save, or each batch of the import_products command) and a product
+delete takes them off the days' totals.
+
+Other writes that bypass the API (bulk inserts, the admin, the cascades of a user delete) are not
+tracked: the rebuild_sales command recomputes the rollups from the orders, for any range of days.
+"""
+
+
+def sold_quantities(status, items):
+    """{product_id: quantity} sold by an order in `status` with `items` as (product_id, quantity) pairs, None unless confirmed"""
+    if status != Order.StatusChoices.CONFIRMED:
+        return None
+    quantities = Counter()
+    for product_id, quantity in items:
+        quantities[product_id] += quantity
+    return quantities
+
+
+def sales_day(order):
+    return timezone.localdate(order.created_at)
+
+
+# One statement for the whole change: the product rows in a data-modifying CTE, then the day rows.
+# Rows are written in (day, product) order so concurrent writers take their row locks in the same order.
+APPLY_SALES_CHANGES = """
+WITH delta AS (
+    SELECT d.day, d.product_id, d.units, d.units * p.price AS revenue, d.orders
+    FROM unnest(%s::date[], %s::bigint[], %s::integer[], %s::integer[]) AS d(day, product_id, units, orders)
+    JOIN {product} p ON p.id = d.product_id
+), product_rows AS (
+    INSERT INTO {product_sales} AS s (day, product_id, units, revenue, orders)
+    SELECT day, product_id, units, revenue, orders FROM delta ORDER BY day, product_id
+    ON CONFLICT (day, product_id) DO UPDATE SET
+        units = s.units + EXCLUDED.units, revenue = s.revenue + EXCLUDED.revenue, orders = s.orders + EXCLUDED.orders
+)
+INSERT INTO {daily_sales} AS s (day, units, revenue, orders)
+SELECT day, SUM(units), SUM(revenue), SUM(orders) FROM (
+    SELECT day, units, revenue, 0 AS orders FROM delta
+    UNION ALL
+    SELECT day, 0, 0, orders FROM unnest(%s::date[], %s::integer[]) AS o(day, orders)
+) changes
+GROUP BY day ORDER BY day
+ON CONFLICT (day) DO UPDATE SET
+    units = s.units + EXCLUDED.units, revenue = s.revenue + EXCLUDED.revenue, orders = s.orders + EXCLUDED.orders
+"""
+
+
+def apply_sales_changes(changes):
+    """
+    Move the rollups from counting `old` to counting `new` for each (day, old, new) of `changes`, with
+    `old` and `new` the sold_quantities of an order. Must be called inside the order's transaction.
+    """
+    products = defaultdict(lambda: [0, 0])  # (day, product_id) -> [units, orders]
+    days = Counter()  # day -> orders
+    for day, old, new in changes:
+        days[day] += (new is not None) - (old is not None)
+        old, new = old or {}, new or {}
+        for product_id in set(old) | set(new):
+            row = products[day, product_id]
+            row[0] += new.get(product_id, 0) - old.get(product_id, 0)
+            row[1] += (product_id in new) - (product_id in old)
+
+    products = {key: row for key, row in products.items() if any(row)}
+    days = {day: orders for day, orders in days.items() if orders}
+    if not products and not days:
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            APPLY_SALES_CHANGES.format(
+                product=Product._meta.db_table,
+                product_sales=ProductDailySales._meta.db_table,
+                daily_sales=DailySales._meta.db_table,
+            ),
+            [
+                [day for day, _ in products],
+                [product_id for _, product_id in products],
+                [units for units, _ in products.values()],
+                [orders for _, orders in products.values()],
+                list(days),
+                list(days.values()),
+            ],
+        )
+
+
+# The products' rows at their current price, and the difference added to the days' revenue
+REPRICE_SALES = """
+WITH repriced AS (
+    UPDATE {product_sales} s SET revenue = s.units * p.price
+    FROM {product_sales} old, {product} p
+    WHERE old.id = s.id AND p.id = s.product_id AND p.product_id = ANY(%(product_ids)s)
+        AND s.revenue <> s.units * p.price
+    RETURNING s.day, s.revenue - old.revenue AS difference
+)
+UPDATE {daily_sales} d SET revenue = d.revenue + r.difference
+FROM (SELECT day, SUM(difference) AS difference FROM repriced GROUP BY day) r
+WHERE d.day = r.day
+"""
+
+REMOVE_PRODUCT_SALES = """
+UPDATE {daily_sales} d SET units = d.units - s.units, revenue = d.revenue - s.revenue
+FROM {product_sales} s
+WHERE s.product_id = %(product_id)s AND s.day = d.day
+"""
+
+
+def run_on_rollups(sql, **params):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql.format(
+                product=Product._meta.db_table,
+                product_sales=ProductDailySales._meta.db_table,
+                daily_sales=DailySales._meta.db_table,
+            ),
+            params,
+        )
+
+
+def reprice_sales(product_ids):
+    """Re-price the rollups of the products (by product_id) whose price changed, in one statement"""
+    run_on_rollups(REPRICE_SALES, product_ids=list(product_ids))
+
+
+def remove_product_sales(product):
+    """Take a product's rollups off the days' totals (its own rows go with it, ON DELETE CASCADE)"""
+    run_on_rollups(REMOVE_PRODUCT_SALES, product_id=product.pk)
+
+
+def day_range(field, since=None, until=None):
+    """Filter on the datetime `field` for the days since..until (inclusive, either open), as an index friendly range"""
+    bounds = {}
+    if since is not None:
+        bounds[f"{field}__gte"] = timezone.make_aware(datetime.combine(since, time.min))
+    if until is not None:
+        bounds[f"{field}__lt"] = timezone.make_aware(datetime.combine(until + timedelta(days=1), time.min))
+    return bounds
+
+
+def insert_from(model, columns, queryset):
+    """INSERT INTO the model's table the rows of `queryset` (selecting `columns` in order), without a round trip through Python"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {model._meta.db_table} ({', '.join(columns)}) {sql}", params)
+        return cursor.rowcount
+
+
+def rebuild_sales(since=None, until=None):
+    """Recompute the rollups of the days since..until (inclusive, either open) from the confirmed orders"""
+    confirmed = Order.StatusChoices.CONFIRMED
+    orders = Order.objects.filter(status=confirmed, **day_range("created_at", since, until))
+    items = OrderItem.objects.filter(order__status=confirmed, **day_range("order__created_at", since, until))
+    days = {}
+    if since is not None:
+        days["day__gte"] = since
+    if until is not None:
+        days["day__lte"] = until
+
+    with transaction.atomic():
+        # Order writes wait for the rebuild to commit, then apply their change on top of it
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"LOCK TABLE {ProductDailySales._meta.db_table}, {DailySales._meta.db_table} IN EXCLUSIVE MODE"
+            )
+        ProductDailySales.objects.filter(**days).delete()
+        DailySales.objects.filter(**days).delete()
+
+        product_rows = insert_from(
+            ProductDailySales,
+            ["day", "product_id", "units", "revenue", "orders"],
+            items.values(day=TruncDate("order__created_at"), product_key=F("product_id"))
+            .annotate(
+                units=Sum("quantity"),
+                revenue=Sum(F("quantity") * F("product__price")),
+                orders=Count("order_id", distinct=True),
+            )
+            .order_by(),
+        )
+        day_rows = insert_from(
+            DailySales,
+            ["day", "units", "revenue", "orders"],
+            orders.values(day=TruncDate("created_at"))
+            .annotate(
+                units=Coalesce(Sum("items__quantity"), 0),
+                revenue=Coalesce(
+                    Sum(F("items__quantity") * F("items__product__price")),
+                    Value(0),
+                    output_field=DecimalField(max_digits=14, decimal_places=2),
+                ),
+                orders=Count("pk", distinct=True),
+            )
+            .order_by(),
+        )
+    return product_rows, day_rows
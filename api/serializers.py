@@ -1,6 +1,14 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+
 from rest_framework import serializers
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import transaction
+from django.utils import timezone
+from .cache import bump_generation_on_commit, order_list_namespace
 from .models import Order, OrderItem, Product, User
+from .sales import apply_sales_changes, sales_day, sold_quantities
+from .stock import InsufficientStock, apply_stock_changes, held_quantities, lock_order_holding
 
 
 # List of users serializer
@@ -12,6 +20,16 @@ class UserSerializer(serializers.ModelSerializer):
         # fields = "__all__"
 
 
+# Compact list of users: order aggregates computed by the database instead of every order pk
+class UserSummarySerializer(serializers.ModelSerializer):
+    order_count = serializers.IntegerField(read_only=True)
+    last_order_at = serializers.DateTimeField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = User
+        fields = ("id", "username", "email", "is_staff", "is_active", "is_superuser", "is_authenticated", "get_full_name", "order_count", "last_order_at")
+
+
 # List and create products serializerg
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
@@ -49,9 +67,76 @@ class OrderItemSerializer(serializers.ModelSerializer):
             "item_subtotal",
         )
 
+# Product pk field that resolves against products loaded once for the whole request (context["products"])
+# instead of running one query per order item
+class PreloadedProductField(serializers.PrimaryKeyRelatedField):
+    def to_internal_value(self, data):
+        products = self.context.get("products")
+        if products is None:
+            return super().to_internal_value(data)
+        try:
+            product = products.get(Product._meta.pk.to_python(data))
+        except DjangoValidationError:
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        if product is None:
+            self.fail("does_not_exist", pk_value=data)
+        return product
+
+
+# Reserve/release the stock difference between two holdings, reported as a validation error on the items
+def reserve_stock(old, new):
+    try:
+        apply_stock_changes(old, new)
+    except InsufficientStock as exc:
+        raise serializers.ValidationError(
+            {"items": [f"Not enough stock for product {product_id}." for product_id in exc.product_ids]}
+        )
+
+
+# Create many orders at once: one INSERT for the orders and one for all their items
+class OrderBulkCreateSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        # (product_id, quantity) lines of every order
+        lines = [[(item["product"].pk, item["quantity"]) for item in data.get("items") or []] for data in validated_data]
+        with transaction.atomic():
+            # Reserve the stock of the whole batch in one pass over the products
+            held = sum(
+                (
+                    held_quantities(data.get("status", Order.StatusChoices.PENDING), order_lines)
+                    for data, order_lines in zip(validated_data, lines)
+                ),
+                Counter(),
+            )
+            reserve_stock({}, held)
+
+            orders = Order.objects.bulk_create(
+                [Order(**{key: value for key, value in data.items() if key != "items"}) for data in validated_data]
+            )
+            OrderItem.objects.bulk_create(
+                [
+                    OrderItem(order=order, **item)
+                    for order, data in zip(orders, validated_data)
+                    for item in data.get("items") or []
+                ]
+            )
+            # The sales rollups of the confirmed orders, in one statement for the batch
+            apply_sales_changes(
+                (sales_day(order), None, sold_quantities(order.status, order_lines))
+                for order, order_lines in zip(orders, lines)
+            )
+            # bulk_create sends no post_save signal, so invalidate the cached order lists here
+            bump_generation_on_commit(
+                "order_list.staff",
+                *{order_list_namespace(user_id=order.user_id) for order in orders},
+            )
+        return orders
+
+
 # Create order serializer
 class OrderCreateSerializer(serializers.ModelSerializer):
     class OrderItemCreateSerializer(serializers.ModelSerializer):
+        product = PreloadedProductField(queryset=Product.objects.all())
+
         class Meta:
             model = OrderItem
             fields = ("product", "quantity")
@@ -66,28 +151,75 @@ class OrderCreateSerializer(serializers.ModelSerializer):
             orderitem_data = None
 
         with transaction.atomic():  # Ensure that the entire update operation is atomic — if any part fails, all changes are rolled back
+            # Reserve/release only the stock difference between the old and the new items and status
+            old_status, old_items = lock_order_holding(instance)
+            new_items = old_items
+            if orderitem_data is not None:
+                new_items = [(item["product"].pk, item["quantity"]) for item in orderitem_data]
+            reserve_stock(
+                held_quantities(old_status, old_items),
+                held_quantities(validated_data.get("status", old_status), new_items),
+            )
+
             instance = super().update(instance, validated_data)# Update the order
 
             if orderitem_data is not None:
-                # Clear existing items (optional, depends on requirements)
-                instance.items.all().delete() # Delete the existing items
-
-                # Recreate items with the updated data
-                for item in orderitem_data:
-                    OrderItem.objects.create(order=instance, **item) # Create the order items
+                self.update_items(instance, orderitem_data)
+            apply_sales_changes(
+                [
+                    (
+                        sales_day(instance),
+                        sold_quantities(old_status, old_items),
+                        sold_quantities(instance.status, new_items),
+                    )
+                ]
+            )
         return instance
 
+    # Diff the incoming items against the existing lines: only changed lines are written, the others
+    # (and their order_item_id) are left alone. At most one query each for update, create and delete.
+    def update_items(self, instance, orderitem_data):
+        existing = defaultdict(list)  # product_id -> existing lines, matched in line order
+        # order_id must be loaded too: the related manager reads it on every line to attach the instance
+        for line in instance.items.order_by("pk").only("pk", "order_id", "product_id", "quantity"):
+            existing[line.product_id].append(line)
+
+        changed, added = [], []
+        for item in orderitem_data:
+            lines = existing.get(item["product"].pk)
+            if lines:
+                line = lines.pop(0)
+                if line.quantity != item["quantity"]:
+                    line.quantity = item["quantity"]
+                    changed.append(line)
+            else:
+                added.append(OrderItem(order=instance, **item))
+        removed = [line.pk for lines in existing.values() for line in lines]
+
+        if changed:
+            OrderItem.objects.bulk_update(changed, ["quantity"])
+        if added:
+            OrderItem.objects.bulk_create(added)
+        if removed:
+            OrderItem.objects.filter(pk__in=removed).delete()
+
     def create(self, validated_data):
         if "items" in validated_data:
             orderitem_data = validated_data.pop("items") # Get the items data
         else:
             orderitem_data = None
 
+        lines = [(item["product"].pk, item["quantity"]) for item in orderitem_data or []]
         with transaction.atomic():  # Ensure that the entire create operation is atomic — if any part fails, all changes are rolled back
+            reserve_stock({}, held_quantities(validated_data.get("status", Order.StatusChoices.PENDING), lines))
+
             order = Order.objects.create(**validated_data) # Create the order
 
-            for item in orderitem_data:
-                OrderItem.objects.create(order=order, **item) # Create the order items
+            # Create the order items in a single INSERT (the order's post_save already invalidated the caches)
+            OrderItem.objects.bulk_create(
+                [OrderItem(order=order, **item) for item in orderitem_data or []]
+            )
+            apply_sales_changes([(sales_day(order), None, sold_quantities(order.status, lines))])
 
             return order
 
@@ -100,6 +232,7 @@ class OrderCreateSerializer(serializers.ModelSerializer):
             "items",
         )
         extra_kwargs = {"user": {"read_only": True}}  # Another way to make a field read only
+        list_serializer_class = OrderBulkCreateSerializer
 
 
 # List of orders serializer
@@ -109,11 +242,34 @@ class OrderSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     items = OrderItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField(method_name="total")
+    item_count = serializers.SerializerMethodField()
 
     def total(self, obj):
+        if hasattr(obj, "total_price"):  # Annotated by OrderViewSet, summed in the database
+            return obj.total_price or 0
         order_items = obj.items.all()
         return sum(order_item.item_subtotal for order_item in order_items)
 
+    # Status transitions (e.g. PATCH {"status": "Cancelled"}) release or reserve the order's stock,
+    # and add the order to the sales rollups or take it off them
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            old_status, items = lock_order_holding(instance)
+            reserve_stock(
+                held_quantities(old_status, items),
+                held_quantities(validated_data.get("status", old_status), items),
+            )
+            instance = super().update(instance, validated_data)
+            apply_sales_changes(
+                [(sales_day(instance), sold_quantities(old_status, items), sold_quantities(instance.status, items))]
+            )
+            return instance
+
+    def get_item_count(self, obj):
+        if hasattr(obj, "item_count"):  # Annotated by OrderViewSet
+            return obj.item_count
+        return len(obj.items.all())
+
     class Meta:
         model = Order
         fields = (
@@ -123,6 +279,7 @@ class OrderSerializer(serializers.ModelSerializer):
             "status",
             "items",
             "total_price",
+            "item_count",
         )
 
 
@@ -130,3 +287,54 @@ class ProductInfoSerializer(serializers.Serializer):
     products = ProductSerializer(many=True)
     count = serializers.IntegerField()
     max_price = serializers.FloatField()
+
+
+# Query parameters of the sales endpoints: the days start..end (inclusive), by default the last 7 days
+class SalesRangeSerializer(serializers.Serializer):
+    max_days = 366  # The rows read grow with the range, not with the orders
+
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        end = attrs.get("end") or timezone.localdate()
+        start = attrs.get("start") or end - timedelta(days=6)
+        if start > end:
+            raise serializers.ValidationError({"start": "Must not be after end."})
+        if (end - start).days >= self.max_days:
+            raise serializers.ValidationError({"start": f"At most {self.max_days} days at a time."})
+        return {**attrs, "start": start, "end": end}
+
+
+class TopSellersQuerySerializer(SalesRangeSerializer):
+    by = serializers.ChoiceField(choices=["units", "revenue", "orders"], default="units")
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+
+class SalesFiguresSerializer(serializers.Serializer):
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    orders = serializers.IntegerField()
+
+
+class TopSellerSerializer(SalesFiguresSerializer):
+    product = serializers.IntegerField()
+    name = serializers.CharField()
+
+
+class DailySalesSerializer(SalesFiguresSerializer):
+    day = serializers.DateField()
+
+
+class TopSellersSerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()
+    by = serializers.CharField()
+    results = TopSellerSerializer(many=True)
+
+
+class SalesSeriesSerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()
+    totals = SalesFiguresSerializer()
+    results = DailySalesSerializer(many=True)  # Every day of the range, days without sales as zeros
@@ -1,7 +1,9 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
 from django.dispatch import receiver
-from api.models import Product
-from django.core.cache import cache
+from api.cache import bump_generation_on_commit, coalesce_on_commit, order_list_namespace
+from api.models import Order, OrderItem, Product
+from api.object_cache import evict_product_on_commit, refresh_product_on_commit
+from api.sales import remove_product_sales, reprice_sales
 
 
 @receiver([post_save, post_delete], sender=Product)
@@ -9,11 +11,95 @@ def invalidate_product_cache(sender, instance, **kwargs):
     """
     Invalidate product list caches when a product is created, updated, or deleted
     """
-    print("Clearing product cache")
+    # Move the product list to a new cache generation (a single INCR, coalesced per transaction)
+    bump_generation_on_commit("product_list")
 
-    # Clear product list caches
-    cache.delete_pattern("*product_list*") # Clear all product list caches with the pattern *product_list* from the cache
 
+@receiver(post_save, sender=Product)
+def refresh_product_object_cache(sender, instance, update_fields=None, **kwargs):
+    """
+    Write the saved product through to its object cache entries, instead of evicting them
+    """
+    refresh_product_on_commit(instance, update_fields)
+
+
+@receiver(post_delete, sender=Product)
+def evict_product_object_cache(sender, instance, **kwargs):
+    evict_product_on_commit(instance)
+
+
+@receiver(post_save, sender=Product)
+def reprice_product_sales(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    Keep the sales rollups at the product's current price (a no-op unless the price changed)
+    """
+    if not created and (update_fields is None or "price" in update_fields):
+        reprice_sales([instance.product_id])
+
+
+@receiver(pre_delete, sender=Product)
+def remove_deleted_product_sales(sender, instance, **kwargs):
+    remove_product_sales(instance)
+
+
+@receiver(pre_save, sender=Order)
+def remember_previous_order_owner(sender, instance, update_fields=None, **kwargs):
+    """
+    Keep the stored owner of an order about to be updated, whose list loses the order if it is reassigned
+    """
+    instance._previous_user_id = None
+    if instance._state.adding or (update_fields is not None and not {"user", "user_id"} & set(update_fields)):
+        return
+    instance._previous_user_id = Order.objects.filter(pk=instance.pk).values_list("user_id", flat=True).first()
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_cache(sender, instance, **kwargs):
+    """
+    Invalidate the cached order lists of the order's owner (and previous owner) and of the staff
+    """
+    namespaces = {order_list_namespace(user_id=instance.user_id), "order_list.staff"}
+    previous_user_id = getattr(instance, "_previous_user_id", None)
+    if previous_user_id is not None:
+        namespaces.add(order_list_namespace(user_id=previous_user_id))
+    bump_generation_on_commit(*namespaces)
+    owners = transaction_order_owners()
+    if owners is not None:
+        owners.pop(instance.pk, None)  # The owner may have changed (e.g. reassigned in the admin)
+
+
+def transaction_order_owners():
+    """{order_id: user_id} looked up by the current transaction, None outside a transaction"""
+    state = coalesce_on_commit("order_owners", lambda state: None)
+    return None if state is None else state.setdefault("owners", {})
+
+
+# One lookup per order and transaction (a queryset delete of many lines of one order, which runs in a
+# transaction, then costs a single query here), never reused by a later transaction
+def order_owner(order_id):
+    owners = transaction_order_owners()
+    if owners is None:
+        return Order.objects.filter(pk=order_id).values_list("user_id", flat=True).first()
+    if order_id not in owners:
+        owners[order_id] = Order.objects.filter(pk=order_id).values_list("user_id", flat=True).first()
+    return owners[order_id]
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def invalidate_order_item_cache(sender, instance, origin=None, **kwargs):
+    """
+    Invalidate the order lists that show this item (only the owner's and the staff's)
+    """
+    if isinstance(origin, Order):  # Cascade from an order delete, already handled by invalidate_order_cache
+        return
 
-# Impliment cache invalidation for the order list
+    # The order is usually already loaded (OrderItem.objects.create(order=order, ...)), else look up just the user id
+    if OrderItem.order.is_cached(instance):
+        user_id = instance.order.user_id
+    else:
+        user_id = order_owner(instance.order_id)
 
+    if user_id is None:
+        bump_generation_on_commit("order_list.staff")
+    else:
+        bump_generation_on_commit(order_list_namespace(user_id=user_id), "order_list.staff")
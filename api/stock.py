@@ -0,0 +1,65 @@
+from collections import Counter
+
+from django.db.models import F
+
+from api.cache import bump_generation_on_commit
+from api.models import Order, OrderItem, Product
+from api.object_cache import refresh_products_on_commit
+
+"""
+Stock reservation
+
+An order holds stock for its items unless it is cancelled. Every change (create, item update,
+status transition, delete) is applied as a net delta per product with conditional UPDATEs:
+
+    UPDATE api_product SET stock = stock - n WHERE id = %s AND stock >= n
+
+so there is no read-modify-write race and stock can never go below zero. Products are always
+updated in primary key order, so two transactions touching the same products take their row
+locks in the same order and cannot deadlock. Must be called inside a transaction.
+"""
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_ids):
+        self.product_ids = sorted(product_ids)
+        super().__init__(f"Not enough stock for products {self.product_ids}")
+
+
+def held_quantities(status, items):
+    """{product_id: quantity} held by an order in `status` with `items` as (product_id, quantity) pairs"""
+    quantities = Counter()
+    if status == Order.StatusChoices.CANCELLED:  # Cancelled orders hold no stock
+        return quantities
+    for product_id, quantity in items:
+        quantities[product_id] += quantity
+    return quantities
+
+
+def lock_order_holding(order):
+    """Lock the order row and read its status and items, so concurrent writes to one order can't release stock twice"""
+    status = Order.objects.select_for_update().values_list("status", flat=True).get(pk=order.pk)
+    items = list(OrderItem.objects.filter(order=order).values_list("product_id", "quantity"))
+    return status, items
+
+
+def apply_stock_changes(old, new):
+    """Move from holding `old` to holding `new` ({product_id: quantity}), reserving or releasing the difference"""
+    deltas = {product_id: new.get(product_id, 0) - old.get(product_id, 0) for product_id in set(old) | set(new)}
+
+    # Deterministic lock order: always walk the products by primary key
+    for product_id in sorted(deltas):
+        delta = deltas[product_id]
+        if delta > 0:
+            reserved = Product.objects.filter(pk=product_id, stock__gte=delta).update(stock=F("stock") - delta)
+            if not reserved:
+                # Fail fast so the row locks taken so far are released as soon as the caller rolls back
+                raise InsufficientStock([product_id])
+        elif delta < 0:
+            Product.objects.filter(pk=product_id).update(stock=F("stock") - delta)
+
+    changed = [product_id for product_id, delta in deltas.items() if delta]
+    if changed:
+        # queryset.update() sends no post_save signal, so refresh the product caches here
+        bump_generation_on_commit("product_list")
+        refresh_products_on_commit(changed)
@@ -0,0 +1,89 @@
+import csv
+import io
+
+from rest_framework.utils.encoders import JSONEncoder
+
+
+# Encode exactly like DRF's JSONRenderer does by default (compact separators, unicode kept as is)
+# A single encoder instance is reused, json.dumps(cls=...) would build a new one for every row
+encode_json = JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+# Walk a queryset through a server-side cursor and yield lists of at most chunk_size rows
+# Only one chunk is held in memory at a time, however big the table is
+def iter_chunks(queryset, chunk_size=2000):
+    chunk = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Same as iter_chunks for async code, through the async ORM
+async def aiter_chunks(queryset, chunk_size=2000):
+    chunk = []
+    async for obj in queryset.aiterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_rows(chunk, serializer_class, first):
+    body = ",".join(encode_json(row) for row in serializer_class(chunk, many=True).data)
+    return body if first else "," + body
+
+
+def encode_extra(extra):
+    return "".join(",%s:%s" % (encode_json(name), encode_json(value)) for name, value in (extra or {}).items())
+
+
+# Stream {"<key>": [...rows...], **extra} as JSON, serializing the rows one chunk at a time
+def stream_json_object(key, queryset, serializer_class, extra=None, chunk_size=2000):
+    yield "{%s:[" % encode_json(key)
+    first = True
+    for chunk in iter_chunks(queryset, chunk_size):
+        yield encode_rows(chunk, serializer_class, first)
+        first = False
+    yield "]" + encode_extra(extra) + "}"
+
+
+# Async generator version of stream_json_object, for a StreamingHttpResponse of an async view
+async def astream_json_object(key, queryset, serializer_class, extra=None, chunk_size=2000):
+    yield "{%s:[" % encode_json(key)
+    first = True
+    async for chunk in aiter_chunks(queryset, chunk_size):
+        yield encode_rows(chunk, serializer_class, first)
+        first = False
+    yield "]" + encode_extra(extra) + "}"
+
+
+# Stream dicts as newline delimited JSON, flushing every flush_every rows instead of once per row
+def stream_ndjson(rows, flush_every=1000):
+    buffer = []
+    for row in rows:
+        buffer.append(encode_json(row))
+        if len(buffer) >= flush_every:
+            yield "\n".join(buffer) + "\n"
+            buffer = []
+    if buffer:
+        yield "\n".join(buffer) + "\n"
+
+
+# Stream sequences as CSV under a header row, flushing every flush_every rows
+def stream_csv(header, rows, flush_every=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % flush_every == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -1,7 +1,63 @@
-from django.test import TestCase
-from api.models import Order, User
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+from zoneinfo import ZoneInfo
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from django_redis import get_redis_connection
+from api.cache import cache_page_by_generation, get_generation, order_list_namespace
+from api.filters import OrderFilter, ProductFilter
+from api.models import DailySales, Order, OrderItem, Product, ProductDailySales, User
+from api.stock import InsufficientStock, apply_stock_changes
 from django.urls import reverse
 from rest_framework import status
+from drf_spectacular.generators import SchemaGenerator
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework_simplejwt.tokens import RefreshToken
+from api.views import OrderViewSet, ProductBatchAPIView, ProductDetailAPIView, ProductInfoAPIView, ProductListCreateAPIView
+from api.management.commands.benchmark_api import Command as BenchmarkCommand
+from api.instrumentation import record_queries
+from api.querybudget import QueryBudgetExceeded, QueryInspector, query_shape
+from api.replicas import (
+    ReplicaHealth,
+    ReplicaRouter,
+    ReplicaRoutingMiddleware,
+    aread_alias,
+    health as replica_health,
+    stick_to_primary,
+)
+from api.throttles import (
+    RedisRateThrottle,
+    SlidingWindowAnonRateThrottle,
+    TokenBucketAnonRateThrottle,
+)
+from api.tiered_cache import LocalLRU, TieredRedisCache
+from api.renderers import FastJSONRenderer
+from api.object_cache import load_products
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 # Create your tests here.
@@ -17,12 +73,1534 @@ class UserOrderTestCase(TestCase):
     def test_user_order_endpoint_retrieves_only_authenticated_user_orders(self):
         user = User.objects.get(username="user2")
         self.client.force_login(user)
-        response = self.client.get(reverse("user-orders"))
+        response = self.client.get(reverse("order-list"))  # The user-orders route was folded into the orders viewset
 
         assert response.status_code == status.HTTP_200_OK
         orders = response.json()
-        self.assertTrue(all(order["user"] == user.id for order in orders))
+        self.assertEqual(len(orders), 2)
+        self.assertTrue(all(order["user"]["id"] == user.id for order in orders))
 
     def test_user_order_list_unauthenticated(self):
-        response = self.client.get(reverse("user-orders"))
-        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(reverse("order-list"))
+        # SessionAuthentication comes first and sends no WWW-Authenticate header, so DRF answers 403 rather than 401
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ProductInfoTestCase(TestCase):
+    def setUp(self):
+        cache.clear()  # Reset the throttle history between tests
+        Product.objects.create(name="A", description="a", price=Decimal("10.00"), stock=1)
+        Product.objects.create(name="B", description="b", price=Decimal("25.50"), stock=0)
+
+    def test_product_info_streams_products_count_and_max_price(self):
+        response = self.client.get("/products/info/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(data["count"], 2)
+        self.assertEqual(data["max_price"], 25.5)
+        self.assertEqual([product["name"] for product in data["products"]], ["A", "B"])
+
+    def test_product_info_empty_catalog(self):
+        Product.objects.all().delete()
+        response = self.client.get("/products/info/")
+
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(data, {"products": [], "count": 0, "max_price": None})
+
+
+# Queries against the api tables only (Silk records every request with queries of its own)
+def app_queries(queries):
+    return [
+        query
+        for query in queries
+        if '"api_' in query["sql"] and '"silk_' not in query["sql"] and not query["sql"].startswith("EXPLAIN")
+    ]
+
+
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for index, price in enumerate(["5.00", "5.00", "5.00", "7.50", "1.00"]):
+            Product.objects.create(name=f"P{index}", description="", price=Decimal(price), stock=index)
+
+    def walk(self, url):
+        names, pages = [], 0
+        while url:
+            data = self.client.get(url).json()
+            names += [product["name"] for product in data["results"]]
+            url, pages = data["next"], pages + 1
+        return names, pages
+
+    def test_keyset_pages_follow_ordering_with_pk_tie_breaker(self):
+        names, pages = self.walk("/products/?pagination=cursor&ordering=-price&size=2")
+
+        self.assertEqual(names, ["P3", "P2", "P1", "P0", "P4"])  # Ties on price fall back to -pk
+        self.assertEqual(pages, 3)
+
+    def test_previous_link_returns_the_previous_page(self):
+        first = self.client.get("/products/?pagination=cursor&ordering=price&size=2").json()
+        second = self.client.get(first["next"]).json()
+        back = self.client.get(second["previous"]).json()
+
+        self.assertEqual(back["results"], first["results"])
+        self.assertIsNone(back["previous"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/products/?cursor=bogus")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_page_number_pagination_is_still_the_default(self):
+        data = self.client.get("/products/?pagenum=2").json()
+        self.assertEqual(data["count"], 5)
+        self.assertEqual([product["name"] for product in data["results"]], ["P2", "P3"])
+
+    def test_orders_keyset_mode(self):
+        user = User.objects.create_user(username="buyer", password="test")
+        for _ in range(3):
+            Order.objects.create(user=user)
+        self.client.force_login(user)
+
+        first = self.client.get("/orders/?pagination=cursor&ordering=created_at&size=2").json()
+        second = self.client.get(first["next"]).json()
+
+        self.assertEqual(len(first["results"]), 2)
+        self.assertEqual(len(second["results"]), 1)
+        self.assertIsNone(second["next"])
+
+
+@skipUnless(connection.vendor == "postgresql", "Full-text search needs PostgreSQL")
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+class ProductSearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name="Digital Camera", description="Takes pictures", price=Decimal("350.99"), stock=4)
+        Product.objects.create(name="Coffee Machine", description="Brews a digital espresso", price=Decimal("70.99"), stock=6)
+        Product.objects.create(name="Watch", description="Tells the time", price=Decimal("500.05"), stock=0)
+
+    def search(self, term):
+        data = self.client.get("/products/", {"search": term, "size": 4}).json()
+        return [product["name"] for product in data["results"]]
+
+    def test_search_vector_is_maintained_by_the_trigger(self):
+        product = Product.objects.get(name="Watch")
+        product.name = "Wrist Watch"
+        product.save()
+        self.assertIn("wrist", str(Product.objects.get(pk=product.pk).search_vector))
+
+    def test_results_are_ranked_name_matches_first(self):
+        self.assertEqual(self.search("digital"), ["Digital Camera", "Coffee Machine"])
+
+    def test_prefix_and_typo_matches(self):
+        self.assertEqual(self.search("cam"), ["Digital Camera"])
+        self.assertEqual(self.search("machne"), ["Coffee Machine"])
+
+    def test_backfill_command(self):
+        Product.objects.update(search_vector=None)
+        call_command("backfill_search_vector", batch_size=2, stdout=io.StringIO())
+        self.assertFalse(Product.objects.filter(search_vector__isnull=True).exists())
+
+
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+class ProductCacheGenerationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name="A", description="", price=Decimal("1.00"), stock=1)
+
+    def test_product_write_moves_the_list_to_a_new_generation(self):
+        self.assertEqual(self.client.get("/products/").json()["count"], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name="B", description="", price=Decimal("2.00"), stock=1)
+
+        self.assertEqual(self.client.get("/products/").json()["count"], 2)
+
+    def test_writes_in_one_transaction_bump_the_generation_once(self):
+        before = get_generation("product_list")
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                for product in Product.objects.all():
+                    for price in ("3.00", "4.00", "5.00"):
+                        product.price = Decimal(price)
+                        product.save()
+
+        self.assertEqual(len(callbacks), 2)  # The generation bumps and the object cache writes, once each
+        self.assertEqual(get_generation("product_list"), before + 1)
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class OrderListCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username="alice", password="test")
+        self.bob = User.objects.create_user(username="bob", password="test")
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.alice)
+            Order.objects.create(user=self.bob)
+
+    def get_orders(self, user):
+        token = RefreshToken.for_user(user).access_token  # A fresh token on every call
+        return self.client.get("/orders/", HTTP_AUTHORIZATION=f"Bearer {token}").json()
+
+    def test_cache_is_shared_across_tokens_of_the_same_user(self):
+        self.assertEqual(len(self.get_orders(self.alice)), 1)
+        Order.objects.bulk_create([Order(user=self.alice)])  # No signals, so nothing is invalidated
+
+        self.assertEqual(len(self.get_orders(self.alice)), 1)
+
+    def test_order_write_only_evicts_the_owner_and_staff(self):
+        self.get_orders(self.alice)
+        bob_generation = get_generation(order_list_namespace(self.bob))
+        staff_generation = get_generation("order_list.staff")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.alice)
+
+        self.assertEqual(len(self.get_orders(self.alice)), 2)
+        self.assertEqual(get_generation(order_list_namespace(self.bob)), bob_generation)
+        self.assertEqual(get_generation("order_list.staff"), staff_generation + 1)
+
+    def test_reassigned_order_leaves_the_previous_owners_list(self):
+        self.assertEqual(len(self.get_orders(self.alice)), 1)
+        order = Order.objects.get(user=self.alice)
+        order.user = self.bob  # e.g. in the admin
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+
+        self.assertEqual(self.get_orders(self.alice), [])
+        self.assertEqual(len(self.get_orders(self.bob)), 2)
+
+    def test_item_write_follows_a_reassigned_order(self):
+        order = Order.objects.get(user=self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name="Camera", description="", price=Decimal("1.00"), stock=1)
+            item = OrderItem.objects.create(order_id=order.pk, product=product, quantity=1)  # Owner looked up
+        Order.objects.filter(pk=order.pk).update(user=self.bob)
+        bob_generation = get_generation(order_list_namespace(self.bob))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            OrderItem.objects.filter(pk=item.pk).first().save()  # Order not loaded: owner looked up again
+
+        self.assertEqual(get_generation(order_list_namespace(self.bob)), bob_generation + 1)
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class OrderTotalsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        cheap = Product.objects.create(name="Cheap", description="", price=Decimal("12.99"), stock=10)
+        pricey = Product.objects.create(name="Pricey", description="", price=Decimal("350.00"), stock=10)
+        self.small = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.small, product=cheap, quantity=2)
+        self.large = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.large, product=pricey, quantity=2)
+        OrderItem.objects.create(order=self.large, product=cheap, quantity=1)
+        self.empty = Order.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_totals_and_item_counts_come_from_the_annotation(self):
+        orders = {order["order_id"]: order for order in self.client.get("/orders/").json()}
+
+        self.assertEqual(orders[str(self.small.pk)]["total_price"], 25.98)
+        self.assertEqual(orders[str(self.large.pk)]["total_price"], 712.99)
+        self.assertEqual(orders[str(self.large.pk)]["item_count"], 2)
+        self.assertEqual(orders[str(self.empty.pk)]["total_price"], 0)
+
+    def test_filter_and_order_by_total_price(self):
+        over_500 = self.client.get("/orders/", {"total_price__gt": 500}).json()
+        self.assertEqual([order["order_id"] for order in over_500], [str(self.large.pk)])
+
+        in_range = self.client.get("/orders/", {"total_price__range": "1,100"}).json()
+        self.assertEqual([order["order_id"] for order in in_range], [str(self.small.pk)])
+
+        ordered = self.client.get("/orders/", {"ordering": "-total_price"}).json()
+        self.assertEqual(
+            [order["order_id"] for order in ordered],
+            [str(self.large.pk), str(self.small.pk), str(self.empty.pk)],
+        )
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class OrderBulkWriteTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="b2b", password="test")
+        self.products = [
+            Product.objects.create(name=f"P{index}", description="", price=Decimal("1.00"), stock=100)
+            for index in range(3)
+        ]
+        self.client.force_login(self.user)
+
+    def payload(self, count):
+        return [
+            {"items": [{"product": product.pk, "quantity": 1} for product in self.products]}
+            for _ in range(count)
+        ]
+
+    def post_bulk(self, count):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/orders/bulk/", self.payload(count), content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response, len(app_queries(queries))
+
+    def test_bulk_create_uses_a_fixed_number_of_queries(self):
+        response, small_batch_queries = self.post_bulk(2)
+        _, large_batch_queries = self.post_bulk(25)
+
+        self.assertEqual(small_batch_queries, large_batch_queries)
+        self.assertEqual(len(response.json()), 2)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 27)
+        self.assertEqual(OrderItem.objects.filter(order__user=self.user).count(), 27 * 3)
+
+    def test_bulk_create_rejects_unknown_products(self):
+        response = self.client.post(
+            "/orders/bulk/", [{"items": [{"product": 999999, "quantity": 1}]}], content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+
+    def test_create_inserts_items_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/orders/", self.payload(1)[0], content_type="application/json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        inserts = [query for query in app_queries(queries) if query["sql"].startswith('INSERT INTO "api_orderitem"')]
+        self.assertEqual(len(inserts), 1)
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class StockReservationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        self.camera = Product.objects.create(name="Camera", description="", price=Decimal("350.99"), stock=5)
+        self.watch = Product.objects.create(name="Watch", description="", price=Decimal("500.05"), stock=1)
+        self.client.force_login(self.user)
+
+    def stock(self, product):
+        product.refresh_from_db()
+        return product.stock
+
+    def place(self, *items, **extra):
+        payload = {"items": [{"product": product.pk, "quantity": quantity} for product, quantity in items], **extra}
+        return self.client.post("/orders/", payload, content_type="application/json")
+
+    def test_create_reserves_stock(self):
+        response = self.place((self.camera, 2), (self.watch, 1))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.stock(self.camera), 3)
+        self.assertEqual(self.stock(self.watch), 0)
+
+    def test_insufficient_stock_rejects_the_whole_order(self):
+        response = self.place((self.camera, 2), (self.watch, 2))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("items", response.json())
+        self.assertEqual(self.stock(self.camera), 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_update_reserves_only_the_difference_and_cancel_releases(self):
+        order_id = self.place((self.camera, 2)).json()["order_id"]
+
+        response = self.client.put(
+            f"/orders/{order_id}/",
+            {"items": [{"product": self.camera.pk, "quantity": 4}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.camera), 1)
+
+        response = self.client.patch(f"/orders/{order_id}/", {"status": "Cancelled"}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.camera), 5)
+
+    def test_delete_releases_stock(self):
+        order_id = self.place((self.watch, 1)).json()["order_id"]
+        self.client.delete(f"/orders/{order_id}/")
+        self.assertEqual(self.stock(self.watch), 1)
+
+
+@skipUnless(connection.vendor == "postgresql", "Needs row locking")
+class ConcurrentStockReservationTestCase(TransactionTestCase):
+    def test_concurrent_reservations_never_oversell(self):
+        product = Product.objects.create(name="Hot", description="", price=Decimal("1.00"), stock=5)
+        outcomes = []
+
+        def reserve():
+            try:
+                with transaction.atomic():
+                    apply_stock_changes({}, {product.pk: 1})
+                outcomes.append(True)
+            except InsufficientStock:
+                outcomes.append(False)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reserve) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(outcomes.count(True), 5)
+        self.assertEqual(product.stock, 0)
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class OrderItemDiffUpdateTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        self.products = [
+            Product.objects.create(name=f"P{index}", description="", price=Decimal("1.00"), stock=100)
+            for index in range(4)
+        ]
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=self.order, product=product, quantity=1) for product in self.products[:3]]
+        )
+        self.client.force_login(self.user)
+
+    def put_items(self, quantities):
+        payload = {"items": [{"product": self.products[index].pk, "quantity": qty} for index, qty in quantities]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(f"/orders/{self.order.pk}/", payload, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [query["sql"] for query in app_queries(queries)]
+
+    def test_unchanged_lines_keep_their_ids(self):
+        before = dict(self.order.items.values_list("product_id", "order_item_id"))
+
+        queries = self.put_items([(0, 1), (1, 5), (3, 2)])  # Keep P0, change P1, drop P2, add P3
+
+        after = dict(self.order.items.values_list("product_id", "order_item_id"))
+        self.assertEqual(after[self.products[0].pk], before[self.products[0].pk])
+        self.assertEqual(after[self.products[1].pk], before[self.products[1].pk])
+        self.assertNotIn(self.products[2].pk, after)
+        self.assertEqual(self.order.items.get(product=self.products[1]).quantity, 5)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('UPDATE "api_orderitem"')]), 1)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('INSERT INTO "api_orderitem"')]), 1)
+        self.assertEqual(len([sql for sql in queries if sql.startswith('DELETE FROM "api_orderitem"')]), 1)
+
+    def test_no_item_writes_when_nothing_changed(self):
+        queries = self.put_items([(0, 1), (1, 1), (2, 1)])
+        self.assertFalse([sql for sql in queries if sql.split()[0] in ("INSERT", "DELETE") or sql.startswith('UPDATE "api_orderitem"')])
+
+
+class UserListTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user(username=f"user{index}", password="test") for index in range(7)]
+        for user in self.users[:3]:
+            Order.objects.create(user=user)
+            Order.objects.create(user=user)
+
+    def test_users_are_paginated_and_orders_prefetched(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get("/users/").json()
+
+        self.assertEqual(len(data["results"]), 5)
+        self.assertIsNotNone(data["next"])
+        self.assertEqual(len(data["results"][0]["orders"]), 2)
+        self.assertEqual(len(app_queries(queries)), 2)  # One for the page of users, one for their orders
+
+    def test_compact_mode_returns_order_aggregates(self):
+        data = self.client.get("/users/", {"compact": "true"}).json()
+        first = data["results"][0]
+
+        self.assertNotIn("orders", first)
+        self.assertEqual(first["order_count"], 2)
+        self.assertIsNotNone(first["last_order_at"])
+        self.assertEqual(data["results"][-1]["order_count"], 0)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        self.camera = Product.objects.create(name="Camera", description="Digital", price=Decimal("350.99"), stock=4)
+        self.watch = Product.objects.create(name="Watch", description="Gold", price=Decimal("500.05"), stock=2)
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.order, product=self.camera, quantity=2)
+        OrderItem.objects.create(order=self.order, product=self.watch, quantity=1)
+        Order.objects.create(user=User.objects.create_user(username="other", password="test"))
+
+    def read(self, response):
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content).decode()
+
+    def test_product_export_ndjson_uses_the_product_filters(self):
+        body = self.read(self.client.get("/products/export/", {"price__gt": 400}))
+        rows = [json.loads(line) for line in body.splitlines()]
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["name"], "Watch")
+        self.assertEqual(rows[0]["price"], "500.05")
+
+    def test_product_export_csv(self):
+        response = self.client.get("/products/export/", {"format": "csv"})
+        lines = self.read(response).splitlines()
+
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        self.assertEqual(lines[0], "id,product_id,description,name,price,stock")
+        self.assertEqual(len(lines), 3)
+
+    @mock.patch.object(OrderViewSet, "throttle_classes", [])
+    def test_order_export_is_scoped_to_the_user(self):
+        self.client.force_login(self.user)
+
+        orders = [json.loads(line) for line in self.read(self.client.get("/orders/export/")).splitlines()]
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0]["total_price"], "1202.03")
+        self.assertEqual([item["product_name"] for item in orders[0]["items"]], ["Camera", "Watch"])
+
+        lines = self.read(self.client.get("/orders/export/", {"format": "csv"})).splitlines()
+        self.assertEqual(len(lines), 3)  # Header and one row per order item
+
+    def test_product_export_is_documented(self):
+        operation = SchemaGenerator().get_schema(request=None, public=True)["paths"]["/products/export/"]["get"]
+        self.assertEqual(set(operation["responses"]["200"]["content"]), {"application/x-ndjson", "text/csv"})
+        self.assertTrue({"format", "price__range", "search"} <= {param["name"] for param in operation["parameters"]})
+
+
+class ImportProductsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.existing = Product.objects.create(name="Old name", description="", price=Decimal("1.00"), stock=1)
+
+    def import_feed(self, content, suffix, **options):
+        with tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False) as feed:
+            feed.write(content)
+        self.addCleanup(os.unlink, feed.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command("import_products", feed.name, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_csv_import_upserts_on_product_id_and_skips_invalid_rows(self):
+        generation = get_generation("product_list")
+        out, err = self.import_feed(
+            "product_id,name,description,price,stock\n"
+            f"{self.existing.product_id},New name,Updated,9.99,5\n"
+            ",Brand new,Fresh,3.50,2\n"
+            ",Free stuff,Invalid,0,2\n",
+            ".csv",
+            batch_size=2,
+        )
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.price, self.existing.stock), ("New name", Decimal("9.99"), 5))
+        self.assertTrue(Product.objects.filter(name="Brand new").exists())
+        self.assertFalse(Product.objects.filter(name="Free stuff").exists())
+        self.assertIn("Price must be greater than 0.", err)
+        self.assertIn("rows/s", out)
+        self.assertEqual(get_generation("product_list"), generation + 1)  # Invalidated once, not per row
+
+    def test_malformed_ndjson_line_is_an_invalid_row(self):
+        out, err = self.import_feed(
+            '{"name": "Before", "description": "d", "price": "1.00", "stock": 1}\n'
+            "\n"
+            '{"name": "Broken", "price": \n'
+            '{"name": "After", "description": "d", "price": "2.00", "stock": 1}\n',
+            ".ndjson",
+        )
+
+        self.assertEqual(Product.objects.filter(name__in=["Before", "After"]).count(), 2)
+        self.assertIn("Line 3:", err)
+        self.assertIn("1 invalid rows skipped", out)
+
+    @skipUnless(connection.vendor == "postgresql", "COPY needs PostgreSQL")
+    def test_ndjson_import_with_copy(self):
+        rows = [{"product_id": str(self.existing.product_id), "name": "Copied", "description": "d", "price": "2.00", "stock": 3}]
+        self.import_feed("\n".join(json.dumps(row) for row in rows) + "\n", ".ndjson", method="copy")
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.name, "Copied")
+        self.assertIn("'copi'", str(Product.objects.get(pk=self.existing.pk).search_vector))  # Stemmed by the trigger
+
+
+class PopulateDbTestCase(TestCase):
+    def populate(self, seed):
+        call_command(
+            "populate_db", users=5, products=30, orders=40, items_per_order=3, seed=seed, batch_size=7,
+            stdout=io.StringIO(),
+        )
+        return (
+            set(Order.objects.values_list("order_id", "created_at")),
+            set(OrderItem.objects.values_list("order_item_id", "quantity")),
+            set(Product.objects.values_list("product_id", "description", "stock")),
+        )
+
+    def test_same_seed_generates_the_same_data(self):
+        first = self.populate("a")
+        self.assertEqual(len(first[0]), 40)
+        self.assertEqual(User.objects.count(), 6)  # admin + 5
+        self.assertEqual(Product.objects.count(), 30)
+        self.assertTrue(Order.objects.filter(created_at__lt=timezone.now() - timedelta(days=30)).exists())
+        self.assertFalse(Order.objects.filter(created_at__gte=timezone.make_aware(datetime(2025, 1, 2))).exists())
+        self.assertEqual(self.populate("a"), first)  # Nothing added, no stock held twice
+
+        Order.objects.all().delete()
+        Product.objects.all().delete()
+        self.assertEqual(self.populate("a"), first)
+        self.assertEqual(User.objects.count(), 6)  # Existing seeded users are kept, not duplicated
+        self.assertNotEqual(self.populate("b")[0], first[0])
+
+    def test_pending_and_confirmed_orders_hold_stock(self):
+        call_command("populate_db", orders=0, seed="a", stdout=io.StringIO())
+        generated = dict(Product.objects.values_list("pk", "stock"))
+        call_command("populate_db", orders=30, seed="a", stdout=io.StringIO())
+
+        held = Counter()
+        items = OrderItem.objects.exclude(order__status=Order.StatusChoices.CANCELLED)
+        for product_id, quantity in items.values_list("product_id", "quantity"):
+            held[product_id] += quantity
+        self.assertTrue(held)
+        self.assertEqual(Product.objects.count(), 6)  # The classic products are inserted once
+        self.assertEqual(
+            dict(Product.objects.values_list("pk", "stock")),
+            {pk: max(stock - held[pk], 0) for pk, stock in generated.items()},
+        )
+
+
+class BenchmarkApiTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        call_command("populate_db", users=3, products=10, orders=20, seed="bench", stdout=io.StringIO())
+
+    def test_endpoints_report_latency_queries_and_cache_hits(self):
+        command = BenchmarkCommand(stdout=io.StringIO())
+        results = command.run_endpoints(
+            {"endpoint": ["orders.list.user", "orders.create"], "requests": 5, "warmup": 1}
+        )
+
+        self.assertEqual(set(results), {"orders.list.user", "orders.create"})
+        listed, created = results["orders.list.user"], results["orders.create"]
+        self.assertEqual(listed["statuses"], {"200": 5})
+        self.assertEqual(listed["cache_hit_rate"], 1.0)  # Warmed up by the unmeasured request
+        self.assertEqual(created["statuses"], {"201": 5})
+        self.assertIsNone(created["cache_hit_rate"])
+        self.assertLessEqual(created["p50_ms"], created["p99_ms"])
+        self.assertEqual(Order.objects.count(), 20)  # Writes are rolled back
+
+    def test_sales_and_async_endpoints(self):
+        names = ["sales.top", "sales.top.revenue", "sales.series"] + [
+            name for name, *_ in BenchmarkCommand().endpoints() if name.startswith("async.")
+        ]
+        results = BenchmarkCommand(stdout=io.StringIO()).run_endpoints({"endpoint": names, "requests": 1, "warmup": 0})
+
+        self.assertEqual(
+            {name: result["statuses"] for name, result in results.items()}, {name: {"200": 1} for name in names}
+        )
+
+    def test_baseline_regressions(self):
+        baseline = {"a": {"p95_ms": 10.0, "queries_max": 3}, "b": {"p95_ms": 10.0, "queries_max": 3}}
+        results = {
+            "a": {"p95_ms": 11.0, "queries_max": 3},  # Within the threshold
+            "b": {"p95_ms": 20.0, "queries_max": 4},
+            "c": {"p95_ms": 99.0, "queries_max": 9},  # Not in the baseline
+        }
+
+        regressions = BenchmarkCommand().compare(baseline, results, threshold=0.2, min_delta_ms=2.0)
+
+        self.assertEqual(regressions, ["b: p95 10.00ms -> 20.00ms", "b: queries 3 -> 4"])
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class QueryBudgetTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        for index in range(3):
+            product = Product.objects.create(name=f"P{index}", description="", price=Decimal("1.00"), stock=10)
+            OrderItem.objects.create(order=Order.objects.create(user=self.user), product=product, quantity=1)
+        self.client.force_login(self.user)
+
+    def test_order_list_stays_within_its_budget(self):
+        response = self.client.get("/orders/")  # Raises QueryBudgetExceeded in test runs otherwise
+        self.assertEqual(len(response.json()), 3)
+
+    @mock.patch.object(OrderViewSet, "query_budget", {"list": 3})
+    def test_exceeding_the_budget_raises_in_tests(self):
+        with self.assertRaisesMessage(QueryBudgetExceeded, "GET /orders/: 6 queries, budget is 3"):
+            self.client.get("/orders/")
+
+    @mock.patch.object(OrderViewSet, "query_budget", {"list": 3})
+    def test_sampled_log_mode_logs_the_violation(self):
+        with self.settings(QUERY_BUDGET={"MODE": "log", "SAMPLE_RATE": 1.0}), self.assertLogs("api.querybudget") as logs:
+            response = self.client.get("/orders/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("6 queries, budget is 3", logs.output[0])
+
+        cache.clear()
+        with self.settings(QUERY_BUDGET={"MODE": "log", "SAMPLE_RATE": 0}), self.assertNoLogs("api.querybudget"):
+            self.client.get("/orders/")  # Not sampled
+
+    def test_repeated_query_shapes_are_flagged_with_their_stack(self):
+        with record_queries(QueryInspector(repeat_threshold=3)) as inspector:
+            names = [item.product.name for item in OrderItem.objects.all()]  # One product query per item
+
+        self.assertEqual(len(names), 3)
+        (shape, stack), = inspector.repeated.items()
+        self.assertIn('FROM "api_product"', shape)
+        self.assertIn("test_repeated_query_shapes_are_flagged_with_their_stack", stack)
+        self.assertEqual(query_shape('WHERE "id" IN (%s, %s, %s)'), query_shape('WHERE "id" IN (%s, %s)'))
+
+
+@override_settings(METRICS_TOKEN="scrape-token")
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Product.objects.create(name="A", description="a", price=Decimal("10.00"), stock=1)
+
+    def scrape(self):
+        return self.client.get("/metrics/", headers={"Authorization": "Bearer scrape-token"})
+
+    def metric(self, text, sample):
+        for line in text.splitlines():
+            if line.startswith(sample + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0
+
+    @mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+    def test_latency_queries_and_page_cache_hits_per_view(self):
+        view = 'view="api.views.ProductListCreateAPIView"'
+        before = self.scrape().content.decode()
+        self.client.get("/products/")
+        self.client.get("/products/")
+        after = self.scrape().content.decode()
+
+        self.assertEqual(self.scrape()["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        for sample, increase in (
+            (f'api_request_duration_seconds_count{{{view},method="GET",status="200"}}', 2),
+            (f'api_request_duration_seconds_bucket{{{view},method="GET",status="200",le="+Inf"}}', 2),
+            (f'api_request_queries_count{{{view},method="GET"}}', 2),
+            (f'api_page_cache_requests_total{{{view},result="miss"}}', 1),
+            (f'api_page_cache_requests_total{{{view},result="hit"}}', 1),
+        ):
+            self.assertEqual(self.metric(after, sample) - self.metric(before, sample), increase, sample)
+        self.assertGreater(self.metric(after, f'api_request_db_duration_seconds_sum{{{view},method="GET"}}'), 0)
+
+    def test_throttled_requests_are_counted(self):
+        sample = 'api_throttled_requests_total{view="api.views.ProductInfoAPIView",method="GET"}'
+        before = self.metric(self.scrape().content.decode(), sample)
+        statuses = [self.client.get("/products/info/").status_code for _ in range(3)]  # anon: 2/minute
+
+        self.assertEqual(statuses[-1], status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.metric(self.scrape().content.decode(), sample) - before, 1)
+
+    def test_metrics_need_the_token_or_a_staff_user(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get("/metrics/", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.scrape().status_code, status.HTTP_200_OK)
+
+        self.client.force_login(User.objects.create_user(username="customer", password="test"))
+        self.assertEqual(self.client.get("/metrics/").status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_login(User.objects.create_user(username="staff", password="test", is_staff=True))
+        self.assertEqual(self.client.get("/metrics/").status_code, status.HTTP_200_OK)
+
+    def test_silk_only_records_sampled_or_requested_staff_requests(self):
+        from products.settings import silk_intercept
+
+        staff = User.objects.create_user(username="staff", password="test", is_staff=True)
+        customer = User.objects.create_user(username="customer", password="test")
+        request = mock.Mock(headers={"X-Silk-Profile": "1"}, user=staff)
+        with mock.patch("products.settings.SILK_SAMPLE_RATE", 0):
+            self.assertTrue(silk_intercept(request))
+            request.user = customer
+            self.assertFalse(silk_intercept(request))
+            self.assertFalse(silk_intercept(mock.Mock(headers={}, user=staff)))
+        with mock.patch("products.settings.SILK_SAMPLE_RATE", 1):
+            self.assertTrue(silk_intercept(mock.Mock(headers={}, user=customer)))
+
+
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+@mock.patch.object(ProductDetailAPIView, "throttle_classes", [])
+@mock.patch.object(ProductInfoAPIView, "throttle_classes", [])
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username="alice", password="test")
+        self.bob = User.objects.create_user(username="bob", password="test")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products = [
+                Product.objects.create(name=name, description=name, price=Decimal(price), stock=5)
+                for name, price in (("A", "3.00"), ("B", "1.00"), ("C", "2.00"))
+            ]
+            self.order = Order.objects.create(user=self.alice)
+            OrderItem.objects.create(order=self.order, product=self.products[0], quantity=2)
+            Order.objects.create(user=self.bob)
+
+    def auth(self, user):
+        return {"Authorization": f"Bearer {RefreshToken.for_user(user).access_token}"}
+
+    async def read(self, response):
+        # Consumed like an ASGI server does, iterating an async stream synchronously would buffer it with a warning
+        if response.streaming:
+            return b"".join([chunk async for chunk in response])
+        return response.content
+
+    def test_product_endpoints_match_the_sync_views(self):
+        for path in (
+            "products/?ordering=-price",
+            "products/?pagenum=2",
+            "products/?pagination=cursor&size=2",
+            "products/?price__lt=2.5",
+            f"products/{self.products[1].pk}/",
+            "products/info/",
+        ):
+            expected = self.client.get(f"/{path}")
+            response = async_to_sync(self.async_client.get)(f"/async/{path}")
+            content = async_to_sync(self.read)(response)
+            self.assertEqual(response.status_code, expected.status_code, path)
+            # Same bytes, pagination links aside (they point to the async URL)
+            self.assertEqual(
+                content.replace(b"/async/", b"/"),
+                b"".join(expected) if expected.streaming else expected.content,
+                path,
+            )
+
+    def test_order_endpoints_match_the_sync_views_and_are_scoped(self):
+        for path in ("orders/", "orders/?pagination=cursor", f"orders/{self.order.pk}/"):
+            expected = self.client.get(f"/{path}", headers=self.auth(self.alice))
+            response = async_to_sync(self.async_client.get)(f"/async/{path}", headers=self.auth(self.alice))
+            self.assertEqual(response.status_code, status.HTTP_200_OK, path)
+            self.assertEqual(response.json(), expected.json(), path)
+
+        other = async_to_sync(self.async_client.get)(f"/async/orders/{self.order.pk}/", headers=self.auth(self.bob))
+        self.assertEqual(other.status_code, status.HTTP_404_NOT_FOUND)
+        anonymous = async_to_sync(self.async_client.get)("/async/orders/")
+        self.assertEqual(anonymous.status_code, status.HTTP_403_FORBIDDEN)
+
+    async def test_page_cache_follows_the_sync_invalidation(self):
+        self.assertEqual((await self.async_client.get("/async/products/")).json()["count"], 3)
+        # bulk_create sends no signal: the cached page is still served
+        await Product.objects.abulk_create([Product(name="D", description="d", price=Decimal("4.00"), stock=1)])
+        self.assertEqual((await self.async_client.get("/async/products/")).json()["count"], 3)
+
+        def create():
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.create(name="E", description="e", price=Decimal("5.00"), stock=1)
+
+        await sync_to_async(create)()
+        self.assertEqual((await self.async_client.get("/async/products/")).json()["count"], 5)
+
+    def test_product_info_streams_a_sync_iterator_under_wsgi(self):
+        expected = b"".join(self.client.get("/products/info/"))
+        response = self.client.get("/async/products/info/")
+        self.assertFalse(response.is_async)  # Sent as it is read, not buffered with a warning
+        self.assertEqual(b"".join(response), expected)
+
+        response = async_to_sync(self.async_client.get)("/async/products/info/")
+        self.assertTrue(response.is_async)
+
+    @override_settings(
+        REPLICAS={"ALIASES": ["replica_1"], "STICKY_SECONDS": 10, "MAX_LAG_SECONDS": 5, "CHECK_INTERVAL": 60}
+    )
+    async def test_replica_routing_never_probes_from_the_event_loop(self):
+        # The last check found the replica behind (the test database is all there is to read from)
+        probe = mock.patch.object(replica_health, "measure", side_effect=AssertionError("Probed during a request"))
+        lags = mock.patch.object(replica_health, "lags", {"replica_1": 30.0})
+        with mock.patch.object(replica_health, "start"), lags, probe:
+            responses = [
+                await self.async_client.get("/async/products/?search=a"),
+                await self.async_client.get(f"/async/products/{self.products[0].pk}/"),
+                await self.async_client.get("/async/orders/", headers=self.auth(self.alice)),
+                await self.async_client.get(f"/async/orders/{self.order.pk}/", headers=self.auth(self.alice)),
+            ]
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+
+    async def test_concurrent_requests_and_read_only_methods(self):
+        responses = await asyncio.gather(
+            *[self.async_client.get(f"/async/products/{product.pk}/") for product in self.products],
+            self.async_client.get("/async/orders/", headers=self.auth(self.bob)),
+        )
+        self.assertEqual([response.json()["name"] for response in responses[:3]], ["A", "B", "C"])
+        self.assertEqual(len(responses[3].json()), 1)
+
+        response = await self.async_client.post("/async/products/", {})
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    def test_async_views_are_left_out_of_the_schema(self):
+        schema = SchemaGenerator().get_schema(request=None, public=True)
+        self.assertIn("/products/", schema["paths"])
+        self.assertFalse([path for path in schema["paths"] if path.startswith("/async/")])
+
+
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+@mock.patch.object(ProductDetailAPIView, "throttle_classes", [])
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class ConditionalRequestTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username="admin", password="test", is_staff=True)
+        self.alice = User.objects.create_user(username="alice", password="test")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = Product.objects.create(name="A", description="a", price=Decimal("10.00"), stock=5)
+            self.order = Order.objects.create(user=self.alice)
+            OrderItem.objects.create(order=self.order, product=self.product, quantity=1)
+
+    def test_unchanged_product_is_answered_304_from_its_version_only(self):
+        url = f"/products/{self.product.pk}/"
+        response = self.client.get(url)
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        # The version comes from the object cache entry the payload would be served from
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(url, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified.content, b"")
+
+        # queryset.update() doesn't go through auto_now, the trigger moves updated_at instead
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                apply_stock_changes({}, {self.product.pk: 1})
+        self.assertGreater(Product.objects.get(pk=self.product.pk).updated_at, self.product.updated_at)
+        changed = self.client.get(url, headers={"If-None-Match": response["ETag"]})
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(changed["ETag"], response["ETag"])
+
+    def test_stale_if_match_prevents_lost_updates(self):
+        url = f"/products/{self.product.pk}/"
+        self.client.force_login(self.admin)
+        etag = self.client.get(url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {"stock": 7}, content_type="application/json")  # Someone else's update
+
+        stale = self.client.patch(url, {"price": "1.00"}, content_type="application/json", headers={"If-Match": etag})
+        self.assertEqual(stale.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.price, Decimal("10.00"))
+
+        current = self.client.get(url)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            updated = self.client.patch(
+                url, {"price": "1.00"}, content_type="application/json", headers={"If-Match": current}
+            )
+        self.assertEqual(updated.status_code, status.HTTP_200_OK)
+        self.assertEqual(updated["ETag"], self.client.get(url)["ETag"])
+        self.assertEqual(
+            self.client.delete(url, headers={"If-Match": current}).status_code, status.HTTP_412_PRECONDITION_FAILED
+        )
+
+    def test_product_list_etag_follows_the_catalog(self):
+        etag = self.client.get("/products/")["ETag"]
+        self.assertNotEqual(self.client.get("/products/?pagenum=1")["ETag"], etag)  # Another URL, another ETag
+
+        with self.assertNumQueries(0):  # The version is the generation of the cached pages
+            self.assertEqual(
+                self.client.get("/products/", headers={"If-None-Match": etag}).status_code,
+                status.HTTP_304_NOT_MODIFIED,
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name="B", description="b", price=Decimal("1.00"), stock=1)
+        self.assertEqual(self.client.get("/products/", headers={"If-None-Match": etag}).status_code, status.HTTP_200_OK)
+
+    def test_order_etags_follow_the_order_and_its_products(self):
+        self.client.force_login(self.alice)
+        detail, listing = f"/orders/{self.order.pk}/", "/orders/"
+        etags = {url: self.client.get(url)["ETag"] for url in (detail, listing)}
+        for url, etag in etags.items():
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED, url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal("12.00")  # Shown in the order items
+            self.product.save()
+        for url, etag in etags.items():
+            response = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+        self.assertEqual(self.client.get(detail).json()["total_price"], 12)
+
+        etag = self.client.get(listing)["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.create(user=self.alice)
+        self.assertEqual(self.client.get(listing, headers={"If-None-Match": etag}).status_code, status.HTTP_200_OK)
+
+        self.client.force_login(User.objects.create_user(username="bob", password="test"))
+        self.assertEqual(self.client.get(detail).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_product_write_evicts_the_cached_order_list(self):
+        self.client.force_login(self.alice)
+        etag = self.client.get("/orders/")["ETag"]  # Cached under the same generations as the ETag
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal("12.00")
+            self.product.save()
+        response = self.client.get("/orders/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()[0]["items"][0]["product_price"], "12.00")
+        self.assertEqual(
+            self.client.get("/orders/", headers={"If-None-Match": response["ETag"]}).status_code,
+            status.HTTP_304_NOT_MODIFIED,
+        )
+
+
+@mock.patch.object(ProductDetailAPIView, "throttle_classes", [])
+@mock.patch.object(ProductBatchAPIView, "throttle_classes", [])
+class ProductObjectCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a = Product.objects.create(name="A", description="a", price=Decimal("1.00"), stock=5)
+            self.b = Product.objects.create(name="B", description="b", price=Decimal("2.00"), stock=5)
+
+    def test_detail_is_served_from_the_object_cache(self):
+        cache.clear()
+        expected = self.client.get(f"/products/{self.a.pk}/").json()
+        with self.assertNumQueries(0):
+            response = self.client.get(f"/products/{self.a.pk}/")
+        self.assertEqual(response.json(), expected)
+        self.assertEqual(cache.get(f"product.uuid.{self.a.product_id}")["data"], expected)
+        self.assertEqual(self.client.get("/products/999999/").json(), {"detail": "No Product matches the given query."})
+
+    def test_writes_refresh_the_entries_in_place(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a.price = Decimal("3.00")
+            self.a.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                apply_stock_changes({}, {self.b.pk: 2})  # queryset.update(), no post_save
+
+        with self.assertNumQueries(0):
+            a, b = (self.client.get(f"/products/{product.pk}/").json() for product in (self.a, self.b))
+        self.assertEqual((a["price"], b["stock"]), ("3.00", 3))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a.delete()
+        self.assertIsNone(cache.get(f"product.{self.a.pk}"))
+
+    def test_batch_reads_use_one_get_many_and_one_query_for_the_misses(self):
+        cache.delete_many([f"product.{self.b.pk}", f"product.uuid.{self.b.product_id}"])
+        url = f"/products/batch/?ids={self.b.pk},999999,{self.a.pk}&product_ids={self.b.product_id}"
+
+        with self.assertNumQueries(1):
+            names = [product["name"] for product in self.client.get(url).json()]
+        self.assertEqual(names, ["B", "A", "B"])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.client.get(url.replace("999999,", "")).json()), 3)
+
+        self.assertEqual(self.client.get("/products/batch/?ids=x").status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(REPLICAS={"ALIASES": ["replica_1"], "STICKY_SECONDS": 10, "MAX_LAG_SECONDS": 5, "CHECK_INTERVAL": 60})
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = mock.Mock(pk=1, is_authenticated=True)
+        patcher = mock.patch.object(replica_health, "usable", return_value=["replica_1"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def route(self, method="get", user=None, model=Product, status_code=200):
+        request = getattr(RequestFactory(), method)("/products/")
+        request.user = user or AnonymousUser()
+        routed = []
+
+        def view(request):
+            routed.append(ReplicaRouter().db_for_read(model))
+            return HttpResponse(status=status_code)
+
+        ReplicaRoutingMiddleware(view)(request)
+        return routed[0]
+
+    def test_only_product_and_order_reads_of_safe_requests_go_to_a_replica(self):
+        self.assertEqual(self.route(), "replica_1")
+        self.assertEqual(self.route(model=Order), "replica_1")
+        self.assertIsNone(self.route(model=User))
+        self.assertEqual(self.route(method="post"), "default")
+        self.assertIsNone(ReplicaRouter().db_for_read(Product))  # Outside a request (commands, shell)
+        self.assertEqual(ReplicaRouter().db_for_write(Product), "default")
+
+    def test_reads_stick_to_the_primary_after_a_write(self):
+        self.route(method="post", user=self.alice, status_code=400)  # Failed writes don't count
+        self.assertEqual(self.route(user=self.alice), "replica_1")
+
+        self.route(method="post", user=self.alice, status_code=201)
+        self.assertEqual(self.route(user=self.alice), "default")
+        self.assertEqual(self.route(user=mock.Mock(pk=2, is_authenticated=True)), "replica_1")
+
+    def test_unreachable_or_lagging_replicas_are_skipped_until_the_next_check(self):
+        health = ReplicaHealth()
+        with mock.patch.object(health, "start"), mock.patch.object(
+            health, "measure", side_effect=[30.0, 0.5, None]
+        ) as measure:
+            self.assertEqual(health.usable(), [])  # Not checked yet
+            health.check()
+            self.assertEqual(health.usable(), [])
+            self.assertEqual(health.usable(), [])  # Routing never measures
+            health.check()
+            self.assertEqual(health.usable(), ["replica_1"])
+            health.check()
+            self.assertEqual(health.usable(), [])
+        self.assertEqual(measure.call_count, 3)
+
+        checking = threading.Event()
+        with mock.patch.object(health, "run", side_effect=lambda: checking.wait(5)) as run:
+            health.usable()
+            health.usable()
+            checking.set()
+            health.thread.join(timeout=5)
+        run.assert_called_once()  # One checking thread per process
+
+    def test_reads_that_fill_a_cache_go_to_the_primary(self):
+        routed = []
+
+        @cache_page_by_generation(60, "replica_test")
+        def page(request):
+            routed.append(ReplicaRouter().db_for_read(Product))
+            return HttpResponse()
+
+        def products(request):
+            with mock.patch("api.object_cache.cache_products", lambda products: routed.append(products.db)):
+                load_products()
+            return HttpResponse()
+
+        for view in (page, products):
+            request = RequestFactory().get("/products/")
+            request.user = AnonymousUser()
+            ReplicaRoutingMiddleware(view)(request)
+        self.assertEqual(routed, [None, "default"])
+        self.assertEqual(self.route(), "replica_1")  # The other reads still go to the replica
+
+    async def test_async_views_choose_the_replica_through_the_async_cache(self):
+        request = RequestFactory().get("/async/products/")
+        request.user = self.alice
+        await aread_alias(request)
+        self.assertEqual(request.replica_alias, "replica_1")
+
+        await sync_to_async(stick_to_primary)(self.alice.pk)
+        request = RequestFactory().get("/async/products/")
+        request.user = self.alice
+        await aread_alias(request)
+        self.assertEqual(request.replica_alias, "default")
+
+
+@skipUnless(fakeredis is not None, "Needs fakeredis (with lupa for Lua scripts)")
+class RedisThrottleTestCase(SimpleTestCase):
+    def setUp(self):
+        # In-memory stand-in for the Redis server, Lua scripts included
+        self.redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch.object(RedisRateThrottle, "get_client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = Request(RequestFactory().get("/products/"))
+        self.request.user = AnonymousUser()
+
+    def throttle(self, throttle_class, rate, now):
+        throttle = type("Throttle", (throttle_class,), {"rate": rate, "scope": "test"})()
+        throttle.timer = lambda: now
+        return throttle
+
+    def attempts(self, throttle_class, rate, now, count=1):
+        results = []
+        for _ in range(count):
+            throttle = self.throttle(throttle_class, rate, now)
+            results.append(throttle.allow_request(self.request, None))
+        return results, throttle.wait()
+
+    def test_sliding_window_weights_the_previous_window(self):
+        self.assertEqual(self.attempts(SlidingWindowAnonRateThrottle, "3/min", 600.0, 4), ([True] * 3 + [False], 80))
+        # 19s into the next window, 3 * (1 - 19/60) + 1 is still over 3; at 20s it isn't
+        self.assertEqual(self.attempts(SlidingWindowAnonRateThrottle, "3/min", 679.0)[0], [False])
+        self.assertEqual(self.attempts(SlidingWindowAnonRateThrottle, "3/min", 680.0)[0], [True])
+        self.assertEqual(len(self.redis.hkeys(next(iter(self.redis.keys("*sliding_window*"))))), 2)
+
+    def test_token_bucket_bursts_then_refills(self):
+        self.assertEqual(self.attempts(TokenBucketAnonRateThrottle, "2/min", 600.0, 3), ([True, True, False], 30))
+        self.assertEqual(self.attempts(TokenBucketAnonRateThrottle, "2/min", 629.0)[0], [False])
+        self.assertEqual(self.attempts(TokenBucketAnonRateThrottle, "2/min", 630.0)[0], [True])
+
+    def test_concurrent_requests_cannot_overrun_the_limit(self):
+        allowed = []
+
+        def attempt():
+            for throttle_class in (SlidingWindowAnonRateThrottle, TokenBucketAnonRateThrottle):
+                if self.throttle(throttle_class, "10/min", 600.0).allow_request(self.request, None):
+                    allowed.append(throttle_class)
+
+        threads = [threading.Thread(target=attempt) for _ in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(allowed.count(SlidingWindowAnonRateThrottle), 10)
+        self.assertEqual(allowed.count(TokenBucketAnonRateThrottle), 10)
+
+
+class TieredCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for _ in range(100):  # L1 is bypassed until the invalidation channel is subscribed
+            if cache.tier.listening:
+                break
+            time.sleep(0.02)
+        self.assertTrue(cache.tier.listening)
+
+    def test_repeated_reads_are_served_in_process(self):
+        cache.set("product.42", {"name": "Cached"}, 60)
+        self.assertEqual(cache.get("product.42"), {"name": "Cached"})
+        with mock.patch.object(TieredRedisCache, "fetch", side_effect=AssertionError("Redis was read")):
+            value = cache.get("product.42")
+            self.assertEqual(value, {"name": "Cached"})
+            value["name"] = "Changed"  # Every hit decodes its own copy
+            self.assertEqual(cache.get_many(["product.42"]), {"product.42": {"name": "Cached"}})
+        self.assertEqual(cache.stats()["l1"]["entries"], 1)
+
+    def test_other_workers_writes_are_broadcast(self):
+        cache.set("generation:tiered", 5, None)
+        self.assertEqual(cache.get("generation:tiered"), 5)
+        key = cache.make_key("generation:tiered")
+        redis = get_redis_connection("default")
+        redis.set(key, 9)  # Another worker's write, not seen by this L1 yet
+        self.assertEqual(cache.get("generation:tiered"), 5)
+        redis.publish(cache.l1_channel, f"another-worker\n{key}")
+        for _ in range(100):
+            if cache.tier.lru.get(key) is None:
+                break
+            time.sleep(0.02)
+        self.assertEqual(cache.get("generation:tiered"), 9)
+
+    def test_own_writes_are_seen_right_away(self):
+        generation = get_generation("product_list")
+        self.assertEqual(get_generation("product_list"), generation)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name="Tiered", description="", price=Decimal("1.00"), stock=1)
+        self.assertEqual(get_generation("product_list"), generation + 1)
+
+    def test_only_prefixed_keys_go_through_l1(self):
+        cache.set("throttle_anon_127.0.0.1", [1.0], 60)
+        cache.get("throttle_anon_127.0.0.1")
+        self.assertEqual(cache.stats()["l1"]["entries"], 0)
+
+    def test_stats_count_lookups_per_tier(self):
+        before = cache.stats()
+        cache.set("product.7", "seven", 60)
+        cache.get("product.7")
+        cache.get("product.7")
+        cache.get("product.8")
+        after = cache.stats()
+        self.assertEqual(after["l1"]["hits"] - before["l1"]["hits"], 1)
+        self.assertEqual(after["l1"]["misses"] - before["l1"]["misses"], 2)
+        self.assertEqual(after["l2"]["hits"] - before["l2"]["hits"], 1)
+        self.assertEqual(after["l2"]["misses"] - before["l2"]["misses"], 1)
+
+
+class LocalLRUTestCase(SimpleTestCase):
+    def test_bounded_by_entries_and_bytes(self):
+        lru = LocalLRU(max_entries=2, max_bytes=10)
+        lru.put("a", b"1234", 60, lru.epoch)
+        lru.put("b", b"1234", 60, lru.epoch)
+        lru.get("a")  # "b" is now the least recently used
+        lru.put("c", b"1234", 60, lru.epoch)
+        self.assertEqual(list(lru.entries), ["a", "c"])
+        lru.put("d", b"12345678", 60, lru.epoch)
+        self.assertEqual((list(lru.entries), lru.size), (["d"], 8))
+
+    def test_entries_expire(self):
+        lru = LocalLRU(max_entries=10, max_bytes=100)
+        with mock.patch("api.tiered_cache.time.monotonic", return_value=100.0):
+            lru.put("a", b"1", 5, lru.epoch)
+        with mock.patch("api.tiered_cache.time.monotonic", return_value=104.9):
+            self.assertEqual(lru.get("a"), b"1")
+        with mock.patch("api.tiered_cache.time.monotonic", return_value=105.0):
+            self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.size, 0)
+
+    def test_read_racing_an_invalidation_is_not_kept(self):
+        lru = LocalLRU(max_entries=10, max_bytes=100)
+        epoch = lru.epoch  # Read from Redis starts
+        lru.invalidate(["a"])  # Another worker writes "a" meanwhile
+        lru.put("a", b"old", 60, epoch)
+        self.assertIsNone(lru.get("a"))
+
+
+@mock.patch.object(ProductListCreateAPIView, "throttle_classes", [])
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class FastListSerializationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username="admin", password="test")
+        self.user = User.objects.create_user(username="büyer", password="test", first_name="Zoë", last_name="Ng")
+        products = [
+            Product.objects.create(name=f"Prodüct {index}  ", description="", price=price, stock=index)
+            for index, price in enumerate([Decimal("0.50"), Decimal("12.99"), Decimal("350.00"), Decimal("7.10")])
+        ]
+        for quantities in ([(0, 2), (3, 1)], [(2, 5)], []):
+            order = Order.objects.create(user=self.user)
+            for product, quantity in quantities:
+                OrderItem.objects.create(order=order, product=products[product], quantity=quantity)
+        # Distinct totals: ?ordering=-total_price has no tie-breaker
+        order = Order.objects.create(user=self.admin, status=Order.StatusChoices.CONFIRMED)
+        OrderItem.objects.create(order=order, product=products[1], quantity=1)
+
+    def assertSameAsSerializers(self, path):
+        fast = self.client.get(path)
+        cache.clear()
+        # The DRF serializers and JSONRenderer
+        with mock.patch.object(ProductListCreateAPIView, "values_serializer_class", None), mock.patch.object(
+            OrderViewSet, "values_serializer_class", None
+        ), mock.patch.object(FastJSONRenderer, "render", JSONRenderer.render):
+            slow = self.client.get(path)
+        cache.clear()
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+        return fast.json()
+
+    def test_product_lists(self):
+        self.assertEqual(len(self.assertSameAsSerializers("/products/?size=4")["results"]), 4)
+        self.assertSameAsSerializers("/products/?ordering=-price&pagenum=2")
+        page = self.assertSameAsSerializers("/products/?pagination=cursor&ordering=price&size=3")
+        self.assertSameAsSerializers(page["next"])
+
+    def test_order_lists(self):
+        for user in (self.user, self.admin):
+            self.client.force_login(user)
+            self.assertSameAsSerializers("/orders/")
+            self.assertSameAsSerializers("/orders/?ordering=-total_price")
+            page = self.assertSameAsSerializers("/orders/?pagination=cursor&ordering=-total_price&size=2")
+            self.assertSameAsSerializers(page["next"])
+        self.assertEqual(len(self.assertSameAsSerializers("/orders/?status=Confirmed")), 1)
+
+    def test_renderer_matches_drf(self):
+        data = {
+            "text": "  \x00\x1f\"\\é😀",
+            "decimal": Decimal("712.99"),
+            "datetime": timezone.now(),
+            "uuid": uuid.uuid4(),
+            "nested": [{"a": None, "b": True, "c": 1.5}],
+            "lazy": _("Not found."),
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, "application/json; indent=2"),
+            JSONRenderer().render(data, "application/json; indent=2"),
+        )
+
+
+class HotQueryIndexTestCase(TestCase):
+    # The access paths of the list endpoints against the plans PostgreSQL picks on a seeded dataset
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            "populate_db", users=20, products=5000, orders=20000, items_per_order=1, seed="plans", stdout=io.StringIO()
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE api_order, api_product")  # Statistics of the seeded rows, as autovacuum would
+        cls.user = Order.objects.values_list("user", flat=True).first()
+        cls.day = Order.objects.order_by("created_at").values_list("created_at", flat=True)[5000].date()
+
+    def assertPlanUses(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn("Seq Scan", plan)
+
+    def filter_orders(self, queryset=None, **params):
+        return OrderFilter(params, queryset=Order.objects.all() if queryset is None else queryset).qs
+
+    def test_order_plans(self):
+        self.assertPlanUses(Order.objects.filter(user=self.user).order_by("pk")[:10], "order_user_pk_idx")
+        self.assertPlanUses(
+            self.filter_orders(Order.objects.filter(user=self.user), created_at=self.day), "order_user_created_idx"
+        )
+        self.assertPlanUses(self.filter_orders(created_at=self.day), "order_created_idx")
+        self.assertPlanUses(self.filter_orders(status=Order.StatusChoices.PENDING, created_at=self.day), "_created_idx")
+        self.assertPlanUses(Order.objects.order_by("-created_at", "-pk")[:10], "order_created_idx")
+        # What the day filter replaced: the cast of every row
+        self.assertIn("Seq Scan", Order.objects.filter(created_at__date=self.day).explain())
+
+    def test_product_plans(self):
+        self.assertPlanUses(
+            ProductFilter({"price__range": "10,10.5"}, queryset=Product.objects.all()).qs, "product_price_idx"
+        )
+        self.assertPlanUses(Product.objects.order_by("price", "pk")[:10], "product_price_idx")
+        self.assertPlanUses(Product.objects.filter(stock__gt=0).order_by("pk")[:10], "product_in_stock_idx")
+
+    def test_day_filter_matches_the_date_lookup(self):
+        # Orders on either side of midnight in both time zones
+        midnight = datetime.combine(self.day, datetime.min.time())
+        edges = [timezone.make_aware(midnight, ZoneInfo(zone)) for zone in ("UTC", "America/New_York")]
+        edges += [edge - timedelta(microseconds=1) for edge in edges]
+        for pk, created_at in zip(Order.objects.values_list("pk", flat=True)[:4], edges):
+            Order.objects.filter(pk=pk).update(created_at=created_at)
+
+        for zone in ("UTC", "America/New_York"):
+            with timezone.override(zone):
+                for day in (self.day, self.day + timedelta(days=1)):
+                    self.assertQuerySetEqual(
+                        self.filter_orders(created_at=day).order_by("pk"),
+                        Order.objects.filter(created_at__date=day).order_by("pk"),
+                    )
+
+
+@mock.patch.object(OrderViewSet, "throttle_classes", [])
+class SalesRollupTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="buyer", password="test")
+        self.admin = User.objects.create_user(username="staff", password="test", is_staff=True)
+        self.camera = Product.objects.create(name="Camera", description="", price=Decimal("10.00"), stock=100)
+        self.film = Product.objects.create(name="Film", description="", price=Decimal("2.50"), stock=100)
+        self.today = timezone.localdate()
+        self.client.force_login(self.user)
+
+    def place(self, *items, status="Confirmed"):
+        payload = {"status": status, "items": [{"product": product.pk, "quantity": quantity} for product, quantity in items]}
+        return self.client.post("/orders/", payload, content_type="application/json").json()["order_id"]
+
+    def patch(self, order_id, status):
+        response = self.client.patch(f"/orders/{order_id}/", {"status": status}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def rollups(self):
+        # The rows still counting something (a rebuild leaves out what went back to zero)
+        products = ProductDailySales.objects.exclude(units=0, orders=0).order_by("day", "product")
+        days = DailySales.objects.exclude(units=0, orders=0).order_by("day")
+        return (
+            [(row.day, row.product_id, row.units, row.revenue, row.orders) for row in products],
+            [(row.day, row.units, row.revenue, row.orders) for row in days],
+        )
+
+    def assertSales(self, products, day):
+        self.assertEqual(
+            self.rollups(),
+            ([(self.today, *row) for row in products], [(self.today, *day)] if day else []),
+        )
+
+    def assertRebuildMatches(self):
+        incremental = self.rollups()
+        call_command("rebuild_sales", stdout=io.StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_order_writes_update_the_rollups(self):
+        first = self.place((self.camera, 2), status="Pending")
+        self.assertSales([], None)
+
+        self.patch(first, "Confirmed")
+        self.assertSales([(self.camera.pk, 2, Decimal("20.00"), 1)], (2, Decimal("20.00"), 1))
+
+        response = self.client.put(
+            f"/orders/{first}/",
+            {"items": [{"product": self.camera.pk, "quantity": 1}, {"product": self.film.pk, "quantity": 4}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        second = self.place((self.film, 2), (self.film, 1))  # Two lines of one product: one order
+        self.assertSales(
+            [(self.camera.pk, 1, Decimal("10.00"), 1), (self.film.pk, 7, Decimal("17.50"), 2)],
+            (8, Decimal("27.50"), 2),
+        )
+        self.assertRebuildMatches()
+
+        self.patch(first, "Cancelled")
+        self.assertSales([(self.film.pk, 3, Decimal("7.50"), 1)], (3, Decimal("7.50"), 1))
+        self.client.delete(f"/orders/{second}/")
+        self.assertSales([], None)
+
+        response = self.client.post(
+            "/orders/bulk/",
+            [
+                {"status": "Confirmed", "items": [{"product": self.camera.pk, "quantity": 3}]},
+                {"status": "Confirmed"},  # An order without items still counts as an order
+                {"items": [{"product": self.camera.pk, "quantity": 5}]},
+            ],
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertSales([(self.camera.pk, 3, Decimal("30.00"), 1)], (3, Decimal("30.00"), 2))
+        self.assertRebuildMatches()
+
+    def test_price_changes_and_product_deletes(self):
+        self.place((self.camera, 2), (self.film, 1))
+        self.client.force_login(self.admin)
+
+        response = self.client.patch(f"/products/{self.camera.pk}/", {"price": "12.00"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertSales(
+            [(self.camera.pk, 2, Decimal("24.00"), 1), (self.film.pk, 1, Decimal("2.50"), 1)],
+            (3, Decimal("26.50"), 1),
+        )
+        self.assertRebuildMatches()
+
+        self.client.delete(f"/products/{self.film.pk}/")
+        self.assertSales([(self.camera.pk, 2, Decimal("24.00"), 1)], (2, Decimal("24.00"), 1))
+        self.assertRebuildMatches()
+
+    def test_imported_prices_reprice_the_rollups(self):
+        self.place((self.camera, 2), (self.film, 1))
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as feed:
+            feed.write(f"product_id,name,description,price,stock\n{self.camera.product_id},Camera,New,12.00,100\n")
+        self.addCleanup(os.unlink, feed.name)
+
+        call_command("import_products", feed.name, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertSales(
+            [(self.camera.pk, 2, Decimal("24.00"), 1), (self.film.pk, 1, Decimal("2.50"), 1)],
+            (3, Decimal("26.50"), 1),
+        )
+        self.assertRebuildMatches()
+
+    def test_rebuild_of_a_range_of_days(self):
+        call_command("populate_db", users=3, products=10, orders=60, seed="sales", stdout=io.StringIO())
+        rebuilt = self.rollups()
+        days = [day for day, *_ in rebuilt[1]]
+        self.assertEqual(
+            sum(orders for *_, orders in rebuilt[1]),
+            Order.objects.filter(status=Order.StatusChoices.CONFIRMED).count(),
+        )
+
+        DailySales.objects.update(units=0, orders=0)
+        call_command("rebuild_sales", since=days[1], until=days[2], stdout=io.StringIO())
+        self.assertEqual(
+            [row[0] for row in self.rollups()[1]], days[1:3]  # Only the rebuilt days count again
+        )
+        call_command("rebuild_sales", stdout=io.StringIO())
+        self.assertEqual(self.rollups(), rebuilt)
+
+    def test_top_sellers_and_series(self):
+        self.place((self.camera, 1), (self.film, 3))
+        self.place((self.film, 1))
+        self.place((self.camera, 9), status="Cancelled")
+        self.client.force_login(self.admin)
+
+        with self.assertNumQueries(4):  # Session, user, rollups, names: whatever the number of orders
+            response = self.client.get("/products/top-sellers/")
+        self.assertEqual(
+            response.json(),
+            {
+                "start": str(self.today - timedelta(days=6)),
+                "end": str(self.today),
+                "by": "units",
+                "results": [
+                    {"units": 4, "revenue": "10.00", "orders": 2, "product": self.film.pk, "name": "Film"},
+                    {"units": 1, "revenue": "10.00", "orders": 1, "product": self.camera.pk, "name": "Camera"},
+                ],
+            },
+        )
+        response = self.client.get("/products/top-sellers/?by=revenue&limit=1")
+        self.assertEqual([seller["name"] for seller in response.json()["results"]], ["Camera"])  # Tie broken by pk
+
+        start = self.today - timedelta(days=2)
+        response = self.client.get(f"/products/sales/?start={start}&end={self.today}").json()
+        self.assertEqual(response["totals"], {"units": 5, "revenue": "20.00", "orders": 2})
+        self.assertEqual(
+            response["results"],
+            [
+                {"units": 0, "revenue": "0.00", "orders": 0, "day": str(start)},
+                {"units": 0, "revenue": "0.00", "orders": 0, "day": str(start + timedelta(days=1))},
+                {"units": 5, "revenue": "20.00", "orders": 2, "day": str(self.today)},
+            ],
+        )
+
+        self.assertEqual(self.client.get(f"/products/sales/?start={self.today}&end={start}").status_code, 400)
+        self.assertEqual(self.client.get("/products/sales/?start=2000-01-01").status_code, 400)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/products/top-sellers/").status_code, 403)
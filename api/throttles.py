@@ -1,4 +1,27 @@
-from rest_framework.throttling import UserRateThrottle
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.commands.core import Script
+from rest_framework.throttling import AnonRateThrottle, ScopedRateThrottle, SimpleRateThrottle, UserRateThrottle
+
+"""
+Atomic Redis throttles
+
+DRF's SimpleRateThrottle keeps a list of request timestamps in the cache: every request reads the
+whole list, trims it in Python and writes it back. That is two round trips, a payload growing with
+the rate, and a race: workers reading the same list at the same time all let their request through.
+
+These throttles run their algorithm in Redis instead, as one Lua script call (EVALSHA, a single round
+trip): Redis runs a script without interleaving any other command, so concurrent workers can't overrun
+the limit, and the state is a couple of numbers whatever the rate.
+
+- Sliding window: the counts of the current and the previous fixed window, the previous one weighted by
+  how much of it still overlaps the sliding window. Same limits as DRF's (N requests per duration),
+  without the timestamps.
+- Token bucket: up to N requests at once, then refilled continuously at N per duration.
+
+Both read the time from the throttle's timer (like DRF, so tests can move it) and use the cache's Redis
+client (django-redis), under the cache's key prefix.
+"""
 
 
 class BurstRateThrottle(UserRateThrottle):
@@ -7,3 +30,127 @@ class BurstRateThrottle(UserRateThrottle):
 
 class SustainedRateThrottle(UserRateThrottle):
     scope = "sustained"
+
+
+SLIDING_WINDOW = Script(
+    None,
+    b"""
+local now, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local current = math.floor(now / window)
+local elapsed = (now % window) / window
+local counts = redis.call('HMGET', KEYS[1], current, current - 1)
+local this, previous = tonumber(counts[1]) or 0, tonumber(counts[2]) or 0
+
+if previous * (1 - elapsed) + this + 1 > limit then
+    -- Milliseconds until the weighted count leaves room for one more request
+    local wait
+    if this + 1 <= limit then
+        wait = window * (1 - elapsed - (limit - 1 - this) / previous)
+    else
+        wait = window * (1 - elapsed) + window * (1 - (limit - 1) / this)
+    end
+    return {0, math.ceil(wait)}
+end
+
+redis.call('HINCRBY', KEYS[1], current, 1)
+redis.call('HDEL', KEYS[1], current - 2)
+redis.call('PEXPIRE', KEYS[1], window * 2)
+return {1, 0}
+""",
+)
+
+TOKEN_BUCKET = Script(
+    None,
+    b"""
+local now, capacity, duration = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local rate = capacity / duration  -- Tokens per millisecond
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens, at = tonumber(state[1]) or capacity, tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - at) * rate)
+at = math.max(at, now)  -- Workers' clocks arrive out of order: never refill the same time twice
+
+local allowed, wait = 0, 0
+if tokens >= 1 then
+    tokens, allowed = tokens - 1, 1
+else
+    wait = math.ceil((1 - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', at)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1000)  -- Gone once full again
+return {allowed, wait}
+""",
+)
+
+
+class RedisRateThrottle(SimpleRateThrottle):
+    """SimpleRateThrottle whose check is one atomic script call (`script` with `script_args`)"""
+
+    script = None
+    key_prefix = None  # Kept apart from the stock throttles' keys, which hold a pickled list
+
+    def get_client(self):
+        return get_redis_connection("default")
+
+    def script_args(self, now_ms):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        allowed, wait_ms = self.script(
+            keys=[cache.make_key(f"{self.key_prefix}:{self.key}")],
+            args=self.script_args(int(self.now * 1000)),
+            client=self.get_client(),
+        )
+        self.wait_seconds = wait_ms / 1000
+        return bool(allowed)
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class SlidingWindowRateThrottle(RedisRateThrottle):
+    script = SLIDING_WINDOW
+    key_prefix = "sliding_window"
+
+    def script_args(self, now_ms):
+        return [now_ms, int(self.duration * 1000), self.num_requests]
+
+
+class TokenBucketRateThrottle(RedisRateThrottle):
+    script = TOKEN_BUCKET
+    key_prefix = "token_bucket"
+
+    def script_args(self, now_ms):
+        return [now_ms, self.num_requests, int(self.duration * 1000)]
+
+
+# Drop-in replacements of DRF's throttles (same scopes and rates settings)
+class SlidingWindowAnonRateThrottle(AnonRateThrottle, SlidingWindowRateThrottle):
+    pass
+
+
+class SlidingWindowUserRateThrottle(UserRateThrottle, SlidingWindowRateThrottle):
+    pass
+
+
+class SlidingWindowScopedRateThrottle(ScopedRateThrottle, SlidingWindowRateThrottle):
+    pass
+
+
+class TokenBucketAnonRateThrottle(AnonRateThrottle, TokenBucketRateThrottle):
+    pass
+
+
+class TokenBucketUserRateThrottle(UserRateThrottle, TokenBucketRateThrottle):
+    pass
+
+
+class TokenBucketScopedRateThrottle(ScopedRateThrottle, TokenBucketRateThrottle):
+    pass
@@ -0,0 +1,387 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis.cache import RedisCache, omit_exception
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+from api.metrics import CACHE_TIER_REQUESTS, record_cache_lookup
+
+"""
+Two-tier cache: an in-process LRU (L1) in front of Redis (L2)
+
+TieredRedisCache is the django-redis backend (same client, keys and serialization, so everything else
+talking to that Redis keeps working) with a small LRU of the raw Redis values in each process. Only the
+keys starting with one of OPTIONS["L1"]["KEY_PREFIXES"] go through L1: the hot, read-mostly ones (cached
+pages, generation counters, product entries), not the throttle or sticky keys written on every request.
+
+- A read of an L1 key is answered from the process memory when it is there, else read from Redis
+  together with its TTL (one pipelined round trip) and kept until the Redis key expires, at most
+  OPTIONS["L1"]["TIMEOUT"] seconds. L1 is bounded by MAX_ENTRIES and MAX_BYTES, least recently used first.
+- Every write of an L1 key through this backend (set, delete, incr of a generation by
+  invalidate_product_cache, ...) drops the key from the local L1 and publishes it on a Redis channel.
+  Each process listens to the channel in a background thread and drops the keys the others wrote.
+- A read racing an invalidation doesn't put what it read into L1 (the LRU counts invalidations).
+  While the channel is down (not subscribed yet, connection lost) L1 is empty and bypassed, since
+  invalidations could be missed. A connection that dies silently leaves L1 at most TIMEOUT behind.
+
+Django creates a cache backend per thread: the L1 of a process (and its listener) is shared by all of
+them. Lookups are counted per tier in the api_cache_requests_total metric, see stats().
+"""
+
+logger = logging.getLogger(__name__)
+
+REDIS_ERRORS = (ConnectionError, TimeoutError, ResponseError, OSError)
+
+L1_DEFAULTS = {
+    "KEY_PREFIXES": (),  # Empty: every key
+    "TIMEOUT": 30,
+    "MAX_ENTRIES": 1000,
+    "MAX_BYTES": 32 * 1024 * 1024,
+    "CHANNEL": "l1.invalidate",
+}
+
+CLEAR_ALL = "*"
+
+
+class LocalLRU:
+    """Bounded store of raw (encoded) Redis values, each with its own expiry"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries, self.max_bytes = max_entries, max_bytes
+        self.entries = OrderedDict()  # key -> (raw value, expires at on the monotonic clock)
+        self.size = 0
+        self.epoch = 0  # Bumped by every invalidation
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, raw, ttl, epoch):
+        """Keep `raw` for `ttl` seconds, unless an invalidation happened since `epoch` was read"""
+        if ttl <= 0 or len(raw) > self.max_bytes:
+            return
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self._pop(key)
+            self.entries[key] = (raw, time.monotonic() + ttl)
+            self.size += len(raw)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.epoch += 1
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class LocalTier:
+    """The L1 of this process for one Redis channel, and the thread applying the other processes' invalidations"""
+
+    def __init__(self, channel, options):
+        self.channel = channel
+        self.lru = LocalLRU(options["MAX_ENTRIES"], options["MAX_BYTES"])
+        self.origin = uuid.uuid4().hex  # Tags this process's messages, already applied locally
+        self.listening = False
+        self.thread = None
+
+    def start(self, connect):
+        self.thread = threading.Thread(target=self.listen, args=(connect,), name="l1-invalidation", daemon=True)
+        self.thread.start()
+
+    def listen(self, connect):
+        backoff = 0.1
+        while True:
+            pubsub = None
+            try:
+                pubsub = connect().pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self.lru.clear()  # Whatever was written while not subscribed
+                        self.listening = True
+                        backoff = 0.1
+                    elif message["type"] == "message":
+                        self.receive(message["data"])
+            except Exception:
+                logger.warning(
+                    "L1 invalidation channel %s lost, bypassing L1 until resubscribed", self.channel, exc_info=True
+                )
+            finally:
+                self.listening = False
+                self.lru.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except REDIS_ERRORS:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 5)
+
+    def message(self, keys):
+        return "\n".join([self.origin, *keys])
+
+    def receive(self, data):
+        origin, *keys = (data.decode() if isinstance(data, bytes) else data).split("\n")
+        if origin == self.origin:
+            return
+        if CLEAR_ALL in keys:
+            self.lru.clear()
+        else:
+            self.lru.invalidate(keys)
+
+
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+class TieredRedisCache(RedisCache):
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self.l1_options = {**L1_DEFAULTS, **params.get("OPTIONS", {}).get("L1", {})}
+        self.l1_prefixes = tuple(self.l1_options["KEY_PREFIXES"])
+        self.l1_channel = self.make_key(self.l1_options["CHANNEL"])
+
+    @property
+    def tier(self):
+        # One per process: a forked worker starts its own (the parent's thread isn't copied)
+        key = (os.getpid(), self._server, self.l1_channel)
+        tier = _tiers.get(key)
+        if tier is None:
+            with _tiers_lock:
+                tier = _tiers.get(key)
+                if tier is None:
+                    tier = LocalTier(self.l1_channel, self.l1_options)
+                    tier.start(lambda: self.client.get_client(write=True))
+                    _tiers[key] = tier
+        return tier
+
+    def l1_key(self, key, version=None):
+        """The Redis key of `key` when it goes through L1, else None"""
+        if self.l1_prefixes and not str(key).startswith(self.l1_prefixes):
+            return None
+        return str(self.client.make_key(key, version=version))
+
+    def l1_ttl(self, pttl):
+        # PTTL: -1 for a key without expiry, -2 for a missing one
+        if pttl == -1:
+            return self.l1_options["TIMEOUT"]
+        return min(self.l1_options["TIMEOUT"], pttl / 1000)
+
+    # Reads
+
+    @omit_exception(return_value={})
+    def fetch(self, keys):
+        """{key: (raw value, PTTL)} of the keys found in Redis, in one round trip"""
+        client = self.client.get_client(write=False)
+        try:
+            pipeline = client.pipeline(transaction=False)
+            pipeline.mget(keys)
+            for key in keys:
+                pipeline.pttl(key)
+            values, *pttls = pipeline.execute()
+        except REDIS_ERRORS as e:
+            raise ConnectionInterrupted(connection=client) from e
+        return {key: (value, pttl) for key, value, pttl in zip(keys, values, pttls) if value is not None}
+
+    def get(self, key, default=None, version=None, client=None):
+        return self.get_many([key], version=version).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        tier = self.tier
+        l1_keys = {}
+        if tier.listening:
+            l1_keys = {key: l1_key for key in keys if (l1_key := self.l1_key(key, version)) is not None}
+
+        found = {}
+        misses = {}
+        for key, l1_key in l1_keys.items():
+            raw = tier.lru.get(l1_key)
+            if raw is None:
+                misses[key] = l1_key
+            else:
+                found[key] = self.client.decode(raw)
+        record_cache_lookup("l1", hits=len(found), misses=len(misses))
+
+        l2_hits = 0
+        if misses:
+            epoch = tier.lru.epoch
+            fetched = self.fetch(list(misses.values()))
+            for key, l1_key in misses.items():
+                if l1_key in fetched:
+                    raw, pttl = fetched[l1_key]
+                    tier.lru.put(l1_key, raw, self.l1_ttl(pttl), epoch)
+                    found[key] = self.client.decode(raw)
+                    l2_hits += 1
+
+        others = [key for key in keys if key not in l1_keys]
+        if others:
+            fetched = super().get_many(others, version=version)
+            found.update(fetched)
+            l2_hits += len(fetched)
+        record_cache_lookup("l2", hits=l2_hits, misses=len(misses) + len(others) - l2_hits)
+        return {key: found[key] for key in keys if key in found}
+
+    def has_key(self, key, version=None, client=None):
+        l1_key = self.l1_key(key, version)
+        if l1_key is not None and self.tier.listening and self.tier.lru.get(l1_key) is not None:
+            return True
+        return super().has_key(key, version=version, client=client)
+
+    # Writes: drop the keys from every process's L1 once Redis has them
+
+    def invalidate(self, keys, version=None):
+        l1_keys = [l1_key for key in keys if (l1_key := self.l1_key(key, version)) is not None]
+        if l1_keys:
+            self.tier.lru.invalidate(l1_keys)
+            self.publish(l1_keys)
+
+    def publish(self, l1_keys):
+        try:
+            self.client.get_client(write=True).publish(self.l1_channel, self.tier.message(l1_keys))
+        except REDIS_ERRORS:
+            # The write itself went through: the other processes' copies expire within the L1 timeout
+            logger.warning("Could not publish L1 invalidations on %s", self.l1_channel, exc_info=True)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        try:
+            return super().set(key, value, timeout, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        try:
+            return super().add(key, value, timeout, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        try:
+            return super().set_many(data, timeout, version, *args, **kwargs)
+        finally:
+            self.invalidate(list(data), version)
+
+    def delete(self, key, version=None, *args, **kwargs):
+        try:
+            return super().delete(key, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def delete_many(self, keys, version=None, *args, **kwargs):
+        keys = list(keys)
+        try:
+            return super().delete_many(keys, version, *args, **kwargs)
+        finally:
+            self.invalidate(keys, version)
+
+    def incr(self, key, delta=1, version=None, *args, **kwargs):
+        try:
+            return super().incr(key, delta, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def decr(self, key, delta=1, version=None, *args, **kwargs):
+        try:
+            return super().decr(key, delta, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def incr_version(self, key, delta=1, version=None, *args, **kwargs):
+        version = self.version if version is None else version
+        try:
+            return super().incr_version(key, delta, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)
+            self.invalidate([key], version + delta)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None, *args, **kwargs):
+        try:
+            return super().touch(key, timeout, version, *args, **kwargs)
+        finally:
+            self.invalidate([key], version)  # Its L1 copy would outlive the new TTL
+
+    def expire(self, key, *args, version=None, **kwargs):
+        try:
+            return super().expire(key, *args, version=version, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def pexpire(self, key, *args, version=None, **kwargs):
+        try:
+            return super().pexpire(key, *args, version=version, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def expire_at(self, key, *args, version=None, **kwargs):
+        try:
+            return super().expire_at(key, *args, version=version, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def pexpire_at(self, key, *args, version=None, **kwargs):
+        try:
+            return super().pexpire_at(key, *args, version=version, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def persist(self, key, *args, version=None, **kwargs):
+        try:
+            return super().persist(key, *args, version=version, **kwargs)
+        finally:
+            self.invalidate([key], version)
+
+    def clear_l1(self):
+        self.tier.lru.clear()
+        self.publish([CLEAR_ALL])
+
+    def delete_pattern(self, *args, **kwargs):
+        try:
+            return super().delete_pattern(*args, **kwargs)
+        finally:
+            self.clear_l1()
+
+    def clear(self):
+        try:
+            return super().clear()
+        finally:
+            self.clear_l1()
+
+    def stats(self):
+        """Lookups and hit ratio per tier in this process, and the size of L1"""
+        counts = CACHE_TIER_REQUESTS.snapshot()
+        stats = {}
+        for tier in ("l1", "l2"):
+            hits, misses = counts.get((tier, "hit"), 0), counts.get((tier, "miss"), 0)
+            ratio = hits / (hits + misses) if hits + misses else None
+            stats[tier] = {"hits": hits, "misses": misses, "hit_ratio": ratio}
+        lru = self.tier.lru
+        stats["l1"].update(entries=len(lru.entries), bytes=lru.size, listening=self.tier.listening)
+        return stats
@@ -1,16 +1,26 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path("products/", views.ProductListCreateAPIView.as_view()),
     path("products/info/", views.ProductInfoAPIView.as_view()),
+    path("products/export/", views.ProductExportAPIView.as_view()),
+    path("products/batch/", views.ProductBatchAPIView.as_view()),
+    path("products/top-sellers/", views.TopSellersAPIView.as_view()),
+    path("products/sales/", views.SalesSeriesAPIView.as_view()),
     # path("products/<uuid:product_id>/", views.ProductDetailAPIView.as_view()),
     path("products/<int:product_id>/", views.ProductDetailAPIView.as_view()),
     # path("orders/", views.OrderListAPIView.as_view()),
     # path("user-orders/", views.UserOrderListAPIView.as_view()),
     path("users/", views.UserListView.as_view()),
+    # Async versions of the read endpoints (api/async_views.py), for ASGI deployments
+    path("async/products/", async_views.product_list),
+    path("async/products/info/", async_views.product_info),
+    path("async/products/<int:product_id>/", async_views.product_detail),
+    path("async/orders/", async_views.order_list),
+    path("async/orders/<uuid:pk>/", async_views.order_detail),
 ]
 
 router = DefaultRouter()
@@ -1,26 +1,58 @@
+import uuid
+from datetime import timedelta
+from decimal import Decimal
 from typing import Any
 
-from django.db.models import Max, QuerySet
+from django.db.models import Count, DecimalField, F, Max, Prefetch, QuerySet, Sum, Value, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters, generics, viewsets
+from rest_framework import filters, generics, status, viewsets
 from rest_framework.decorators import action, api_view
 from rest_framework.pagination import LimitOffsetPagination, PageNumberPagination
 from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.views.decorators.cache import cache_page
 from django.utils.decorators import method_decorator
-from api.filters import InStockFilterBackend, OrderFilter, ProductFilter
+from api.filters import InStockFilterBackend, OrderFilter, ProductFilter, ProductSearchFilter
 from django.views.decorators.vary import vary_on_headers
-from api.models import Order, OrderItem, Product, User
-from rest_framework.throttling import ScopedRateThrottle
+from api.models import DailySales, Order, OrderItem, Product, ProductDailySales, User
+from api.throttles import SlidingWindowScopedRateThrottle  # ScopedRateThrottle checked by one atomic Redis call
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema
+from api.streaming import stream_json_object
+from api.exports import (
+    ORDER_ITEM_EXPORT_FIELDS,
+    PRODUCT_EXPORT_FIELDS,
+    export_response,
+    order_documents,
+    order_item_rows,
+    product_documents,
+    product_rows,
+)
+from api.renderers import CSVRenderer, NDJSONRenderer
+from api.pagination import KeysetPagination, KeysetPaginationMixin, ProductPageNumberPagination
+from api.fast_serializers import OrderValuesSerializer, ProductValuesSerializer, ValuesListMixin
+from api.cache import cache_page_by_generation, order_list_page_namespaces
+from api.object_cache import get_products
+from api.conditional import conditional, order_list_version, order_version, product_list_version, product_version
+from api.sales import apply_sales_changes, sales_day, sold_quantities
+from api.stock import apply_stock_changes, held_quantities, lock_order_holding
 from api.serializers import (
     OrderCreateSerializer,
     OrderSerializer,
     ProductInfoSerializer,
     ProductSerializer,
+    SalesRangeSerializer,
+    SalesSeriesSerializer,
+    TopSellersQuerySerializer,
+    TopSellersSerializer,
     UserSerializer,
+    UserSummarySerializer,
 )
 
 """
@@ -29,9 +61,29 @@ Class Base Generic Views
 
 # List of users
 class UserListView(generics.ListAPIView):
-    queryset = User.objects.all()
+    # Only the order pks are needed for UserSerializer.orders, fetched in one query per page
+    queryset = User.objects.prefetch_related(
+        Prefetch("orders", queryset=Order.objects.only("pk", "user_id"))
+    ).order_by("pk")
     serializer_class = UserSerializer
-    pagination_class = None
+    pagination_class = KeysetPagination  # Keyset cursors, so deep pages cost the same as the first one
+    ordering_fields = ["username", "date_joined"]
+
+    # ?compact=true returns order_count/last_order_at aggregates instead of the full list of order pks
+    def is_compact(self):
+        return self.request.query_params.get("compact", "").lower() in ("1", "true", "yes")
+
+    def get_queryset(self):
+        if self.is_compact():
+            return User.objects.annotate(
+                order_count=Count("orders"), last_order_at=Max("orders__created_at")
+            ).order_by("pk")
+        return super().get_queryset()
+
+    def get_serializer_class(self):
+        if self.is_compact():
+            return UserSummarySerializer
+        return super().get_serializer_class()
 
 
 # List and Create Product
@@ -49,18 +101,19 @@ class UserListView(generics.ListAPIView):
 #         return super().get_permissions()
 
 
-class ProductListCreateAPIView(generics.ListCreateAPIView):
+class ProductListCreateAPIView(ValuesListMixin, KeysetPaginationMixin, generics.ListCreateAPIView):
     throttle_scope = "products" # To throttle the requests for products
-    throttle_classes = [ScopedRateThrottle] # This could also be done in the settings.py file globally
+    throttle_classes = [SlidingWindowScopedRateThrottle] # This could also be done in the settings.py file globally
     # queryset = Product.objects.all()
-    queryset = Product.objects.order_by(
+    queryset = Product.objects.defer("search_vector").order_by(
         "pk"
     )  # To solve :  UnorderedObjectListWarning: Pagination may yield inconsistent results with an unordered object_list: <class 'api.models.Product'> QuerySet.
     serializer_class = ProductSerializer
+    values_serializer_class = ProductValuesSerializer  # Same JSON for the list, from .values_list() rows
     filterset_class = ProductFilter
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
+        ProductSearchFilter,  # Full-text + trigram search on PostgreSQL (filters.SearchFilter elsewhere)
         filters.OrderingFilter,
         # InStockFilterBackend,
     ]
@@ -69,19 +122,19 @@ class ProductListCreateAPIView(generics.ListCreateAPIView):
         "description",
     ]  # To exactly match the name, add = before the name (['=name', 'description'])
     ordering_fields = ["name", "price", "stock"]
+    # Maximum queries per request, session authentication included (api/querybudget.py)
+    query_budget = {"get": 4, "post": 4}
     # pagination_class = LimitOffsetPagination
-    pagination_class = PageNumberPagination
-    pagination_class.page_size = 2
-    pagination_class.page_query_param = "pagenum"
-    pagination_class.page_size_query_param = "size"
-    pagination_class.max_page_size = 4
+    pagination_class = ProductPageNumberPagination  # ?pagenum=&size= (pass ?pagination=cursor for keyset pagination instead)
 
 
 # docker run --name django-redis -d -p 6379:6379 --rm redis # To run the redis container
 # docker ps # To check if the redis container is running
 
     # Overriding the list method to cache the product list for 15 minutes (60 * 15 = 900 seconds = 15 minutes)
-    @method_decorator(cache_page(60 * 15, key_prefix='product_list'))
+    # A client sending back the ETag of an unchanged catalog gets a 304 before the cache is even looked up
+    @conditional(product_list_version)
+    @method_decorator(cache_page_by_generation(60 * 15, "product_list"))  # Key prefix moves on with every product write
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
     
@@ -104,12 +157,81 @@ class ProductListCreateAPIView(generics.ListCreateAPIView):
         )
 
 
+# Stream the (filtered) catalog as NDJSON (default) or CSV: /products/export/?format=csv&price__gt=10
+class ProductExportAPIView(generics.GenericAPIView):
+    queryset = Product.objects.order_by("pk")
+    filterset_class = ProductFilter
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, filters.OrderingFilter]
+    search_fields = ["name", "description"]
+    ordering_fields = ["name", "price", "stock"]
+    renderer_classes = [NDJSONRenderer, CSVRenderer]
+    pagination_class = None
+
+    # ?format= comes from the renderers: one Product document per line, or a CSV row of PRODUCT_EXPORT_FIELDS
+    @extend_schema(
+        responses={
+            (200, NDJSONRenderer.media_type): ProductSerializer(many=True),
+            (200, CSVRenderer.media_type): OpenApiTypes.BINARY,
+        }
+    )
+    def get(self, request):
+        products = self.filter_queryset(self.get_queryset())
+        return export_response(
+            request,
+            "products",
+            product_documents(products),
+            PRODUCT_EXPORT_FIELDS,
+            product_rows(products),
+        )
+
+
+# Several products in one request, from the object cache: /products/batch/?ids=1,2&product_ids=<uuid>,<uuid>
+class ProductBatchAPIView(APIView):
+    throttle_scope = "products"
+    throttle_classes = [SlidingWindowScopedRateThrottle]
+    max_products = 100
+    # Session authentication + one read-through query for the products missing from the cache
+    query_budget = 3
+
+    @extend_schema(responses=ProductSerializer(many=True))
+    def get(self, request):
+        ids = [value for value in request.query_params.get("ids", "").split(",") if value]
+        product_ids = [value for value in request.query_params.get("product_ids", "").split(",") if value]
+        if len(ids) + len(product_ids) > self.max_products:
+            raise ValidationError({"detail": f"At most {self.max_products} products per request."})
+        try:
+            by_pk, by_product_id = get_products(pks=ids, product_ids=product_ids)
+        except ValueError:
+            raise ValidationError({"detail": "ids must be integers and product_ids UUIDs."})
+
+        # In the requested order, unknown products left out
+        products = [by_pk.get(int(pk)) for pk in ids] + [by_product_id.get(uuid.UUID(value)) for value in product_ids]
+        return Response([product["data"] for product in products if product is not None])
+
+
 # class ProductDetailAPIView(generics.RetrieveAPIView):
 class ProductDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Product.objects.all()
+    queryset = Product.objects.defer("search_vector")  # The tsvector is only needed by the search filter
     serializer_class = ProductSerializer
     lookup_url_kwarg = "product_id"
 
+    # ETag/Last-Modified from the product's updated_at: 304 on GET, 412 on a PUT/PATCH/DELETE with a stale If-Match
+    # The payload comes from the per-product object cache (api/object_cache.py), looked up by product_version
+    @conditional(product_version)
+    def retrieve(self, request, *args, **kwargs):
+        product = getattr(self, "cached_product", None)
+        if product is None:
+            raise NotFound("No Product matches the given query.")
+        return Response(product["data"])
+
+    @conditional(product_version)
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @conditional(product_version)
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
     def get_permissions(self):
         self.permission_classes = [AllowAny]
         if self.request.method in ["PUT", "PATCH", "DELETE"]:
@@ -143,38 +265,132 @@ Class Base ViewSet (ViewSet allows creation of CRUD operations in a single class
 """
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ValuesListMixin, KeysetPaginationMixin, viewsets.ModelViewSet):
     throttle_scope = "orders" # To throttle the requests for orders
-    throttle_classes = [ScopedRateThrottle] # This could also be done in the settings.py file globally
+    throttle_classes = [SlidingWindowScopedRateThrottle] # This could also be done in the settings.py file globally
     # queryset = Order.objects.prefetch_related("items__product")
-    queryset = Order.objects.prefetch_related("items__product").order_by(
+    queryset = Order.objects.select_related("user").prefetch_related(
+        # Both in pk order, like the queries of OrderValuesSerializer, so both paths list them the same way
+        Prefetch("items", queryset=OrderItem.objects.order_by("pk")),
+        "items__product",
+        # OrderSerializer.user lists the pks of the user's orders, fetched in one query for the whole page
+        Prefetch("user__orders", queryset=Order.objects.only("pk", "user_id").order_by("pk")),
+    ).annotate(
+        # Order totals are computed by the database, so they can be filtered and sorted on in SQL
+        total_price=Coalesce(
+            Sum(F("items__product__price") * F("items__quantity")),
+            Value(Decimal("0")),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+        item_count=Count("items"),
+    ).order_by(
         "pk"
     )  # To solve :  UnorderedObjectListWarning: Pagination may yield inconsistent results with an unordered object_list: <class 'api.models.Order'> QuerySet.
     serializer_class = OrderSerializer
+    values_serializer_class = OrderValuesSerializer  # Same JSON for the list, from .values_list() rows
     # permission_classes = [AllowAny] # To allow the access to the CRUD operations on the orders endpoint to any user
     permission_classes = [
         IsAuthenticated
     ]  # To restrict the access to the CRUD operations on the orders endpoint to only authenticated users
-    pagination_class = None
+    pagination_class = None  # Plain list by default, ?pagination=cursor returns keyset pages
     filterset_class = OrderFilter
-    filter_backends = [DjangoFilterBackend]
-
-    @method_decorator(cache_page(60 * 15, key_prefix='order_list'))
-    @method_decorator(vary_on_headers("Authorization")) # To vary the cache based on the Authorization header
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    ordering_fields = ["created_at", "total_price"]
+    bulk_max_orders = 1000  # Maximum number of orders accepted by POST /orders/bulk/
+    # Maximum queries per request, session authentication included (api/querybudget.py)
+    # Writes take one stock UPDATE per product, so they have no fixed budget (the N+1 detector still applies)
+    # The ETag version lookups (api/conditional.py) take 1 query on retrieve, none on list (cache generations)
+    query_budget = {"list": 6, "retrieve": 7}
+
+    # Cached per user (staff share one entry) instead of per Authorization header, so a refreshed JWT
+    # still hits the cache, and an order write only evicts its owner's entries and the staff's.
+    # The items show their products, so a product write evicts every order list as well
+    @conditional(order_list_version)
+    @method_decorator(cache_page_by_generation(60 * 15, lambda request: order_list_page_namespaces(request.user)))
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)   
 
+    # ETag/Last-Modified of one order: 304 on GET, 412 on a PUT/PATCH/DELETE with a stale If-Match
+    @conditional(order_version)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @conditional(order_version)
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @conditional(order_version)
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
     # Pass the current user to the serializer
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+    # Stream the user's (or, for staff, every) order as NDJSON (default) or CSV, with the OrderFilter filters
+    @action(detail=False, methods=["get"], url_path="export", renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        orders = self.filter_queryset(self.get_queryset())
+        return export_response(
+            request,
+            "orders",
+            order_documents(orders),
+            ORDER_ITEM_EXPORT_FIELDS,
+            order_item_rows(orders),
+        )
+
+    # Deleting an order that still holds stock gives it back, a confirmed one leaves the sales rollups
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            status, items = lock_order_holding(instance)
+            apply_stock_changes(held_quantities(status, items), {})
+            apply_sales_changes([(sales_day(instance), sold_quantities(status, items), None)])
+            instance.delete()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ("create", "update", "bulk"):  # The actions using OrderCreateSerializer
+            context["products"] = self.preload_products()
+        return context
+
+    # Load every product referenced by the posted items with one query instead of one per order item
+    def preload_products(self):
+        orders = self.request.data if isinstance(self.request.data, list) else [self.request.data]
+        product_ids = {
+            item.get("product")
+            for order in orders
+            if isinstance(order, dict)
+            for item in order.get("items") or []
+            if isinstance(item, dict)
+        }
+        return Product.objects.in_bulk(
+            [pk for pk in product_ids if isinstance(pk, int) or (isinstance(pk, str) and pk.isdigit())]
+        )
+
     def get_serializer_class(self):
         # Can also check if POST: if self.request.method == 'POST'
         # Can also check if PUT or PATCH: if self.request.method in ['PUT', 'PATCH']
-        if self.action == "create" or self.action == "update":
+        if self.action in ("create", "update", "bulk"):
             return OrderCreateSerializer
         return super().get_serializer_class()
 
+    # Create many orders in one request with a fixed number of queries, whatever the batch size
+    @extend_schema(
+        request=OrderCreateSerializer(many=True),
+        responses={201: OrderCreateSerializer(many=True)},
+    )
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        if not isinstance(request.data, list):
+            raise ValidationError({"non_field_errors": ["Expected a list of orders."]})
+
+        serializer = self.get_serializer(data=request.data, many=True, max_length=self.bulk_max_orders)
+        serializer.is_valid(raise_exception=True)
+        orders = serializer.save(user=request.user)
+
+        prefetch_related_objects(orders, "items")  # One query for the items of the response
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     # Allow admin to perform CRUD operations on all orders, and users to perform CRUD operations on their own orders
     def get_queryset(self):
         qs = super().get_queryset()
@@ -200,15 +416,77 @@ Class Base API View
 
 
 class ProductInfoAPIView(APIView):
+    chunk_size = 2000  # Number of products fetched from the server-side cursor and serialized at a time
+
+    @extend_schema(responses=ProductInfoSerializer)
     def get(self, request):
-        products = Product.objects.all()
-        serializer = ProductInfoSerializer(
-            {
-                "products": products,
-                "count": len(products),
-                "max_price": products.aggregate(max_price=Max("price"))["max_price"],
-            }
+        products = Product.objects.defer("search_vector").order_by("pk")
+        # Count and max price are computed by the database in a single aggregate query
+        info = products.aggregate(count=Count("pk"), max_price=Max("price"))
+        max_price = info["max_price"]
+
+        # Stream the products out chunk by chunk so memory stays flat whatever the catalog size
+        # The payload has the same shape as ProductInfoSerializer (products, count, max_price)
+        return StreamingHttpResponse(
+            stream_json_object(
+                "products",
+                products,
+                ProductSerializer,
+                extra={
+                    "count": info["count"],
+                    "max_price": float(max_price) if max_price is not None else None,
+                },
+                chunk_size=self.chunk_size,
+            ),
+            content_type="application/json",
         )
-        return Response(serializer.data)
 
-        # Continue from Video 29
+
+# Best sellers of a range of days from the sales rollups (api/sales.py), whatever the number of orders:
+# /products/top-sellers/?start=2025-06-01&end=2025-06-07&by=revenue&limit=10
+class TopSellersAPIView(APIView):
+    permission_classes = [IsAdminUser]
+    # Session authentication + the rollups of the range + the names of the products
+    query_budget = 4
+
+    @extend_schema(parameters=[TopSellersQuerySerializer], responses=TopSellersSerializer)
+    def get(self, request):
+        params = TopSellersQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        start, end, by = params.validated_data["start"], params.validated_data["end"], params.validated_data["by"]
+
+        sellers = list(
+            ProductDailySales.objects.filter(day__range=(start, end))
+            .values("product")
+            .annotate(units=Sum("units"), revenue=Sum("revenue"), orders=Sum("orders"))
+            .filter(units__gt=0)  # Products whose orders were all cancelled again
+            .order_by(f"-{by}", "product")[: params.validated_data["limit"]]
+        )
+        names = dict(Product.objects.filter(pk__in=[seller["product"] for seller in sellers]).values_list("pk", "name"))
+        for seller in sellers:
+            seller["name"] = names[seller["product"]]
+        return Response(TopSellersSerializer({"start": start, "end": end, "by": by, "results": sellers}).data)
+
+
+# Units, revenue and confirmed orders per day from the sales rollups: /products/sales/?start=2025-06-01&end=2025-06-30
+class SalesSeriesAPIView(APIView):
+    permission_classes = [IsAdminUser]
+    # Session authentication + the days of the range
+    query_budget = 3
+
+    @extend_schema(parameters=[SalesRangeSerializer], responses=SalesSeriesSerializer)
+    def get(self, request):
+        params = SalesRangeSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        start, end = params.validated_data["start"], params.validated_data["end"]
+
+        days = {
+            day.day: {"day": day.day, "units": day.units, "revenue": day.revenue, "orders": day.orders}
+            for day in DailySales.objects.filter(day__range=(start, end))
+        }
+        series = [
+            days.get(day) or {"day": day, "units": 0, "revenue": Decimal("0"), "orders": 0}
+            for day in (start + timedelta(days=n) for n in range((end - start).days + 1))
+        ]
+        totals = {name: sum(day[name] for day in series) for name in ("units", "revenue", "orders")}
+        return Response(SalesSeriesSerializer({"start": start, "end": end, "totals": totals, "results": series}).data)
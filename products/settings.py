@@ -1,4 +1,6 @@
 import os
+import random
+import sys
 
 import dotenv
 
@@ -21,6 +23,8 @@ SECRET_KEY = "django-insecure-%hjisw!0c0)bs&s9m#0e(#(=g54-#f+q2-d3+p%puk)0=5qrp#
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
+
 ALLOWED_HOSTS = []
 
 
@@ -33,6 +37,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "django_extensions",
     "api",
     "rest_framework",
@@ -42,14 +47,19 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",  # First, so the latency covers the whole middleware stack
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "api.replicas.ReplicaRoutingMiddleware",  # GET reads of products/orders go to the replicas (if any)
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "silk.middleware.SilkyMiddleware",
+    # silk's SilkyMiddleware, usable in an async stack (api/profiling.py)
+    # Only records the requests picked by silk_intercept below
+    "api.profiling.SilkMiddleware",
+    "api.querybudget.QueryBudgetMiddleware",  # Last, so it only counts the queries of the view
 ]
 
 ROOT_URLCONF = "products.urls"
@@ -71,6 +81,8 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "products.wsgi.application"
+# The /async/ views (api/async_views.py) only stop holding a thread per request under an ASGI server
+ASGI_APPLICATION = "products.asgi.application"
 
 
 # Database
@@ -87,8 +99,46 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable not set")
 
+# Looser trigram word match for the product search typo fallback (the pg_trgm default of 0.6 misses one-letter typos),
+# sent as a startup option. Poolers that reject startup options (pgbouncer in transaction mode) need it empty,
+# the threshold then comes from the server: ALTER ROLE ... SET pg_trgm.word_similarity_threshold = 0.5
+TRIGRAM_WORD_SIMILARITY_THRESHOLD = os.getenv("TRIGRAM_WORD_SIMILARITY_THRESHOLD", "0.5")
+
+
+def with_search_options(database):
+    """Add the search settings to the libpq `options` of the database (after any from its URL)"""
+    if TRIGRAM_WORD_SIMILARITY_THRESHOLD:
+        options = database.setdefault("OPTIONS", {})
+        setting = f"-c pg_trgm.word_similarity_threshold={TRIGRAM_WORD_SIMILARITY_THRESHOLD}"
+        options["options"] = f"{options['options']} {setting}" if options.get("options") else setting
+    return database
+
+
 DATABASES = {
-    "default": dj_database_url.parse(DATABASE_URL, conn_max_age=600, ssl_require=True)
+    "default": with_search_options(dj_database_url.parse(DATABASE_URL, conn_max_age=600, ssl_require=True))
+}
+
+# Read replicas: every DATABASE_URL_REPLICA_<name> variable adds a replica_<name> database, which
+# api.replicas.ReplicaRouter uses for the product/order reads of GET requests
+for name, url in sorted(os.environ.items()):
+    if name.startswith("DATABASE_URL_REPLICA_") and url:
+        alias = "replica_" + name.removeprefix("DATABASE_URL_REPLICA_").lower()
+        # Its own URL's options, plus the search settings (the product searches are read from the replicas too)
+        DATABASES[alias] = with_search_options(dj_database_url.parse(url, conn_max_age=600, ssl_require=True))
+        # Fail fast on a dead replica (the health check then falls back to the primary)
+        DATABASES[alias]["OPTIONS"]["connect_timeout"] = 2
+        DATABASES[alias]["TEST"] = {"MIRROR": "default"}  # Tests read the replicas from the test database
+
+DATABASE_ROUTERS = ["api.replicas.ReplicaRouter"]
+
+REPLICAS = {
+    "ALIASES": [alias for alias in DATABASES if alias.startswith("replica_")],
+    # Seconds a user's reads stay on the primary after a write (read-your-writes)
+    "STICKY_SECONDS": int(os.getenv("REPLICA_STICKY_SECONDS", "10")),
+    # Replicas further behind than this are skipped
+    "MAX_LAG_SECONDS": float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5")),
+    # Seconds between two health/lag checks of a replica, per process
+    "CHECK_INTERVAL": float(os.getenv("REPLICA_CHECK_INTERVAL", "5")),
 }
 
 
@@ -140,18 +190,24 @@ REST_FRAMEWORK = {
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework_simplejwt.authentication.JWTAuthentication",
     ],
+    # JSON through orjson (same bytes as DRF's JSONRenderer, see api/renderers.py)
+    "DEFAULT_RENDERER_CLASSES": [
+        "api.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend"
     ],  # This ia a Generic Filtering, it applies to all the views (It could also be used at the individual view level)
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 5,
+    # Same throttles as rest_framework.throttling, each checked by one atomic Redis script call (api/throttles.py)
     "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.AnonRateThrottle",  # To throttle the requests for anonymous users
-        # "rest_framework.throttling.UserRateThrottle", # To throttle the requests for authenticated users
+        "api.throttles.SlidingWindowAnonRateThrottle",  # To throttle the requests for anonymous users
+        # "api.throttles.SlidingWindowUserRateThrottle", # To throttle the requests for authenticated users
         # "api.throttles.BurstRateThrottle", # To throttle the requests for burst (UserRateThrottle)
         # "api.throttles.SustainedRateThrottle", # To throttle the requests for sustained (UserRateThrottle)
-        "rest_framework.throttling.ScopedRateThrottle", # To throttle the requests for scoped (UserRateThrottle)
+        "api.throttles.SlidingWindowScopedRateThrottle", # To throttle the requests for scoped (UserRateThrottle)
     ],
     "DEFAULT_THROTTLE_RATES": {
         "anon": "2/minute",  # 2 requests per minute for anonymous users
@@ -170,16 +226,58 @@ SPECTACULAR_SETTINGS = {
     "SERVE_INCLUDE_SCHEMA": False,
 }
 
+# Redis behind an in-process LRU for the hot, read-mostly keys, invalidated across workers through a
+# Redis channel (api/tiered_cache.py)
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "api.tiered_cache.TieredRedisCache",
         "LOCATION": "redis://127.0.0.1:6379/1",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "L1": {
+                # Cached pages and their headers, generation counters, product object cache entries
+                "KEY_PREFIXES": ["views.decorators.cache.", "generation:", "product."],
+                "TIMEOUT": int(os.getenv("CACHE_L1_TIMEOUT", "30")),
+                "MAX_ENTRIES": int(os.getenv("CACHE_L1_MAX_ENTRIES", "1000")),
+                "MAX_BYTES": int(os.getenv("CACHE_L1_MAX_BYTES", str(32 * 1024 * 1024))),
+            },
         },
     }
 }
 
+# redis.asyncio client of the async views' page cache (api/async_cache.py): same Redis as the default
+# cache, so they share its generation counters. OPTIONS are passed to redis.asyncio.Redis.from_url
+ASYNC_CACHE = {
+    "LOCATION": CACHES["default"]["LOCATION"],
+    "OPTIONS": {},
+}
+
+# Silk writes every request it records (with its SQL) to the database: only record a sampled fraction,
+# plus the requests of staff users sending "X-Silk-Profile: 1" (none in tests, whose query counts must be exact)
+SILK_SAMPLE_RATE = float(os.getenv("SILK_SAMPLE_RATE", "0" if TESTING else "0.01"))
+
+
+def silk_intercept(request):
+    if request.headers.get("X-Silk-Profile") == "1" and getattr(request, "user", None) and request.user.is_staff:
+        return True
+    return random.random() < SILK_SAMPLE_RATE
+
+
+SILKY_INTERCEPT_FUNC = silk_intercept
+# silk_profile checks that this middleware is installed, silk's own is wrapped by api/profiling.py
+SILKY_MIDDLEWARE_CLASS = "api.profiling.SilkMiddleware"
+
+# /metrics/ (api/metrics.py) answers staff users and scrapes sending "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Per-view query budgets and N+1 detection (api/querybudget.py)
+# Test runs fail on a violation, otherwise a sampled fraction of the requests logs it with its stack
+QUERY_BUDGET = {
+    "MODE": os.getenv("QUERY_BUDGET_MODE", "raise" if TESTING else "log"),  # raise, log or off
+    "SAMPLE_RATE": float(os.getenv("QUERY_BUDGET_SAMPLE_RATE", "1.0" if DEBUG or TESTING else "0.01")),
+    "REPEATED_QUERY_THRESHOLD": 3,
+}
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=60),  # 1 hour access token
     "REFRESH_TOKEN_LIFETIME": timedelta(days=7),  # 7 days refresh token
@@ -12,6 +12,7 @@
 
 from django.contrib import admin
 from django.urls import include, path
+from api.metrics import metrics_view
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -26,6 +27,7 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", include("api.urls")),
     path("silk/", include("silk.urls", namespace="silk")),
+    path("metrics/", metrics_view, name="metrics"),  # Prometheus scrape endpoint (api/metrics.py)
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
     path("api/schema/", SpectacularAPIView.as_view(), name="schema"),